@@ -0,0 +1,333 @@
+"""
+Asynchronous web game server
+
+An ASGI application serving the same routes as webgame.py. Each session
+is guarded by its own lock, and AI moves and session store calls run in
+a thread pool rather than on the event loop. Serve it with any ASGI server, for example
+
+    uvicorn asyncgame:app
+"""
+
+import asyncio
+import json
+import mimetypes
+import os
+import re
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import parse_qsl, urlencode
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from tictactoe import State, metrics, responses
+from tictactoe.movetable import MoveTable
+from tictactoe.session import SessionConflictError, SessionData, \
+    make_session_store, submit_batch, submit_form
+
+APPLICATION_ROOT = os.environ.get('FLASK_APPLICATION_ROOT', '')
+EMPTY_BOARD = list(State()[:].flatten())  # No touchy
+STATIC_FOLDER = os.path.abspath('static')
+MOVE_TABLE = MoveTable.from_files('move-table.json', 'move-table.bin')
+# Session data is serialized as boards are first played
+RESPONSES = responses.ResponseCache()
+
+
+def parse_form(content_type, body):
+    """
+    Parse a URL-encoded or multipart form body
+    :param content_type: (string) the Content-Type header of the request
+    :param body: (bytes) the request body
+    :return: (dict) of field names to string values
+    """
+    if content_type.startswith('multipart/form-data'):
+        header = f'Content-Type: {content_type}\r\n\r\n'.encode('latin-1')
+        message = BytesParser(policy=HTTP).parsebytes(header + body)
+        return {part.get_param('name', header='content-disposition'):
+                part.get_content() for part in message.iter_parts()}
+    return dict(parse_qsl(body.decode('utf-8')))
+
+
+class GameServer:
+    """
+    ASGI application for playing games against the AI
+    """
+    def __init__(self, move_table, prefix='', max_workers=None,
+                 sessions=None, response_cache=None):
+        self.move_table = move_table
+        self.responses = response_cache if response_cache is not None \
+            else RESPONSES
+        self.prefix = prefix
+        self.sessions = sessions if sessions is not None \
+            else make_session_store()
+        # A lock lives only while a request for its session holds it
+        self._locks = weakref.WeakValueDictionary()
+        self._executor = ThreadPoolExecutor(max_workers)
+        self._templates = Environment(loader=FileSystemLoader('templates'),
+                                      autoescape=select_autoescape())
+        self._templates.globals.update(
+            url_for=self.url_for,
+            FLASK_APPLICATION_ROOT=lambda: self.prefix)
+        self._routes = [
+            ('GET', r'/', self.home),
+            ('GET', r'/start-new-game', self.start_new_game),
+            ('GET', r'/session/([^/]+)', self.session),
+            ('GET', r'/session-data/([^/]+)', self.session_data),
+            ('POST', r'/session-data/([^/]+)', self.session_data_submit),
+            ('POST', r'/moves', self.moves),
+            ('GET', r'/move/([^/]+)/([^/]+)', self.move),
+            ('GET', r'/metrics', self.metrics_text),
+            ('GET', r'/static/(.+)', self.static),
+        ]
+
+    def url_for(self, endpoint, **values):
+        """
+        Build the URL of a route, named as in webgame.py. Values which are
+        not part of the path go in the query string.
+        :param endpoint: (string) the endpoint name
+        :return: (string) the URL
+        """
+        paths = {
+            'main.home': '/',
+            'main.start_new_game': '/start-new-game',
+            'main.session': '/session/{session_id}',
+            'main.static': '/static/{filename}',
+        }
+        path = paths[endpoint]
+        query = {k: v for k, v in values.items() if '{%s}' % k not in path}
+        url = self.prefix + path.format(**values)
+        return url + '?' + urlencode(query) if query else url
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+        status, content_type, content, headers = await self._dispatch(
+            scope, body)
+        headers = [(b'content-type', content_type.encode('latin-1'))] + [
+            (k.encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+        await send({'type': 'http.response.start',
+                    'status': status,
+                    'headers': headers})
+        await send({'type': 'http.response.body', 'body': content})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self._executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _dispatch(self, scope, body):
+        path = scope['path']
+        if not path.startswith(self.prefix):
+            return self._text('Not found.', 404)
+        path = path[len(self.prefix):] or '/'
+        for method, pattern, handler in self._routes:
+            match = re.fullmatch(pattern, path)
+            if match and scope['method'] == method:
+                headers = {k.decode('latin-1').lower(): v.decode('latin-1')
+                           for k, v in scope['headers']}
+                query = dict(parse_qsl(scope.get('query_string', b'')
+                                       .decode('latin-1')))
+                request = {'headers': headers, 'query': query, 'body': body}
+                start_time = time.perf_counter()
+                result = await handler(request, *match.groups())
+                endpoint = f'main.{handler.__name__}'
+                metrics.REQUEST_SECONDS.observe(
+                    time.perf_counter() - start_time, endpoint=endpoint)
+                metrics.REQUESTS.inc(endpoint=endpoint, status=result[0])
+                return result
+        return self._text('Not found.', 404)
+
+    @classmethod
+    def _text(cls, text, status=200, content_type='text/html; charset=utf-8',
+              headers=()):
+        return status, content_type, text.encode('utf-8'), list(headers)
+
+    @classmethod
+    def _body(cls, content, status=200,
+              content_type='text/html; charset=utf-8'):
+        return status, content_type, content, []
+
+    def _call(self, function, *args):
+        """
+        Run a blocking call, such as one into the session store, in the
+        thread pool, so that a slow store cannot stall the event loop
+        :param function: (function) the function to call
+        :return: (Future) of its result
+        """
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self._executor, function, *args)
+
+    def _get_lock(self, session_id):
+        """
+        Get the lock of a session, without looking the session up
+        :param session_id: (string) the session id from the URL
+        :return: (tuple) of the int session id and its asyncio.Lock, or
+        (None, None) if the id is not a number
+        """
+        try:
+            sid = int(session_id)
+        except ValueError:
+            return None, None
+        lock = self._locks.get(sid)
+        if lock is None:
+            lock = self._locks[sid] = asyncio.Lock()
+        return sid, lock
+
+    async def home(self, request):
+        return self._text(self._templates.get_template('home.html').render())
+
+    async def start_new_game(self, request):
+        query = request['query']
+        try:
+            game = SessionData.from_options(query.get('size'), query.get('win'),
+                                            query.get('engine'))
+        except ValueError as e:
+            return self._text(str(e), 400)
+        sid, _ = await self._call(self.sessions.create, game)
+        location = self.url_for('main.session', session_id=sid)
+        return self._text('', 302, headers=[('location', location)])
+
+    async def session(self, request, session_id):
+        sid, _ = self._get_lock(session_id)
+        game = None if sid is None else await self._call(self.sessions.get,
+                                                         sid)
+        if game is None:
+            return self._text('Not found.', 404)
+        template = self._templates.get_template('game.html')
+        board_marks = EMPTY_BOARD if game.size == 3 else [0] * game.size ** 2
+        return self._text(template.render(board_marks=board_marks,
+                                          board_size=game.size,
+                                          win_length=game.win_length,
+                                          engine=game.engine,
+                                          session_id=session_id))
+
+    async def session_data(self, request, session_id):
+        sid, lock = self._get_lock(session_id)
+        if sid is None:
+            return self._text('Not found.', 404)
+        async with lock:
+            session = await self._call(self.sessions.get, sid)
+            if session is None:
+                return self._text('Not found.', 404)
+            return self._body(self.responses.session_data(session))
+
+    async def session_data_submit(self, request, session_id):
+        sid, lock = self._get_lock(session_id)
+        if sid is None:
+            return self._text('Not found.', 404)
+        try:
+            with metrics.timing(metrics.STAGE_SECONDS, stage='parse'):
+                form = parse_form(
+                    request['headers'].get('content-type', ''),
+                    request['body'])
+        except ValueError:
+            return self._text('Invalid form.', 400)
+        async with lock:
+            session = await self._call(self.sessions.get, sid)
+            if session is None:
+                return self._text('Not found.', 404)
+            error = await self._call(submit_form, self.move_table, session,
+                                     form)
+            if error is not None:
+                return self._text(error, 400)
+            try:
+                await self._call(self.sessions.save, sid, session)
+            except SessionConflictError as e:
+                return self._text(str(e), 409)
+            return self._body(self.responses.session_data(session))
+
+    async def moves(self, request):
+        try:
+            with metrics.timing(metrics.STAGE_SECONDS, stage='parse'):
+                data = json.loads(request['body'])
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            return self._text('Expected a JSON object.', 400)
+        # Hold the lock of every session in the batch, taken in id order
+        # so that two batches cannot wait on each other
+        locks = {}
+        moves = data.get('moves')
+        for move in moves if isinstance(moves, list) else ():
+            if isinstance(move, dict):
+                sid, lock = self._get_lock(str(move.get('session')))
+                if sid is not None:
+                    locks[sid] = lock
+        locks = [locks[sid] for sid in sorted(locks)]
+        for lock in locks:
+            await lock.acquire()
+        try:
+            replies = await self._call(submit_batch, self.move_table,
+                                       self.sessions, data)
+        except ValueError as e:
+            return self._text(str(e), 400)
+        finally:
+            for lock in locks:
+                lock.release()
+        return self._text(json.dumps(replies),
+                          content_type='application/json')
+
+    async def move(self, request, board, mark):
+        try:
+            key = responses.parse_board(board)
+            mark = responses.parse_mark(mark)
+        except ValueError as e:
+            return self._text(str(e), 400)
+        # Boards without a reply are never cached, whatever they match
+        if (key, mark) not in self.move_table:
+            return self._text('No reply for this board.', 404)
+        tag = responses.etag(self.move_table, key, mark)
+        headers = [('etag', tag), ('cache-control', responses.CACHE_CONTROL)]
+        if responses.etag_matches(request['headers'].get('if-none-match'),
+                                  tag):
+            return 304, 'application/json', b'', headers
+        reply = responses.move_reply(self.move_table, key, mark)
+        return self._text(json.dumps(reply), content_type='application/json',
+                          headers=headers)
+
+    async def metrics_text(self, request):
+        # Rendering counts the sessions in the store
+        return self._text(await self._call(metrics.REGISTRY.render),
+                          content_type=metrics.CONTENT_TYPE)
+
+    async def static(self, request, filename):
+        file_path = os.path.normpath(os.path.join(STATIC_FOLDER, filename))
+        if not file_path.startswith(STATIC_FOLDER + os.sep) or \
+                not os.path.isfile(file_path):
+            return self._text('Not found.', 404)
+        with open(file_path, 'rb') as fp:
+            content = fp.read()
+        content_type = mimetypes.guess_type(file_path)[0]
+        return 200, content_type or 'application/octet-stream', content, []
+
+
+app = GameServer(MOVE_TABLE, APPLICATION_ROOT, sessions=make_session_store(
+    os.environ.get('TTTAI_SESSION_STORE'),
+    max_size=int(os.environ.get('TTTAI_SESSION_MAX_SIZE', 10000)),
+    ttl=float(os.environ.get('TTTAI_SESSION_TTL', 3600))))
+metrics.register_sessions(app.sessions)
+
+
+def main():
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit('asyncgame needs an ASGI server, e.g. '
+                         '"pip install uvicorn"')
+    uvicorn.run(app, port=5000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,8 @@
+"""
+TTTAI benchmarks
+
+Latency and throughput benchmarks for the game engine, the AI and the
+web game. Run them from the repository root with
+
+    python -m benchmarks --output bench.json
+"""
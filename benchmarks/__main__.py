@@ -0,0 +1,232 @@
+"""
+Benchmark runner
+
+Runs the TTTAI benchmarks and writes the results as JSON
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import cycle
+import numpy as np
+from tictactoe import Mark, State
+from tictactoe.ai import branch1, calculate_next_state_for, \
+    calculate_next_state_from_table, cache_dependency_graphs, \
+    mcts_next_state_for, rescore_cache
+from tictactoe.board import Board
+from tictactoe.cache import SharedStateCache, StateCache, \
+    generate_cache_file
+from tictactoe.mcts import line_cells, rollouts
+from tictactoe.movetable import MoveTable
+from tictactoe.parallel import solve_parallel
+from tictactoe.solver import solve
+from tictactoe.traversal import canonical_dedup, is_terminal, traverse
+from .harness import Benchmark
+import tttai
+
+
+def _cycle_setup(items):
+    """
+    Make a setup function which hands out the given items in turn
+    :param items: (list) of argument tuples
+    :return: (function)
+    """
+    items = cycle(items)
+    return lambda: next(items)
+
+
+def engine_benchmarks(cache, table, directory, executor, workers):
+    """
+    Benchmarks of the game engine and the AI
+    :param cache: (StateCache) the loaded cache
+    :param table: (MoveTable) the loaded move table
+    :param directory: (string) a directory for temporary files
+    :param executor: (ProcessPoolExecutor) the pool of the parallel solver
+    :param workers: (int) the number of processes in the pool
+    :return: (list) of Benchmark objects
+    """
+    rng = random.Random(0)
+    states = list(cache)
+    isomorphs = [iso for s in states for iso in StateCache._get_isomorphs(s)]
+    rng.shuffle(isomorphs)
+    moves = [(iso, mark) for iso in isomorphs
+             if iso.winner is None for mark in iso.next_marks()]
+
+    def fresh_state(state):
+        state.reset_winner()
+        return state,
+
+    winner_states = cycle(states)
+    cache_file = os.path.join(directory, 'state-cache.json')
+    # recalculate_desirability clears and rewrites every score, so it runs
+    # on a copy of the cache rather than the one the others read
+    scratch_file = os.path.join(directory, 'scratch-cache.json')
+    cache.write(scratch_file)
+    scratch = StateCache()
+    scratch.load(scratch_file)
+    shared = SharedStateCache.create(
+        os.path.join(directory, 'state-cache.shared'), 'state-cache.bin')
+    graphs = cache_dependency_graphs(cache)
+    lines = line_cells(State().layout)
+    boards = np.zeros((1024, 9), dtype=np.int8)
+    rollout_rng = np.random.default_rng(0)
+    return [
+        Benchmark('State.winner', lambda s: s.winner,
+                  lambda: fresh_state(next(winner_states))),
+        Benchmark('StateCache.__getitem__', cache.__getitem__,
+                  _cycle_setup([(s,) for s in isomorphs])),
+        Benchmark('SharedStateCache.__getitem__', shared.__getitem__,
+                  _cycle_setup([(s,) for s in isomorphs])),
+        Benchmark('branch1', lambda s, m: list(branch1(s, m)),
+                  _cycle_setup(moves)),
+        Benchmark('Board.children', lambda b, m: list(b.children(m)),
+                  _cycle_setup([(Board.from_state(s), m) for s, m in moves])),
+        Benchmark('traverse (unique)',
+                  lambda: sum(1 for _ in traverse(
+                      [State()], Mark.OMARK, prune=is_terminal,
+                      dedup=canonical_dedup()))),
+        Benchmark('calculate_next_state_for',
+                  lambda s, m: calculate_next_state_for(cache, s, m),
+                  _cycle_setup(moves)),
+        Benchmark('calculate_next_state_from_table',
+                  lambda s, m: calculate_next_state_from_table(table, s, m),
+                  _cycle_setup(moves)),
+        Benchmark('rollouts (1024 games)',
+                  lambda: rollouts(lines, boards, np.full(1024, Mark.OMARK),
+                                   rollout_rng)),
+        Benchmark('mcts_next_state_for (100 iterations)',
+                  lambda s, m: mcts_next_state_for(s, m, iterations=100),
+                  _cycle_setup(moves[:100])),
+        Benchmark('recalculate_desirability',
+                  lambda: tttai.recalculate_desirability(scratch)),
+        Benchmark('cache_dependency_graphs',
+                  lambda: cache_dependency_graphs(cache)),
+        Benchmark('rescore_cache (unchanged)',
+                  lambda: rescore_cache(cache, graphs)),
+        Benchmark('solve', lambda: solve(State(), Mark.OMARK)),
+        Benchmark(f'solve_parallel ({workers} workers)',
+                  lambda: solve_parallel(State(), Mark.OMARK,
+                                         executor=executor)),
+        Benchmark('generate_cache_file',
+                  lambda: generate_cache_file(cache_file)),
+        Benchmark('StateCache.load (json)',
+                  lambda: StateCache().load('state-cache.json')),
+        Benchmark('StateCache.load (binary)',
+                  lambda: StateCache().load('state-cache.bin')),
+        Benchmark('MoveTable.load (json)',
+                  lambda: MoveTable().load('move-table.json')),
+        Benchmark('MoveTable.load_snapshot',
+                  lambda: MoveTable().load_snapshot('move-table.bin')),
+    ]
+
+
+def web_benchmarks():
+    """
+    Benchmarks of the web game, through the Flask test client
+    :return: (list) of Benchmark objects
+    """
+    import webgame
+    app = webgame.create_app()
+    client = app.test_client()
+    sessions = app.extensions['tttai']['sessions']
+    cells = cycle(range(9))
+
+    def new_game():
+        sid, _ = sessions.create()
+        cell = next(cells)
+        args = json.dumps({'mark': Mark.OMARK, 'row': cell // 3,
+                           'column': cell % 3})
+        return f'/session-data/{sid}', {'verb': 'set-mark', 'args': args}
+
+    def new_batch():
+        games = [{'board': s.to_code1(), 'mark': Mark.OMARK}
+                 for s in (State.from_key(k) for k in range(3 ** 9))
+                 if Mark.OMARK in s.next_marks() and s.winner is None][:100]
+        return {'games': games},
+
+    return [
+        Benchmark('POST /session-data',
+                  lambda url, data: client.post(url, data=data), new_game),
+        Benchmark('GET /session-data',
+                  lambda url: client.get(url),
+                  lambda: (f'/session-data/{sessions.create()[0]}',)),
+        Benchmark('POST /moves (100 games)',
+                  lambda data: client.post('/moves', json=data),
+                  _cycle_setup([new_batch()])),
+        Benchmark('cold start (webgame)',
+                  lambda: subprocess.run(
+                      [sys.executable, '-c',
+                       'import webgame; webgame.create_app()'], check=True)),
+    ]
+
+
+def compare(results, baseline):
+    """
+    Print the change of each benchmark's p50 latency from a baseline
+    :param results: (list) of result dicts
+    :param baseline: (dict) of earlier benchmark output
+    """
+    before = {r['name']: r for r in baseline['results']}
+    for result in results:
+        if before.get(result['name'], {}).get('p50_ms'):
+            ratio = result['p50_ms'] / before[result['name']]['p50_ms']
+            print(f"{result['name']:36} p50 x{ratio:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='TTTAI benchmarks')
+    parser.add_argument('--output', help='write the JSON results to a file')
+    parser.add_argument('--filter', default='',
+                        help='only run benchmarks whose name contains this')
+    parser.add_argument('--min-seconds', type=float, default=0.5,
+                        help='minimum time to spend on each benchmark')
+    parser.add_argument('--compare', help='JSON results to compare against')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='processes for the parallel solver benchmark')
+    args = parser.parse_args()
+
+    cache = StateCache()
+    cache.load('state-cache.json')
+    table = MoveTable.from_files('move-table.json', 'move-table.bin')
+    results = []
+    with tempfile.TemporaryDirectory() as directory, \
+            ProcessPoolExecutor(args.workers) as executor:
+        benchmarks = engine_benchmarks(cache, table, directory, executor,
+                                       args.workers)
+        for benchmark in benchmarks + web_benchmarks():
+            if args.filter not in benchmark.name:
+                continue
+            benchmark.min_seconds = args.min_seconds
+            result = benchmark.run()
+            results.append(result)
+            ops = result['ops_per_sec']
+            ops = '-' if ops is None else f'{ops:.1f}'
+            print(f"{result['name']:36} {ops:>12} ops/s "
+                  f"p50 {result['p50_ms']:9.4f} ms  "
+                  f"p99 {result['p99_ms']:9.4f} ms")
+
+    output = {
+        'timestamp': time.time(),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(output, fp, indent=2)
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(results, json.load(fp))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Benchmark harness
+
+Times a function call by call and summarizes the latencies
+"""
+
+import time
+
+
+class Benchmark:
+    """
+    A named operation to time. setup is called before every run, outside
+    of the timing, and its result is passed to the operation.
+    """
+    def __init__(self, name, operation, setup=None, min_runs=5,
+                 min_seconds=0.5, max_runs=100000):
+        self.name = name
+        self.operation = operation
+        self.setup = setup
+        self.min_runs = min_runs
+        self.min_seconds = min_seconds
+        self.max_runs = max_runs
+
+    def run(self):
+        """
+        Time the operation until both min_runs and min_seconds are met
+        :return: (dict) of the latency summary
+        """
+        latencies = []
+        total = 0
+        while len(latencies) < self.max_runs and (
+                len(latencies) < self.min_runs or total < self.min_seconds):
+            args = self.setup() if self.setup is not None else ()
+            start_time = time.perf_counter()
+            self.operation(*args)
+            elapsed = time.perf_counter() - start_time
+            latencies.append(elapsed)
+            total += elapsed
+        return summarize(self.name, latencies)
+
+
+def percentile(ordered, fraction):
+    """
+    Get a percentile of sorted values, by the nearest-rank method
+    :param ordered: (list) of sorted values
+    :param fraction: (float) the percentile, between 0 and 1
+    :return: the value
+    """
+    rank = max(0, min(len(ordered) - 1, round(fraction * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def summarize(name, latencies):
+    """
+    Summarize the latencies of the runs of a benchmark
+    :param name: (string) the benchmark name
+    :param latencies: (list) of run times in seconds
+    :return: (dict) with ops_per_sec None if the runs took no measurable
+    time, since JSON has no infinity
+    """
+    ordered = sorted(latencies)
+    total = sum(ordered)
+    return {
+        'name': name,
+        'runs': len(ordered),
+        'ops_per_sec': len(ordered) / total if total else None,
+        'mean_ms': 1000 * total / len(ordered),
+        'p50_ms': 1000 * percentile(ordered, 0.50),
+        'p99_ms': 1000 * percentile(ordered, 0.99),
+    }
@@ -0,0 +1,16 @@
+"""
+Gunicorn configuration for the web game
+
+The master process brings the move table snapshot up to date once,
+before any worker starts, and every worker maps that one file read-only.
+Run it with
+
+    gunicorn --workers 4 'webgame:create_app()'
+"""
+
+from tictactoe.movetable import MoveTable
+
+
+def on_starting(server):
+    # Workers are forked after this, and find the snapshot current
+    MoveTable.from_files('move-table.json', 'move-table.bin')
@@ -11,7 +11,7 @@ class BoardView
         this.element = element;
         this.mark = mark;
         this.winner = null;
-        this.numberOfColumns = 3;
+        this.numberOfColumns = Number(element.dataset.size || 3);
         for(let i = 0; i < element.children.length; i++) {
             let cell = this.element.children[i];
             cell.addEventListener('click', (e) => this.handleCellClicked(i, e));
@@ -1 +1,14 @@
-from .tictactoe import Mark, State
+# Mark, State and BitState are imported on first use, so that modules
+# which need no NumPy, such as bitboard and metrics, load quickly
+_LAZY = ('Mark', 'State', 'BitState')
+
+
+def __getattr__(name):
+    if name in _LAZY:
+        from . import tictactoe
+        return getattr(tictactoe, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY))
@@ -6,7 +6,13 @@ Implementation of the AI
 
 import numpy as np
 from tictactoe import Mark, State
-from .util import apply_xforms
+from . import bitboard, symmetry
+from .board import Board
+from .metrics import AI_SECONDS, timed
+
+# The solvers, traversal and search engines are imported by the functions
+# which use them, so that the web game servers, which play from a move
+# table, start without loading them
 
 
 def branch1(state, mark):
@@ -29,72 +35,159 @@ def branch1(state, mark):
 
     # The tuple is the spice
     possibilities = [option(array, tuple(idx), mark) for idx in blank_coords]
-    yield from (State(p) for p in possibilities)
+    yield from (State(p, win_length=state.win_length) for p in possibilities)
 
 
 def branch(states, mark, depth=1):
     """
     Yield results for making the next move on a given game state to a
-    given depth.
+    given depth, depth first. Moves are applied to a single bit board,
+    and a State is built for each result as it is yielded.
     :param states: (iterable) of States to branch from
     :param mark: (Mark) the player's mark at the supplied depth
     :param depth: (int) the ply by which to branch
     :return: (generator) of State objects as the result of all possible
     subsequent moves to the degree of the supplied depth
     """
+    from .traversal import is_terminal, traverse
+    states = list(states)
     yield from states
-    if depth <= 0:
+    if depth <= 0 or not states:
         return
-    for state in states:
-        if state.winner is None:
-            down = branch1(state, mark)
-            next_mark = Mark.get_next(mark)
-            yield from branch(list(down), next_mark, depth - 1)
+    for position in traverse(states, mark, depth, prune=is_terminal):
+        if position.ply:
+            yield position.to_state()
 
 
-def cache_state_desirability(cache, root_state, mark):
+def branch_unique(states, mark, depth=1):
+    """
+    Yield results for making the next move on a given game state to a
+    given depth, one ply at a time, keeping only the first isomorph of
+    each state. Each canonical state is therefore yielded and expanded
+    exactly once.
+    :param states: (iterable) of States to branch from
+    :param mark: (Mark) the player's mark at the supplied depth
+    :param depth: (int) the ply by which to branch
+    :return: (generator) of State objects
+    """
+    from .traversal import canonical_dedup, is_terminal, traverse
+    states = list(states)
+    for position in traverse(states, mark, depth, 'bfs', prune=is_terminal,
+                             dedup=canonical_dedup()):
+        yield position.to_state()
+
+
+def cache_state_desirability(cache, root_state, mark, vectorized=False,
+                             workers=1):
     """
     Calculate the desirability of each State for each Mark in the cache
     :param cache: (StateCache) the cache
     :param root_state: (State) the initial state to branch from
     :param mark: (Mark) the initial Mark to calculate subsequent States
+    :param vectorized: (bool) whether to solve with the batch solver
+    :param workers: (int) the number of processes to solve with
+    :return: (Solution) the solved values and solver statistics
     """
-    # Calculate branch states for root state
-    branched = list(branch1(root_state, mark))
-    # Limit operations to cached polymorphs
-    branched_cached = set(cache[state][0] for state in branched)
-
-    # If the root state has a winner, calculate immediate desirability
+    if vectorized:
+        from . import batch
+        solution = batch.solve(root_state, mark)
+    elif workers > 1:
+        # Imported here, since process pools are slow to import
+        from .parallel import solve_parallel
+        solution = solve_parallel(root_state, mark, workers)
+    else:
+        from .solver import solve
+        solution = solve(root_state, mark)
+    solution.apply(cache)
+    root_state.desirability = solution.get_desirability(solution.root_key)
     if root_state.winner is not None:
-        root_state.desirability = State.calculate_desirability(root_state)
         cache.update_state(root_state)
-        return
+    return solution
+
+
+def _owners(graphs):
+    """
+    Get the graph whose score a cache holds for each state. As in
+    Solution.apply, later solutions replace earlier ones, and the root is
+    left out.
+    :param graphs: (list) of DependencyGraph objects, in the order their
+    solutions were applied to the cache
+    :return: (dict) of canonical keys to indices into graphs
+    """
+    owners = {}
+    for index, graph in enumerate(graphs):
+        root_key = graph.solution.root_key
+        owners.update((key, index) for key in graph.depth if key != root_key)
+    return owners
 
-    # If branched states have winners, calculate immediate desirability
-    for state in branched_cached:
-        if state.winner is not None:
-            state.desirability = State.calculate_desirability(state)
-            cache.update_state(state)
 
-    # Calculate the branched desirability of the root state
-    desirability = {Mark.OMARK: 0, Mark.XMARK: 0}
-    next_mark = Mark.get_next(mark)
-    for state in branched_cached:
-        # Dynamically calculate desirability if needed
-        if state.winner is None:
-            cache_state_desirability(cache, state, next_mark)
-            cache.update_state(state)
+def cache_dependency_graphs(cache, marks=(Mark.OMARK, Mark.XMARK)):
+    """
+    Get the game DAGs which solving from State() for each Mark in turn
+    applies to a cache, scored from the desirability the cache holds
+    rather than solved again. The cache keeps only the latest solution's
+    score of a state, so the states whose scores were replaced are scored
+    from their children.
+    :param cache: (StateCache) the cache
+    :param marks: (tuple) of the Mark moving first in each solution, in
+    the order they were applied
+    :return: (list) of DependencyGraph objects
+    """
+    from .solver import DependencyGraph
+    graphs = [DependencyGraph.expand(State(), mark) for mark in marks]
+    owners = _owners(graphs)
+    scores = cache.scores
+    for index, graph in enumerate(graphs):
+        # The score of a finished state is the same in every graph
+        keys = np.array([key for key in graph.depth
+                         if owners.get(key) == index
+                         or not graph.children.get(key)], dtype=np.int64)
+        keys = keys[scores.known['O'][keys]]
+        graph.seed(dict(zip(keys.tolist(),
+                            zip(scores.columns['O'][keys].tolist(),
+                                scores.columns['X'][keys].tolist()))))
+    return graphs
 
-        next_des_o = state.desirability[Mark.OMARK]
-        next_des_x = state.desirability[Mark.XMARK]
-        desirability[Mark.OMARK] += next_des_o
-        desirability[Mark.XMARK] += next_des_x
 
-    # Update root state desirability
+def rescore_cache(cache, graphs, evaluate=State.calculate_desirability):
+    """
+    Score the finished states of game DAGs again with a new scoring
+    function, and update the desirability of only the cached States which
+    change
+    :param cache: (StateCache) the cache
+    :param graphs: (list) of DependencyGraph objects scored as the cache
+    is, see cache_dependency_graphs, in the order their solutions were
+    applied to the cache
+    :param evaluate: (function) scoring finished States, as
+    State.calculate_desirability does
+    :return: (tuple) of the number of states touched, and the set of the
+    canonical keys of the cached States whose desirability changed
+    """
+    changed = [graph.rescore(evaluate) for graph in graphs]
+    touched = sum(graph.touched for graph in graphs)
+    owners = _owners(graphs)
+    keys = {key for key, owner in owners.items() if key in changed[owner]}
+    if keys:
+        scores = [graphs[owners[key]].solution.desirability[key]
+                  for key in keys]
+        o_des, x_des = zip(*scores)
+        cache.scores.update(list(keys), O=o_des, X=x_des)
+    return touched, keys
+
 
-    root_state.desirability = desirability
+def _check_classic(state):
+    """
+    Raise ValueError unless a State is a classic 3x3 board, the only
+    boards which caches and move tables hold
+    :param state: (State) the state
+    """
+    if state.size != bitboard.SIZE or state.win_length != bitboard.SIZE:
+        raise ValueError(f'Only 3x3 boards are cached, not {state.size}x'
+                         f'{state.size} boards with {state.win_length} '
+                         f'in a row')
 
 
+@timed(AI_SECONDS, function='calculate_next_state_for')
 def calculate_next_state_for(cache, root_state, mark):
     """
     Calculates the next state based on cached States with desirability
@@ -103,14 +196,119 @@ def calculate_next_state_for(cache, root_state, mark):
     :param mark: (Mark) the Mark to use in the subsequent State
     :return: (State) the optimal subsequent state for the given Mark
     """
-    branched = branch1(root_state, mark)
-    branched_cached = list(cache[state] for state in branched)
+    _check_classic(root_state)
+    children = Board.from_state(root_state).children(mark)
 
-    def utility(x):
-        state = x[0]
-        gain = state.desirability[mark]
-        loss = state.desirability[Mark.get_next(mark)]
+    def utility(child):
+        desirability = cache.lookup(child[1])[0].desirability
+        gain = desirability[mark]
+        loss = desirability[Mark.get_next(mark)]
         return max(gain, -loss)
 
-    best, xf, ixf = max(branched_cached, key=utility)
-    return State(apply_xforms(ixf, best[:].copy()))
+    return max(children, key=utility)[1].to_state()
+
+
+@timed(AI_SECONDS, function='calculate_next_state_from_table')
+def calculate_next_state_from_table(table, root_state, mark):
+    """
+    Calculates the next state with a precompiled move table. This gives
+    the same State as calculate_next_state_for with the cache the table
+    was compiled from.
+    :param table: (MoveTable) the move table
+    :param root_state: (State) the current state
+    :param mark: (Mark) the Mark to use in the subsequent State
+    :return: (State) the optimal subsequent state for the given Mark
+    """
+    _check_classic(root_state)
+    if root_state.is_full:
+        raise ValueError('No moves remain on a full board')
+    cell = table.reply(root_state.to_key(), mark)
+    state = State(root_state[:].copy(), win_length=root_state.win_length)
+    state.set_mark(cell // state.size, cell % state.size, mark)
+    return state
+
+
+@timed(AI_SECONDS, function='calculate_next_board_from_table')
+def calculate_next_board_from_table(table, root_board, mark):
+    """
+    Calculates the next board with a precompiled move table, as
+    calculate_next_state_from_table does, without building any board
+    :param table: (MoveTable) the move table
+    :param root_board: (Board) the current board
+    :param mark: (Mark) the Mark to use in the subsequent Board
+    :return: (Board) the optimal subsequent board for the given Mark
+    """
+    if root_board.is_full:
+        raise ValueError('No moves remain on a full board')
+    return root_board.play(table.reply(root_board.key, mark), mark)
+
+
+@timed(AI_SECONDS, function='calculate_next_keys_from_table')
+def calculate_next_keys_from_table(table, keys, marks):
+    """
+    Calculates the next states of many classic 3x3 boards at once with a
+    precompiled move table, so the cost of each lookup is shared by the
+    whole batch
+    :param table: (MoveTable) the move table
+    :param keys: (iterable) of board keys
+    :param marks: (iterable) of the Marks to move on each board
+    :return: (ndarray) of the keys of the subsequent boards, -1 where the
+    table has no reply, such as on full or won boards
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    marks = np.asarray(marks, dtype=np.int64)
+    cells = table.replies(keys, marks)
+    powers = 3 ** (bitboard.CELLS - 1 - cells.astype(np.int64))
+    next_keys = keys + marks * powers
+    return np.where(cells < 0, -1, next_keys)
+
+
+@timed(AI_SECONDS, function='search_next_state_for')
+def search_next_state_for(root_state, mark, time_budget=1.0, max_depth=None,
+                          engine=None):
+    """
+    Calculates the next state by searching the game tree, for boards of
+    any size which have no cache
+    :param root_state: (State) the current state
+    :param mark: (Mark) the Mark to use in the subsequent State
+    :param time_budget: (float) seconds to spend deepening the search
+    :param max_depth: (int) the deepest ply to search, or None
+    :param engine: (AlphaBetaSearch) an engine which keeps its
+    transposition table between moves, searching with its own budget and
+    depth, or None for a new one
+    :return: (State) the best subsequent state found for the given Mark
+    """
+    if engine is None:
+        from .search import AlphaBetaSearch
+        engine = AlphaBetaSearch(time_budget, max_depth)
+    cell = engine.search(root_state, mark)
+    if cell is None:
+        raise ValueError('No moves remain on a full board')
+    state = State(root_state[:].copy(), win_length=root_state.win_length)
+    state.set_mark(cell // state.size, cell % state.size, mark)
+    return state
+
+
+@timed(AI_SECONDS, function='mcts_next_state_for')
+def mcts_next_state_for(root_state, mark, time_budget=1.0, iterations=None,
+                        engine=None):
+    """
+    Calculates the next state by Monte Carlo tree search, for positions
+    and variants which have no cache
+    :param root_state: (State) the current state
+    :param mark: (Mark) the Mark to use in the subsequent State
+    :param time_budget: (float) seconds to spend searching
+    :param iterations: (int) the most leaves to play out from, or None
+    :param engine: (MonteCarloTreeSearch) an engine which keeps its trees
+    between moves, searching with its own budget, or None for a new one
+    :return: (State) the best subsequent state found for the given Mark
+    """
+    if engine is None:
+        from .mcts import MonteCarloTreeSearch
+        engine = MonteCarloTreeSearch(time_budget, iterations)
+    cell = engine.search(root_state, mark)
+    if cell is None:
+        raise ValueError('No moves remain on a finished board')
+    state = State(root_state[:].copy(), win_length=root_state.win_length)
+    state.set_mark(cell // state.size, cell % state.size, mark)
+    return state
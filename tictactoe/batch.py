@@ -0,0 +1,176 @@
+"""
+Tic-Tac-Toe batch module
+
+Vectorized evaluation of many boards at once. A batch of N boards is an
+(N, 9) int8 array of marks with cells in row-major order.
+"""
+
+import time
+import numpy as np
+from tictactoe import Mark
+from . import bitboard, symmetry
+from .solver import Solution
+
+POWERS = 3 ** np.arange(bitboard.CELLS - 1, -1, -1)
+PERMUTATIONS = np.array(symmetry.PERMUTATIONS)
+
+# Incidence matrix of cells (rows) and winning lines (columns)
+LINE_MATRIX = np.array([[mask >> cell & 1 for mask in bitboard.WIN_MASKS]
+                        for cell in range(bitboard.CELLS)], dtype=np.int8)
+
+
+class BoardBatch:
+    """
+    A batch of boards held in one (N, 9) int8 array
+    """
+    def __init__(self, boards):
+        boards = np.asarray(boards, dtype=np.int8)
+        self.boards = boards.reshape(-1, bitboard.CELLS)
+
+    @classmethod
+    def from_keys(cls, keys):
+        """
+        Return a BoardBatch given base-3 board keys
+        :param keys: (array_like) of int board keys
+        :return: (BoardBatch)
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        return cls(keys[:, np.newaxis] // POWERS % 3)
+
+    @classmethod
+    def from_states(cls, states):
+        """
+        Return a BoardBatch given State objects
+        :param states: (iterable) of State objects
+        :return: (BoardBatch)
+        """
+        return cls.from_keys([state.to_key() for state in states])
+
+    def keys(self):
+        """
+        Get the base-3 key of each board
+        :return: (ndarray) of shape (N,)
+        """
+        return self.boards @ POWERS
+
+    def winners(self):
+        """
+        Get the winning mark of each board, matching every board against
+        every winning line in one matrix product per mark
+        :return: (ndarray) of shape (N,), 0 where there is no winner
+        """
+        lines = LINE_MATRIX.sum(axis=0)
+        o_wins = ((self.boards == Mark.OMARK) @ LINE_MATRIX == lines).any(1)
+        x_wins = ((self.boards == Mark.XMARK) @ LINE_MATRIX == lines).any(1)
+        winners = np.where(x_wins, Mark.XMARK, Mark.EMPTY)
+        return np.where(o_wins, Mark.OMARK, winners).astype(np.int8)
+
+    def is_full(self):
+        """
+        Get whether each board is full
+        :return: (ndarray) of bool, shape (N,)
+        """
+        return (self.boards != Mark.EMPTY).all(axis=1)
+
+    def expand(self, marks):
+        """
+        Make every legal move on every board
+        :param marks: (array_like) the mark to place on each board, or a
+        single Mark for the whole batch
+        :return: (tuple) of the BoardBatch of children, and the index of
+        the parent board and the cell played for each child
+        """
+        marks = np.broadcast_to(np.asarray(marks, dtype=np.int8),
+                                (len(self),))
+        parents, cells = np.nonzero(self.boards == Mark.EMPTY)
+        children = self.boards[parents]
+        children[np.arange(len(parents)), cells] = marks[parents]
+        return BoardBatch(children), parents, cells
+
+    def isomorphs(self):
+        """
+        Get all eight geometrical isomorphs of every board
+        :return: (ndarray) of shape (N, 8, 9), ordered as ISO_XFORMS
+        """
+        return self.boards[:, PERMUTATIONS]
+
+    def canonicalize(self):
+        """
+        Get the canonical key of each board and the symmetry mapping each
+        board onto it
+        :return: (tuple) of ndarrays of shape (N,)
+        """
+        iso_keys = self.isomorphs() @ POWERS
+        syms = iso_keys.argmin(axis=1)
+        return iso_keys[np.arange(len(self)), syms], syms
+
+    def __len__(self):
+        return len(self.boards)
+
+
+def reachable_levels(root_state, mark):
+    """
+    Get the canonical states reachable from a root state, one ply at a
+    time. Each ply is expanded and deduplicated in a single pass.
+    :param root_state: (State) the initial state to branch from
+    :param mark: (Mark) the Mark to move in the root state
+    :return: (list) of tuples of the sorted canonical keys of a ply, and
+    the unique (parent, child) index pairs linking it to the next ply
+    """
+    keys = np.array([symmetry.CANONICAL[root_state.to_key()]])
+    levels = []
+    while len(keys):
+        batch = BoardBatch.from_keys(keys)
+        open_boards = np.flatnonzero(batch.winners() == Mark.EMPTY)
+        children, parents, _ = BoardBatch(batch.boards[open_boards]).expand(mark)
+        child_keys, _ = children.canonicalize()
+        next_keys, child_index = np.unique(child_keys, return_inverse=True)
+        edges = np.unique(np.stack([open_boards[parents], child_index], 1),
+                          axis=0).reshape(-1, 2)
+        levels.append((keys, edges))
+        keys = next_keys
+        mark = Mark.get_next(mark)
+    return levels
+
+
+def solve(root_state, mark):
+    """
+    Vectorized equivalent of tictactoe.solver.solve, scoring each ply of
+    the game DAG in a few whole-array operations
+    :param root_state: (State) the initial state to branch from
+    :param mark: (Mark) the Mark to move in the root state
+    :return: (Solution)
+    """
+    start_time = time.perf_counter()
+    levels = reachable_levels(root_state, mark)
+    solution = Solution(int(levels[0][0][0]), mark)
+    child_des = child_values = None
+    for depth in reversed(range(len(levels))):
+        keys, edges = levels[depth]
+        to_move = mark if depth % 2 == 0 else Mark.get_next(mark)
+        batch = BoardBatch.from_keys(keys)
+        winners = batch.winners()
+
+        # Terminal scores: wins and losses, and zero for draws
+        o_des = np.where(winners == Mark.OMARK, 1,
+                         np.where(winners == Mark.XMARK, -1, 0))
+        x_des = -o_des
+        values = np.where(winners == to_move, 1,
+                          np.where(winners != Mark.EMPTY, -1, 0))
+
+        # Sum the desirability and maximize the value over the children
+        if len(edges):
+            parents, children = edges[:, 0], edges[:, 1]
+            np.add.at(o_des, parents, child_des[0][children])
+            np.add.at(x_des, parents, child_des[1][children])
+            best = np.full(len(keys), -2)
+            np.maximum.at(best, parents, -child_values[children])
+            values = np.where(best > -2, best, values)
+
+        child_des, child_values = (o_des, x_des), values
+        solution.desirability.update(
+            zip(keys.tolist(), zip(o_des.tolist(), x_des.tolist())))
+        solution.values.update(zip(keys.tolist(), values.tolist()))
+    solution.nodes = len(solution.desirability)
+    solution.seconds = time.perf_counter() - start_time
+    return solution
@@ -0,0 +1,285 @@
+"""
+Bitboard Module
+
+Compact integer representation of Tic-Tac-Toe boards. A board is held
+as a pair of integers (one per player) where bit i is set when that
+player's mark occupies cell i, counting cells in row-major order. The
+module functions work on the classic 3x3 board through lookup tables;
+Layout provides the same operations for any board size and win length.
+"""
+
+from functools import lru_cache
+
+SIZE = 3
+CELLS = SIZE * SIZE
+FULL_MASK = (1 << CELLS) - 1
+
+EMPTY = 0
+OMARK = 1
+XMARK = 2
+
+
+def line_masks(size, win_length=None):
+    """
+    Build the bit masks of every winning line on a square board
+    :param size: (int) the number of rows (and columns) of the board
+    :param win_length: (int) the number of marks in a row needed to win,
+    by default the board size
+    :return: (tuple) of int bit masks
+    """
+    win_length = win_length or size
+    lines = []
+    for row in range(size):
+        for col in range(size):
+            for d_row, d_col in ((0, 1), (1, 0), (1, 1), (1, -1)):
+                end_row = row + d_row * (win_length - 1)
+                end_col = col + d_col * (win_length - 1)
+                if end_row >= size or not 0 <= end_col < size:
+                    continue
+                lines.append(sum(1 << ((row + d_row * i) * size +
+                                       col + d_col * i)
+                                 for i in range(win_length)))
+    return tuple(lines)
+
+
+WIN_MASKS = line_masks(SIZE)
+
+# Lookup tables indexed by a player's bit set
+_WINNING = tuple(any(bits & m == m for m in WIN_MASKS)
+                 for bits in range(1 << CELLS))
+_POPCOUNT = tuple(bin(bits).count('1') for bits in range(1 << CELLS))
+_CELLS = tuple(tuple(i for i in range(CELLS) if bits >> i & 1)
+               for bits in range(1 << CELLS))
+_KEY = tuple(sum(3 ** (CELLS - 1 - i) for i in cells) for cells in _CELLS)
+
+
+def from_cells(cells):
+    """
+    Convert a flat, row-major sequence of cell marks to a bit board
+    :param cells: (iterable) of int marks
+    :return: (tuple) of the O bit set and the X bit set
+    """
+    o = x = 0
+    for i, mark in enumerate(cells):
+        if mark == OMARK:
+            o |= 1 << i
+        elif mark == XMARK:
+            x |= 1 << i
+    return o, x
+
+
+def to_cells(o, x):
+    """
+    Convert a bit board to a flat, row-major list of cell marks
+    :param o: (int) the O bit set
+    :param x: (int) the X bit set
+    :return: (list) of int marks
+    """
+    return [OMARK if o >> i & 1 else XMARK if x >> i & 1 else EMPTY
+            for i in range(CELLS)]
+
+
+def to_key(o, x):
+    """
+    Convert a bit board to its base-3 key. Cell 0 is the most significant
+    digit, so keys sort in the same order as State.to_code1 strings.
+    :param o: (int) the O bit set
+    :param x: (int) the X bit set
+    :return: (int) the key, in range(3 ** CELLS)
+    """
+    return _KEY[o] + 2 * _KEY[x]
+
+
+def from_key(key):
+    """
+    Convert a base-3 key to a bit board
+    :param key: (int) the key
+    :return: (tuple) of the O bit set and the X bit set
+    """
+    o = x = 0
+    for i in reversed(range(CELLS)):
+        key, mark = divmod(key, 3)
+        if mark == OMARK:
+            o |= 1 << i
+        elif mark == XMARK:
+            x |= 1 << i
+    return o, x
+
+
+def winner(o, x):
+    """
+    Get the winning mark of a bit board
+    :param o: (int) the O bit set
+    :param x: (int) the X bit set
+    :return: (int) the winning mark, or EMPTY if there is no winner
+    """
+    if _WINNING[o]:
+        return OMARK
+    if _WINNING[x]:
+        return XMARK
+    return EMPTY
+
+
+def is_full(o, x):
+    """
+    Whether every cell of a bit board holds a mark
+    :param o: (int) the O bit set
+    :param x: (int) the X bit set
+    :return: (bool)
+    """
+    return o | x == FULL_MASK
+
+
+def next_marks(o, x):
+    """
+    Get the marks that could legally be placed next on a bit board
+    :param o: (int) the O bit set
+    :param x: (int) the X bit set
+    :return: (tuple) of int marks
+    """
+    if o | x == FULL_MASK:
+        return ()
+    os, xes = _POPCOUNT[o], _POPCOUNT[x]
+    if os == xes:
+        return OMARK, XMARK
+    return (OMARK,) if xes > os else (XMARK,)
+
+
+def moves(o, x):
+    """
+    Get the empty cells of a bit board
+    :param o: (int) the O bit set
+    :param x: (int) the X bit set
+    :return: (tuple) of row-major cell indices
+    """
+    return _CELLS[FULL_MASK & ~(o | x)]
+
+
+def place(o, x, cell, mark):
+    """
+    Get the bit board that results from placing a mark on a cell
+    :param o: (int) the O bit set
+    :param x: (int) the X bit set
+    :param cell: (int) the row-major cell index
+    :param mark: (int) the mark to place, or EMPTY to clear the cell
+    :return: (tuple) of the O bit set and the X bit set
+    """
+    bit = 1 << cell
+    o &= ~bit
+    x &= ~bit
+    if mark == OMARK:
+        o |= bit
+    elif mark == XMARK:
+        x |= bit
+    return o, x
+
+
+class Layout:
+    """
+    Bit board operations for a square board of any size, on which a
+    player wins with win_length marks in a row, column or diagonal
+    """
+    def __init__(self, size=SIZE, win_length=None):
+        self.size = size
+        self.win_length = win_length or size
+        self.cells = size * size
+        self.full_mask = (1 << self.cells) - 1
+        self.win_masks = line_masks(size, self.win_length)
+        # The winning lines through each cell
+        self.cell_masks = tuple(
+            tuple(m for m in self.win_masks if m >> cell & 1)
+            for cell in range(self.cells))
+        self._classic = (size, self.win_length) == (SIZE, SIZE)
+
+    def from_cells(self, cells):
+        return from_cells(cells)
+
+    def to_cells(self, o, x):
+        return [OMARK if o >> i & 1 else XMARK if x >> i & 1 else EMPTY
+                for i in range(self.cells)]
+
+    def to_key(self, o, x):
+        """
+        Convert a bit board to its base-3 key, cell 0 most significant
+        :param o: (int) the O bit set
+        :param x: (int) the X bit set
+        :return: (int) the key
+        """
+        if self._classic:
+            return to_key(o, x)
+        key = 0
+        for mark in self.to_cells(o, x):
+            key = key * 3 + mark
+        return key
+
+    def from_key(self, key):
+        if self._classic:
+            return from_key(key)
+        o = x = 0
+        for i in reversed(range(self.cells)):
+            key, mark = divmod(key, 3)
+            if mark == OMARK:
+                o |= 1 << i
+            elif mark == XMARK:
+                x |= 1 << i
+        return o, x
+
+    def is_winning(self, bits):
+        """
+        Whether a player's bit set covers a winning line
+        :param bits: (int) the player's bit set
+        :return: (bool)
+        """
+        if self._classic:
+            return _WINNING[bits]
+        return any(bits & m == m for m in self.win_masks)
+
+    def wins_at(self, bits, cell):
+        """
+        Whether a player's bit set covers a winning line through a cell,
+        which is all that needs checking after a move on that cell
+        :param bits: (int) the player's bit set
+        :param cell: (int) the row-major cell index
+        :return: (bool)
+        """
+        return any(bits & m == m for m in self.cell_masks[cell])
+
+    def winner(self, o, x):
+        if self.is_winning(o):
+            return OMARK
+        if self.is_winning(x):
+            return XMARK
+        return EMPTY
+
+    def is_full(self, o, x):
+        return o | x == self.full_mask
+
+    def next_marks(self, o, x):
+        if o | x == self.full_mask:
+            return ()
+        os, xes = bin(o).count('1'), bin(x).count('1')
+        if os == xes:
+            return OMARK, XMARK
+        return (OMARK,) if xes > os else (XMARK,)
+
+    def moves(self, o, x):
+        empty = self.full_mask & ~(o | x)
+        return tuple(i for i in range(self.cells) if empty >> i & 1)
+
+    def place(self, o, x, cell, mark):
+        return place(o, x, cell, mark)
+
+
+def get_layout(size=SIZE, win_length=None):
+    """
+    Get the shared Layout of a board size and win length
+    :param size: (int) the number of rows (and columns) of the board
+    :param win_length: (int) the number of marks in a row needed to win
+    :return: (Layout)
+    """
+    return _get_layout(size, win_length or size)
+
+
+@lru_cache(maxsize=None)
+def _get_layout(size, win_length):
+    return Layout(size, win_length)
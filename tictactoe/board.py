@@ -0,0 +1,176 @@
+"""
+Tic-Tac-Toe board module
+
+Immutable, interned positions of the classic 3x3 game. There is at most
+one Board per board key, so equal Boards are the same object, and moves
+return the existing successor rather than building a new board.
+"""
+
+import threading
+import numpy as np
+from tictactoe import Mark, State
+from . import bitboard, symmetry
+
+# The interned Board of each key, filled as boards are first used
+_BOARDS = [None] * symmetry.NUM_KEYS
+_LOCK = threading.Lock()
+
+
+class Board:
+    """
+    An immutable classic 3x3 board, interned by its base-3 key: Board(key)
+    returns the one Board of that key. Equality and hashing are those of
+    object identity. The winner, marks to move and board code are worked
+    out once, when a board is interned, and its successors the first time
+    each Mark moves on it.
+    """
+    __slots__ = ('key', 'o', 'x', 'cells', 'winner', 'is_full', 'code',
+                 '_next_marks', '_successors')
+
+    def __new__(cls, key=0):
+        board = _BOARDS[key]
+        if board is None:
+            with _LOCK:
+                board = _BOARDS[key]
+                if board is None:
+                    board = _BOARDS[key] = cls._create(key)
+        return board
+
+    @classmethod
+    def _create(cls, key):
+        board = object.__new__(cls)
+        o, x = bitboard.from_key(key)
+        cells = tuple(Mark(m) for m in bitboard.to_cells(o, x))
+        winner = bitboard.winner(o, x)
+        for name, value in (
+                ('key', key), ('o', o), ('x', x), ('cells', cells),
+                ('winner', Mark(winner) if winner else None),
+                ('is_full', bitboard.is_full(o, x)),
+                ('code', ''.join(repr(mark) for mark in cells)),
+                ('_next_marks', frozenset(
+                    Mark(m) for m in bitboard.next_marks(o, x))),
+                # The successors of each Mark, indexed by Mark then cell
+                ('_successors', [None, None, None])):
+            object.__setattr__(board, name, value)
+        return board
+
+    @classmethod
+    def from_bits(cls, o, x):
+        """
+        Get the Board of a bit board
+        :param o: (int) the O bit set
+        :param x: (int) the X bit set
+        :return: (Board)
+        """
+        return cls(bitboard.to_key(o, x))
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Get the Board of a 3x3 State, or of anything with a board key
+        :param state: (State) the state
+        :return: (Board)
+        """
+        return cls(state.to_key())
+
+    @classmethod
+    def interned(cls):
+        """
+        Get the number of Boards interned so far
+        :return: (int)
+        """
+        return sum(board is not None for board in _BOARDS)
+
+    def successors(self, mark):
+        """
+        Get the Board after a Mark moves on each cell
+        :param mark: (Mark) the Mark to move
+        :return: (tuple) of the successor Board of each cell, None for
+        cells which are taken
+        """
+        successors = self._successors[mark]
+        if successors is None:
+            empty = bitboard.FULL_MASK & ~(self.o | self.x)
+            successors = self._successors[mark] = tuple(
+                Board.from_bits(*bitboard.place(self.o, self.x, cell, mark))
+                if empty >> cell & 1 else None
+                for cell in range(bitboard.CELLS))
+        return successors
+
+    def children(self, mark):
+        """
+        Yield the result of each move a Mark can make on this Board
+        :param mark: (Mark) the Mark to move
+        :return: (generator) of (cell, Board) tuples, in cell order
+        """
+        for cell, child in enumerate(self.successors(mark)):
+            if child is not None:
+                yield cell, child
+
+    def play(self, cell, mark):
+        """
+        Get the Board after a move
+        :param cell: (int) the row-major index of an empty cell
+        :param mark: (Mark) the Mark to move
+        :return: (Board)
+        """
+        child = self.successors(mark)[cell]
+        if child is None:
+            raise ValueError(f'Cell {cell} is taken')
+        return child
+
+    def get_mark(self, row, col):
+        """
+        Return the mark on the board at the given row and column index
+        :param row: (int)
+        :param col: (int)
+        :return: (Mark)
+        """
+        return self.cells[row * bitboard.SIZE + col]
+
+    def next_marks(self):
+        """
+        Get the Marks which may move next on this Board
+        :return: (frozenset) of Mark objects
+        """
+        return self._next_marks
+
+    @property
+    def canonical_key(self):
+        return symmetry.CANONICAL[self.key]
+
+    def to_key(self):
+        return self.key
+
+    def to_bits(self):
+        return self.o, self.x
+
+    def to_code1(self):
+        return self.code
+
+    def to_state(self):
+        """
+        Get a new, mutable State of this Board
+        :return: (State)
+        """
+        array = np.array(self.cells, dtype=Mark)
+        return State(array.reshape(bitboard.SIZE, bitboard.SIZE))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Board is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('Board is immutable')
+
+    def __reduce__(self):
+        # Unpickled Boards are interned again
+        return Board, (self.key,)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __repr__(self):
+        return f'Board({self.code!r})'
@@ -4,27 +4,214 @@ Tic-Tac-Toe game state cache module
 Module for caching game states for efficiency
 """
 
-import numpy as np
 import json
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+import numpy as np
 from tictactoe import Mark, State
-from tictactoe.ai import branch
+from tictactoe.ai import branch_unique
+from tictactoe.batch import reachable_levels
+from tictactoe.metrics import CACHE_LOOKUPS
+from tictactoe.scores import ScoreTable, exact_integers
+from tictactoe.solver import solve
 from tictactoe.util import apply_xforms
-from .util import rot180, rot270
+from . import bitboard, symmetry
+
+
+class MappedCacheFile:
+    """
+    Read-only, memory-mapped view of a Format 003 (binary) cache file.
+    Each State is a fixed-width record of its canonical key, its board
+    key and its desirability; records are sorted by canonical key so a
+    lookup binary-searches the mapped file directly.
+    """
+    MAGIC = b'TTTC'
+    FORMAT = 3
+    HEADER = struct.Struct('<4sHI')  # magic, format, record count
+    RECORD = struct.Struct('<HHBxii')  # canonical key, key, flags, O, X
+    # The same record, as a NumPy structured type
+    DTYPE = np.dtype([('canonical', '<u2'), ('key', '<u2'), ('flags', 'u1'),
+                      ('pad', 'u1'), ('o', '<i4'), ('x', '<i4')])
+    HAS_DESIRABILITY = 0x01
+
+    def __init__(self, file_path):
+        with open(file_path, 'rb') as fp:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, _format, count = self.HEADER.unpack_from(self._map)
+        if magic != self.MAGIC or _format != self.FORMAT:
+            raise ValueError(f'{file_path} is not a Format 003 cache file')
+        if len(self._map) != self.HEADER.size + count * self.RECORD.size:
+            raise ValueError(f'{file_path} is truncated')
+        self._count = count
+
+    @classmethod
+    def is_mapped_file(cls, file_path):
+        """
+        Whether the file at the specified path is a Format 003 cache file
+        :param file_path: (string) file path
+        :return: (bool)
+        """
+        with open(file_path, 'rb') as fp:
+            return fp.read(len(cls.MAGIC)) == cls.MAGIC
+
+    @classmethod
+    def write(cls, file_path, records):
+        """
+        Write records to a Format 003 cache file at the specified path
+        :param file_path: (string) file path
+        :param records: (iterable) of record tuples, or an array of DTYPE
+        """
+        if isinstance(records, np.ndarray):
+            records = np.sort(records, order='canonical')
+        else:
+            records = sorted(records)
+        with open(file_path, 'wb') as fp:
+            fp.write(cls.HEADER.pack(cls.MAGIC, cls.FORMAT, len(records)))
+            if isinstance(records, np.ndarray):
+                fp.write(records.astype(cls.DTYPE).tobytes())
+                return
+            for record in records:
+                fp.write(cls.RECORD.pack(*record))
+
+    @classmethod
+    def update(cls, file_path, records):
+        """
+        Overwrite records of a Format 003 cache file in place. Records
+        which are unchanged are not written.
+        :param file_path: (string) file path
+        :param records: (ndarray) of DTYPE, of canonical keys which are
+        already in the file
+        :return: (int) the number of records written
+        """
+        records = np.asarray(records, dtype=cls.DTYPE)
+        with open(file_path, 'r+b') as fp, mmap.mmap(fp.fileno(), 0) as map_:
+            magic, _format, count = cls.HEADER.unpack_from(map_)
+            if magic != cls.MAGIC or _format != cls.FORMAT:
+                raise ValueError(f'{file_path} is not a Format 003 cache file')
+            stored = np.frombuffer(map_, dtype=cls.DTYPE, count=count,
+                                   offset=cls.HEADER.size)
+            index = np.searchsorted(stored['canonical'], records['canonical'])
+            found = index < count
+            found[found] = stored['canonical'][index[found]] == \
+                records['canonical'][found]
+            if not found.all():
+                del stored
+                raise LookupError('Records must already be in the cache '
+                                  'file')
+            changed = stored[index] != records
+            stored[index[changed]] = records[changed]
+            del stored
+            map_.flush()
+        return int(np.count_nonzero(changed))
+
+    @classmethod
+    def to_record(cls, state):
+        """
+        Get the record tuple for a State, whose desirability must fit the
+        record's 32-bit fields
+        :param state: (State) the state
+        :return: (tuple)
+        """
+        key = state.to_key()
+        desirability = state.desirability
+        if desirability is None:
+            return symmetry.CANONICAL[key], key, 0, 0, 0
+        o_des, x_des = exact_integers(
+            [desirability[Mark.OMARK], desirability[Mark.XMARK]],
+            np.int32).tolist()
+        return (symmetry.CANONICAL[key], key, cls.HAS_DESIRABILITY,
+                o_des, x_des)
+
+    @classmethod
+    def to_state(cls, record):
+        """
+        Get a new State for a record tuple
+        :param record: (tuple) the record
+        :return: (State)
+        """
+        _, key, flags, o_des, x_des = record
+        state = State.from_key(key)
+        if flags & cls.HAS_DESIRABILITY:
+            state.desirability = {Mark.OMARK: o_des, Mark.XMARK: x_des}
+        return state
+
+    def array(self):
+        """
+        Get every record as a structured array, a view of the mapped file
+        :return: (ndarray) of DTYPE
+        """
+        return np.frombuffer(self._map, dtype=self.DTYPE, count=self._count,
+                             offset=self.HEADER.size)
+
+    def record(self, index):
+        """
+        Get the record at an index
+        :param index: (int) the record index
+        :return: (tuple)
+        """
+        offset = self.HEADER.size + index * self.RECORD.size
+        return self.RECORD.unpack_from(self._map, offset)
+
+    def find(self, canonical_key):
+        """
+        Binary-search for the record of a canonical key
+        :param canonical_key: (int) the canonical board key
+        :return: (tuple) the record, or None if it is not present
+        """
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record = self.record(mid)
+            if record[0] < canonical_key:
+                lo = mid + 1
+            elif record[0] > canonical_key:
+                hi = mid
+            else:
+                return record
+        return None
+
+    def close(self):
+        self._map.close()
+
+    def __contains__(self, canonical_key):
+        return self.find(canonical_key) is not None
+
+    def __iter__(self):
+        for index in range(self._count):
+            yield self.record(index)
+
+    def __len__(self):
+        return self._count
 
 
 class StateCache:
     """
-    Caches game states according to their isomorphic states
+    Caches game states according to their isomorphic states. Each State
+    is stored under the key of its canonical isomorph. A cache loaded
+    from a Format 003 file reads States from the mapped file on demand;
+    added and updated States are kept in memory in front of it. Scores
+    are kept in a ScoreTable, and the desirability of each cached State
+    is a view of its row.
     """
 
     def __init__(self):
         self._cache = {}
+        self._keys = {}
+        self._mapped = None
+        self.scores = ScoreTable()
 
-    def write(self, file_path):
+    def write(self, file_path, file_format=2):
         """
-        Write this cache to a JSON file at the specified path
+        Write this cache to a file at the specified path
         :param file_path: (string) file path
+        :param file_format: (int) 2 for JSON, 3 for binary
         """
+        if file_format == MappedCacheFile.FORMAT:
+            MappedCacheFile.write(file_path, self._records())
+            return
         data = {
             'Format': '002',
             'States': sorted([c.to_code2() for c in self])
@@ -34,9 +221,20 @@ class StateCache:
 
     def load(self, file_path):
         """
-        Read a JSON file at the specified path into this cache
+        Read a cache file at the specified path into this cache. The file
+        format is detected from its contents.
         :param file_path: (string) file path
         """
+        if MappedCacheFile.is_mapped_file(file_path):
+            mapped = MappedCacheFile(file_path)
+            if self._mapped is None:
+                self._mapped = mapped
+                self._load_scores(mapped.array())
+                return
+            for record in mapped:
+                self.add(MappedCacheFile.to_state(record))
+            mapped.close()
+            return
         with open(file_path, 'r') as fp:
             data = json.load(fp)
         _format = int(data['Format'])
@@ -48,9 +246,84 @@ class StateCache:
             for code in codes:
                 self.add(State.from_code2(code))
 
+    def _load_scores(self, records):
+        """
+        Copy the desirability of mapped records into the score columns,
+        except for States held in memory
+        :param records: (ndarray) of MappedCacheFile.DTYPE
+        """
+        keys = records['canonical'].astype(np.int64)
+        records = records[~np.isin(keys, list(self._keys))]
+        keys = records['canonical'].astype(np.int64)
+        known = records['flags'] & MappedCacheFile.HAS_DESIRABILITY != 0
+        self.scores.set_desirability(keys, None)
+        self.scores.update(keys[known], O=records['o'][known],
+                           X=records['x'][known])
+
+    def write_changes(self, file_path, canonical_keys):
+        """
+        Write the records of some States to a Format 003 cache file in
+        place, as write() would write them, leaving the others untouched
+        :param file_path: (string) file path of a Format 003 cache file
+        holding every given State
+        :param canonical_keys: (iterable) of the canonical keys of the
+        changed States
+        :return: (int) the number of records written
+        """
+        return MappedCacheFile.update(file_path,
+                                      self._records(canonical_keys))
+
+    def _records(self, canonical_keys=None):
+        """
+        Get the Format 003 record of every State, from the score columns
+        :param canonical_keys: (iterable) of the canonical keys of the
+        States to get, or None for all of them
+        :return: (ndarray) of MappedCacheFile.DTYPE, sorted by canonical
+        key
+        """
+        stored = {}
+        if self._mapped is not None:
+            records = self._mapped.array()
+            stored.update(zip(records['canonical'].tolist(),
+                              records['key'].tolist()))
+        stored.update(self._keys)
+        if canonical_keys is None:
+            canonical_keys = stored
+        keys = np.array(sorted(canonical_keys), dtype=np.int64)
+        records = np.zeros(len(keys), dtype=MappedCacheFile.DTYPE)
+        records['canonical'] = keys
+        records['key'] = [stored[k] for k in keys.tolist()]
+        known = self.scores.known['O'][keys]
+        records['flags'] = known * MappedCacheFile.HAS_DESIRABILITY
+        for field, name in (('o', 'O'), ('x', 'X')):
+            records[field] = exact_integers(
+                np.where(known, self.scores.columns[name][keys], 0),
+                np.int32)
+        return records
+
+    def _bind(self, canonical_key, state):
+        """
+        Move the desirability of a State into its row of the score
+        columns, and read it from there from now on
+        :param canonical_key: (int) the canonical board key
+        :param state: (State) the state
+        """
+        self.scores.set_desirability(canonical_key, state.desirability)
+        state.bind_scores(self.scores, canonical_key)
+
+    def _mapped_state(self, record):
+        """
+        Get a new State for a mapped record, bound to the score columns
+        :param record: (tuple) the record
+        :return: (State)
+        """
+        state = State.from_key(record[1])
+        state.bind_scores(self.scores, record[0])
+        return state
+
     @classmethod
     def _hash_board(cls, state):
-        return hash(tuple(state[:].flatten()))
+        return symmetry.CANONICAL[state.to_key()]
 
     @classmethod
     def _get_iso_xforms(cls):
@@ -59,14 +332,7 @@ class StateCache:
         generating all geometrical isomorphs of a game state.
         :return: (generator) of tuples (xform sequence, inv. xform seq.)
         """
-        yield [], []  # Identity
-        yield [np.fliplr], [np.fliplr]
-        yield [np.flipud], [np.flipud]
-        yield [np.rot90], [rot270]
-        yield [rot180], [rot180]
-        yield [rot270], [np.rot90]
-        yield [np.rot90, np.fliplr], [np.fliplr, rot270]
-        yield [rot270, np.fliplr], [np.fliplr, np.rot90]
+        yield from symmetry.ISO_XFORMS
 
     @classmethod
     def _get_isomorphs(cls, state):
@@ -85,56 +351,463 @@ class StateCache:
         :param state: (State) the state
         """
         if state not in self:
-            self._cache[self._hash_board(state)] = state
+            key = state.to_key()
+            canonical_key = symmetry.CANONICAL[key]
+            self._bind(canonical_key, state)
+            self._cache[canonical_key] = state
+            self._keys[canonical_key] = key
 
     def update_state(self, state):
         """
         Update a State object reference in the backing cache
         :param state: (State) the state
         """
-        state_hash = self._hash_board(state)
-        if state_hash not in self._cache:
+        key = state.to_key()
+        canonical_key = symmetry.CANONICAL[key]
+        if self._stored_key(canonical_key) != key:
             raise LookupError('State must already be a direct element of the '
                               'backing cache set')
-        del self._cache[state_hash]
-        self._cache[state_hash] = state
+        self._bind(canonical_key, state)
+        self._cache.pop(canonical_key, None)
+        self._cache[canonical_key] = state
+        self._keys[canonical_key] = key
 
     def clear_desirability(self):
         """
         Set the desirability of all States in the cache to None
         """
-        for state in self._cache.values():
-            state.desirability = None
+        self.scores.clear('O', 'X')
+
+    def contains_key(self, canonical_key):
+        """
+        Whether the cache holds a State for a canonical key
+        :param canonical_key: (int) the canonical board key
+        :return: (bool)
+        """
+        return self._stored_key(canonical_key) is not None
+
+    def _stored_key(self, canonical_key):
+        """
+        Get the board key of the State stored under a canonical key
+        :param canonical_key: (int) the canonical board key
+        :return: (int) the board key, or None if it is not present
+        """
+        if canonical_key in self._keys:
+            return self._keys[canonical_key]
+        if self._mapped is not None:
+            record = self._mapped.find(canonical_key)
+            if record is not None:
+                return record[1]
+        return None
+
+    def lookup(self, item):
+        """
+        Find the cached isomorph of a State
+        :param item: (State) the state
+        :return: (tuple) of the cached State and the index of the symmetry
+        mapping it back onto the given State, or (None, None)
+        """
+        key = item.to_key()
+        canonical_key = symmetry.CANONICAL[key]
+        cached = self._cache.get(canonical_key)
+        if cached is not None:
+            CACHE_LOOKUPS.inc(cache='state', result='hit')
+            return cached, symmetry.relate(self._keys[canonical_key], key)
+        if self._mapped is not None:
+            record = self._mapped.find(canonical_key)
+            if record is not None:
+                CACHE_LOOKUPS.inc(cache='state', result='hit')
+                cached = self._mapped_state(record)
+                return cached, symmetry.relate(record[1], key)
+        CACHE_LOOKUPS.inc(cache='state', result='miss')
+        return None, None
 
     def __contains__(self, item):
-        isos = set(self._get_isomorphs(item))
-        return any(self._hash_board(iso) in self._cache for iso in isos)
+        canonical_key = self._hash_board(item)
+        if canonical_key in self._cache:
+            return True
+        return self._mapped is not None and canonical_key in self._mapped
 
     def __getitem__(self, item):
-        for xforms, ixforms in self._get_iso_xforms():
-            iso = State(apply_xforms(xforms, item[:]))
-            # Retrieve the actual state object based on the board state
-            # hash of the isomorph being present in the cache dictionary
-            board_hash = self._hash_board(iso)
-            if board_hash in self._cache:
-                return self._cache[board_hash], xforms, ixforms
-        return None, None, None
+        cached, sym = self.lookup(item)
+        if cached is None:
+            return None, None, None
+        # The transformations map the given state onto the cached one
+        ixforms, xforms = symmetry.ISO_XFORMS[sym]
+        return cached, xforms, ixforms
 
     def __iter__(self):
         yield from self._cache.values()
+        if self._mapped is not None:
+            for record in self._mapped:
+                if record[0] not in self._cache:
+                    yield self._mapped_state(record)
+
+    def __len__(self):
+        if self._mapped is None:
+            return len(self._cache)
+        overlay = sum(1 for k in self._cache if k not in self._mapped)
+        return len(self._mapped) + overlay
+
+
+class LazyStateCache(StateCache):
+    """
+    A StateCache which starts empty and holds at most max_size States,
+    evicting the least recently used. A State missing from it is read from
+    a Format 003 file, if one is given, or else solved together with the
+    States below it.
+    """
+
+    def __init__(self, max_size=4096, file_path=None):
+        super().__init__()
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self._file_path = file_path
+        self._lock = threading.RLock()
+        self._warm_up = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.solves = 0
+
+    def lookup(self, item):
+        key = item.to_key()
+        canonical_key = symmetry.CANONICAL[key]
+        with self._lock:
+            cached = self._cache.get(canonical_key)
+            if cached is not None:
+                self.hits += 1
+                CACHE_LOOKUPS.inc(cache='state', result='hit')
+                self._cache.move_to_end(canonical_key)
+            else:
+                self.misses += 1
+                CACHE_LOOKUPS.inc(cache='state', result='miss')
+                cached = self._fill(canonical_key)
+            return cached, symmetry.relate(self._keys[canonical_key], key)
+
+    def _fill(self, canonical_key):
+        """
+        Read or solve the State of a canonical key, and store it
+        :param canonical_key: (int) the canonical board key
+        :return: (State) the stored State
+        """
+        if self._mapped is None and self._file_path is not None:
+            self._mapped = MappedCacheFile(self._file_path)
+        if self._mapped is not None:
+            record = self._mapped.find(canonical_key)
+            if record is not None:
+                state = MappedCacheFile.to_state(record)
+                self._store(canonical_key, record[1], state)
+                return state
+        self.solves += 1
+        mark = self._mark_to_move(canonical_key)
+        pieces = self._pieces(canonical_key)
+        solution = solve(State.from_key(canonical_key), mark)
+        # The States below fill only free space, and go first so that the
+        # requested one is stored last. States whose mover in this solution
+        # is not the one the cache keeps are left out.
+        for key in sorted(solution.desirability,
+                          key=lambda k: k == canonical_key):
+            plies = self._pieces(key) - pieces
+            to_move = mark if plies % 2 == 0 else Mark.get_next(mark)
+            if key in self._cache or to_move != self._mark_to_move(key):
+                continue
+            if key != canonical_key and len(self._cache) >= self.max_size:
+                continue
+            state = State.from_key(key)
+            state.desirability = solution.get_desirability(key)
+            self._store(key, key, state)
+        self._cache.move_to_end(canonical_key)
+        return self._cache[canonical_key]
+
+    @classmethod
+    def _pieces(cls, key):
+        o, x = bitboard.from_key(key)
+        return bin(o | x).count('1')
+
+    @classmethod
+    def _mark_to_move(cls, key):
+        """
+        Get the Mark whose desirability a cached board holds. With equal
+        counts either mark may move; the cache generated by tttai.py keeps
+        the desirability of X moving, as it solves the game from X last.
+        :param key: (int) the board key
+        :return: (Mark)
+        """
+        o, x = bitboard.from_key(key)
+        if bin(x).count('1') > bin(o).count('1'):
+            return Mark.OMARK
+        return Mark.XMARK
+
+    def _store(self, canonical_key, key, state):
+        self._bind(canonical_key, state)
+        self._cache[canonical_key] = state
+        self._keys[canonical_key] = key
+        while len(self._cache) > self.max_size:
+            evicted, _ = self._cache.popitem(last=False)
+            del self._keys[evicted]
+            self.evictions += 1
+
+    def add(self, state):
+        with self._lock:
+            key = state.to_key()
+            canonical_key = symmetry.CANONICAL[key]
+            if canonical_key not in self._cache:
+                self._store(canonical_key, key, state)
+
+    def update_state(self, state):
+        with self._lock:
+            key = state.to_key()
+            canonical_key = symmetry.CANONICAL[key]
+            if self._keys.get(canonical_key, key) != key:
+                raise LookupError('State must already be a direct element of '
+                                  'the backing cache set')
+            self._cache.pop(canonical_key, None)
+            self._store(canonical_key, key, state)
+
+    def warm_up(self, states=None):
+        """
+        Fill this cache in a background thread
+        :param states: (iterable) of States to look up, by default every
+        State reachable from the empty board
+        :return: (threading.Thread) the started thread
+        """
+        if states is None:
+            states = (state for mark in (Mark.OMARK, Mark.XMARK)
+                      for state in branch_unique([State()], mark, 9))
+
+        def fill():
+            for state in states:
+                with self._lock:
+                    if len(self._cache) >= self.max_size:
+                        return
+                    canonical_key = self._hash_board(state)
+                    if canonical_key not in self._cache:
+                        self._fill(canonical_key)
+
+        self._warm_up = threading.Thread(target=fill, daemon=True,
+                                         name='StateCache warm-up')
+        self._warm_up.start()
+        return self._warm_up
+
+    def metrics(self):
+        """
+        Get the counters of this cache
+        :return: (dict) of the number of States held and the lookup hits,
+        misses, evictions and solves
+        """
+        return {
+            'size': len(self._cache),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'solves': self.solves,
+        }
+
+    def __contains__(self, item):
+        with self._lock:
+            return self._hash_board(item) in self._cache
+
+    def __iter__(self):
+        with self._lock:
+            states = list(self._cache.values())
+        yield from states
 
     def __len__(self):
         return len(self._cache)
 
 
-def generate_cache_file(file_path):
+class SharedStateCache(StateCache):
+    """
+    A read-only StateCache whose States are flat arrays indexed by
+    canonical key, in a file which every process maps read-only. A
+    primary process writes the file once, and worker processes map the
+    same pages without copying or parsing anything; each lookup builds a
+    new State whose desirability is a view of the mapped columns.
+    """
+    MAGIC = b'TTTS'
+    FORMAT = 1
+    HEADER = struct.Struct('<4sHI6x')  # magic, format, State count
+    ABSENT = 0xFFFF  # Stored key of a canonical key with no State
+
+    def __init__(self, file_path):
+        """
+        :param file_path: (string) a file written by create()
+        """
+        super().__init__()
+        with open(file_path, 'rb') as fp:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, _format, count = self.HEADER.unpack_from(self._map)
+        if magic != self.MAGIC or _format != self.FORMAT:
+            raise ValueError(f'{file_path} is not a shared state cache')
+        if len(self._map) != self._size():
+            raise ValueError(f'{file_path} is truncated')
+        self._count = count
+        desirability, self._stored, self._flags = self._arrays(self._map)
+        known = self._flags & MappedCacheFile.HAS_DESIRABILITY != 0
+        known.setflags(write=False)
+        self.scores = ScoreTable(
+            columns={'O': desirability[:, 0], 'X': desirability[:, 1]},
+            known={'O': known, 'X': known})
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def _arrays(cls, buffer):
+        """
+        Get views of the arrays in a buffer
+        :param buffer: (buffer) the file contents
+        :return: (tuple) of the (NUM_KEYS, 2) desirability, stored key and
+        flags arrays
+        """
+        offset = cls.HEADER.size
+        desirability = np.frombuffer(buffer, dtype='<i4',
+                                     count=2 * symmetry.NUM_KEYS,
+                                     offset=offset).reshape(-1, 2)
+        offset += desirability.nbytes
+        stored = np.frombuffer(buffer, dtype='<u2', count=symmetry.NUM_KEYS,
+                               offset=offset)
+        offset += stored.nbytes
+        flags = np.frombuffer(buffer, dtype='u1', count=symmetry.NUM_KEYS,
+                              offset=offset)
+        return desirability, stored, flags
+
+    @classmethod
+    def _size(cls):
+        return cls.HEADER.size + symmetry.NUM_KEYS * (2 * 4 + 2 + 1)
+
+    @classmethod
+    def create(cls, file_path, source_path):
+        """
+        Write the arrays of a cache file, replacing any earlier file so
+        that processes mapping it keep a consistent view
+        :param file_path: (string) the file to write, such as one in
+        /dev/shm
+        :param source_path: (string) a cache file of any format
+        :return: (SharedStateCache) the written cache
+        """
+        if MappedCacheFile.is_mapped_file(source_path):
+            mapped = MappedCacheFile(source_path)
+            records = list(mapped)
+            mapped.close()
+        else:
+            cache = StateCache()
+            cache.load(source_path)
+            records = [MappedCacheFile.to_record(state) for state in cache]
+        buffer = bytearray(cls._size())
+        cls.HEADER.pack_into(buffer, 0, cls.MAGIC, cls.FORMAT, len(records))
+        desirability, stored, flags = cls._arrays(buffer)
+        stored[:] = cls.ABSENT
+        for canonical_key, key, flag, o_des, x_des in records:
+            stored[canonical_key] = key
+            flags[canonical_key] = flag
+            desirability[canonical_key] = o_des, x_des
+        del desirability, stored, flags
+        temp_path = f'{file_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as fp:
+            fp.write(buffer)
+        os.replace(temp_path, file_path)
+        return cls(file_path)
+
+    def close(self):
+        """
+        Stop using the mapped file
+        """
+        self.scores = self._stored = self._flags = None
+        try:
+            self._map.close()
+        except BufferError:
+            # States looked up earlier still view the columns, and the
+            # file is unmapped once they are gone
+            pass
+
+    def _to_state(self, canonical_key):
+        state = State.from_key(int(self._stored[canonical_key]))
+        state.bind_scores(self.scores, canonical_key)
+        return state
+
+    def _stored_key(self, canonical_key):
+        key = int(self._stored[canonical_key])
+        return None if key == self.ABSENT else key
+
+    def lookup(self, item):
+        key = item.to_key()
+        canonical_key = symmetry.CANONICAL[key]
+        stored = self._stored_key(canonical_key)
+        if stored is None:
+            self.misses += 1
+            CACHE_LOOKUPS.inc(cache='state', result='miss')
+            return None, None
+        self.hits += 1
+        CACHE_LOOKUPS.inc(cache='state', result='hit')
+        return self._to_state(canonical_key), symmetry.relate(stored, key)
+
+    def add(self, state):
+        raise TypeError('SharedStateCache is read-only')
+
+    def update_state(self, state):
+        raise TypeError('SharedStateCache is read-only')
+
+    def metrics(self):
+        """
+        Get the counters of this cache, as LazyStateCache.metrics does
+        :return: (dict) of the number of States held and the lookup hits
+        and misses of this process
+        """
+        return {
+            'size': self._count,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': 0,
+            'solves': 0,
+        }
+
+    def __contains__(self, item):
+        return self._stored_key(self._hash_board(item)) is not None
+
+    def __iter__(self):
+        for canonical_key in np.flatnonzero(self._stored != self.ABSENT):
+            yield self._to_state(int(canonical_key))
+
+    def __len__(self):
+        return self._count
+
+
+def generate_cache_file(file_path, vectorized=False, ply_counts=False,
+                        workers=1):
     """
     Generates a cache of all geometrically dissimilar states of the
-    game. This generally takes a few minutes.
+    game, each in its canonical orientation. Each canonical state is
+    expanded only once, either ply by ply or, if vectorized, in a single
+    batch pass per ply.
+    :param file_path: (string) file path
+    :param vectorized: (bool) whether to use the batch enumeration
+    :param ply_counts: (bool) whether to count the states of each ply
+    :param workers: (int) the number of processes to enumerate with
+    :return: (dict) of {Mark: list of the number of canonical states
+    after each ply} for each starting Mark, if ply_counts is set
     """
     cache = StateCache()
-    for state in branch([State()], Mark.OMARK, 9):
-        cache.add(state)
-    for state in branch([State()], Mark.XMARK, 9):
-        cache.add(state)
+    counts = {}
+    for mark in (Mark.OMARK, Mark.XMARK):
+        counts[mark] = [0] * 10
+        if vectorized:
+            keys = (key for keys, _ in reachable_levels(State(), mark)
+                    for key in keys.tolist())
+        elif workers > 1:
+            # Imported here, since process pools are slow to import
+            from tictactoe.parallel import solve_parallel
+            solution = solve_parallel(State(), mark, workers)
+            keys = sorted(solution.desirability)
+        else:
+            keys = (symmetry.CANONICAL[state.to_key()]
+                    for state in branch_unique([State()], mark, 9))
+        # Every mode stores the canonical isomorph of each state, so the
+        # file is the same whichever mode wrote it
+        for key in keys:
+            state = State.from_key(key)
+            counts[mark][9 - state.to_code1().count('.')] += 1
+            cache.add(state)
     cache.write(file_path)
+    if ply_counts:
+        return counts
@@ -0,0 +1,274 @@
+"""
+Tic-Tac-Toe Monte Carlo tree search module
+
+Monte Carlo tree search for positions and variants which have no cache.
+Random playouts are run thousands at a time as NumPy array operations.
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from tictactoe import Mark
+
+# The completion time of a line nobody completes in a playout
+_NEVER = np.iinfo(np.int16).max
+
+
+def line_cells(layout):
+    """
+    Get the cells of each winning line of a layout
+    :param layout: (Layout) the board layout
+    :return: (ndarray) of shape (lines, win_length) of cell indices
+    """
+    return np.array([[cell for cell in range(layout.cells) if mask >> cell & 1]
+                     for mask in layout.win_masks], dtype=np.intp)
+
+
+def rollouts(lines, boards, marks, rng):
+    """
+    Play random games to the end from many boards at once. Each game
+    fills its empty cells in a random order, the players taking turns,
+    and is won by the player who completes a line first.
+    :param lines: (ndarray) the cells of each winning line, see line_cells
+    :param boards: (ndarray) of shape (games, cells) of Mark values, none
+    of them won yet
+    :param marks: (ndarray) of the Mark to move on each board
+    :param rng: (Generator) the random number generator
+    :return: (ndarray) of the winning Mark of each game, Mark.EMPTY for
+    a draw
+    """
+    boards = np.asarray(boards, dtype=np.int8)
+    marks = np.asarray(marks, dtype=np.int8)[:, np.newaxis]
+    empty = boards == Mark.EMPTY
+    # Ranking random keys gives each empty cell its turn, 0 first, with
+    # the filled cells ranked after them all
+    keys = np.where(empty, rng.random(boards.shape), 2.0)
+    turns = keys.argsort(axis=1).argsort(axis=1).astype(np.int16)
+    movers = np.where(turns % 2 == 0, marks, Mark.XMARK + Mark.OMARK - marks)
+    filled = np.where(empty, movers, boards)
+    turns[~empty] = -1
+
+    line_marks = filled[:, lines]
+    owner = line_marks[:, :, 0]
+    complete = (line_marks == owner[:, :, np.newaxis]).all(axis=2) & \
+        (owner != Mark.EMPTY)
+    completed_at = np.where(complete, turns[:, lines].max(axis=2), _NEVER)
+    first = completed_at.argmin(axis=1)
+    games = np.arange(len(boards))
+    return np.where(completed_at[games, first] < _NEVER,
+                    owner[games, first], Mark.EMPTY)
+
+
+class Node:
+    """
+    A position in a search tree, reached by the mark of the player who
+    moved into it. Wins are counted for that player, a draw as half.
+    """
+    __slots__ = ('o', 'x', 'mark', 'winner', 'full', 'untried', 'children',
+                 'visits', 'wins')
+
+    def __init__(self, layout, o, x, mark, winner=Mark.EMPTY):
+        """
+        :param layout: (Layout) the board layout
+        :param o: (int) the O bit set
+        :param x: (int) the X bit set
+        :param mark: (Mark) the Mark of the player who moved into this
+        position, whose opponent moves next
+        :param winner: (Mark) the winner of the position
+        """
+        self.o = o
+        self.x = x
+        self.mark = mark
+        self.winner = winner
+        self.full = layout.is_full(o, x)
+        self.untried = [] if winner or self.full else list(layout.moves(o, x))
+        self.children = {}
+        self.visits = 0
+        self.wins = 0.0
+
+    @property
+    def is_terminal(self):
+        return bool(self.winner) or self.full
+
+
+class SearchResult:
+    """
+    The cell one search chose, with the tree it searched and the
+    playouts it started with and ran
+    """
+    __slots__ = ('cell', 'root', 'reused', 'iterations')
+
+    def __init__(self, cell, root, reused, iterations):
+        """
+        :param cell: (int) the row-major index of the cell to play, or
+        None if the board is full or won
+        :param root: (Node) the root of the searched tree
+        :param reused: (int) the visits of the root kept from earlier
+        searches
+        :param iterations: (int) the leaves played out from
+        """
+        self.cell = cell
+        self.root = root
+        self.reused = reused
+        self.iterations = iterations
+
+
+class MonteCarloTreeSearch:
+    """
+    Monte Carlo tree search with UCT selection. Each iteration selects
+    batch_size leaves, counting their playouts as visits at once so that
+    the next selections spread out, and plays playouts random games from
+    every leaf in one vectorized batch. The search stops once its time
+    budget or iteration count runs out.
+
+    The subtrees below the move played are kept, keyed by the positions
+    the opponent can reply with, so the next search from one of them
+    starts with the playouts already made. At most reuse_size of them
+    are kept, dropping the least recently stored first. An engine may be
+    shared by threads: each tree is searched by one thread at a time, and
+    each search draws from its own random generator, spawned from the
+    engine's seed.
+    """
+    EXPLORATION = math.sqrt(2)
+
+    def __init__(self, time_budget=1.0, iterations=None, batch_size=16,
+                 playouts=64, reuse_size=4096, seed=None):
+        self.time_budget = time_budget
+        self.iterations = iterations
+        self.batch_size = batch_size
+        self.playouts = playouts
+        self.reuse_size = reuse_size
+        self._seeds = np.random.SeedSequence(seed)
+        self._trees = OrderedDict()
+        self._lines = {}
+        self._lock = threading.Lock()
+
+    def search(self, state, mark):
+        """
+        Find the best move for a mark on a state
+        :param state: (State) the current state
+        :param mark: (Mark) the Mark to move
+        :return: (int) the row-major index of the cell to play, or None
+        if the board is full or won
+        """
+        return self.run(state, mark).cell
+
+    def run(self, state, mark):
+        """
+        Search for the best move for a mark on a state
+        :param state: (State) the current state
+        :param mark: (Mark) the Mark to move
+        :return: (SearchResult) the cell to play and the statistics of
+        this search
+        """
+        layout = state.layout
+        o, x = state.to_bits()
+        tree_key = (layout.size, layout.win_length, o, x, mark)
+        with self._lock:
+            root = self._trees.pop(tree_key, None)
+            lines = self._lines.get(layout)
+            if lines is None:
+                lines = self._lines[layout] = line_cells(layout)
+            rng = np.random.default_rng(self._seeds.spawn(1)[0])
+        if root is None:
+            root = Node(layout, o, x, Mark.get_next(mark),
+                        layout.winner(o, x))
+        reused = root.visits
+        if root.is_terminal:
+            return SearchResult(None, root, reused, 0)
+
+        deadline = time.perf_counter() + self.time_budget
+        iterations = 0
+        while self.iterations is None or iterations < self.iterations:
+            count = self.batch_size if self.iterations is None else \
+                min(self.batch_size, self.iterations - iterations)
+            self._iterate(layout, lines, root, count, rng)
+            iterations += count
+            if time.perf_counter() > deadline:
+                break
+
+        cell, best = max(root.children.items(),
+                         key=lambda item: item[1].visits)
+        self._keep(layout, best)
+        return SearchResult(cell, root, reused, iterations)
+
+    def _iterate(self, layout, lines, root, count, rng):
+        """
+        Select count leaves, play out games from them all at once and
+        propagate the results back to the root
+        """
+        paths = [self._select(layout, root, rng) for _ in range(count)]
+        leaves = [path[-1] for path in paths]
+        open_leaves = [leaf for leaf in leaves if not leaf.is_terminal]
+        results = {}
+        if open_leaves:
+            boards = np.array([layout.to_cells(leaf.o, leaf.x)
+                               for leaf in open_leaves], dtype=np.int8)
+            marks = [Mark.get_next(leaf.mark) for leaf in open_leaves]
+            winners = rollouts(lines, np.repeat(boards, self.playouts, axis=0),
+                               np.repeat(marks, self.playouts),
+                               rng).reshape(-1, self.playouts)
+            for leaf, games in zip(open_leaves, winners):
+                results[id(leaf)] = (np.count_nonzero(games == Mark.OMARK),
+                                     np.count_nonzero(games == Mark.XMARK))
+        for path, leaf in zip(paths, leaves):
+            if leaf.is_terminal:
+                o_wins = self.playouts if leaf.winner == Mark.OMARK else 0
+                x_wins = self.playouts if leaf.winner == Mark.XMARK else 0
+            else:
+                o_wins, x_wins = results[id(leaf)]
+            draws = self.playouts - o_wins - x_wins
+            for node in path:
+                wins = o_wins if node.mark == Mark.OMARK else x_wins
+                node.wins += wins + 0.5 * draws
+
+    def _select(self, layout, root, rng):
+        """
+        Walk down by UCT to a node with untried moves or a terminal
+        node, expand it by one move, and count its playouts as visits
+        along the way
+        :return: (list) of the nodes from the root to the leaf
+        """
+        node = root
+        path = [node]
+        while not node.untried and node.children:
+            log_visits = math.log(node.visits)
+            node = max(node.children.values(),
+                       key=lambda child: self._uct(child, log_visits))
+            path.append(node)
+        if node.untried:
+            cell = node.untried.pop(int(rng.integers(len(node.untried))))
+            mark = Mark.get_next(node.mark)
+            o, x = layout.place(node.o, node.x, cell, mark)
+            won = layout.wins_at(o if mark == Mark.OMARK else x, cell)
+            child = Node(layout, o, x, mark, mark if won else Mark.EMPTY)
+            node.children[cell] = child
+            path.append(child)
+        for node in path:
+            node.visits += self.playouts
+        return path
+
+    def _uct(self, child, log_visits):
+        if not child.visits:
+            return math.inf
+        return child.wins / child.visits + \
+            self.EXPLORATION * math.sqrt(log_visits / child.visits)
+
+    def _keep(self, layout, node):
+        """
+        Keep the subtrees below a move for the next search
+        :param layout: (Layout) the board layout
+        :param node: (Node) the position after the move played
+        """
+        replies = [child for child in node.children.values()
+                   if not child.is_terminal]
+        with self._lock:
+            for child in replies:
+                key = (layout.size, layout.win_length, child.o, child.x,
+                       Mark.get_next(child.mark))
+                self._trees[key] = child
+                self._trees.move_to_end(key)
+            while len(self._trees) > self.reuse_size:
+                self._trees.popitem(last=False)
@@ -0,0 +1,470 @@
+"""
+Tic-Tac-Toe metrics module
+
+Counters, gauges and latency histograms for the AI and the web game
+servers, rendered in the Prometheus text exposition format, and an
+opt-in sampling profiler for single requests
+"""
+
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as _Tally
+from contextlib import contextmanager
+from functools import wraps
+
+# Upper bounds in seconds, from 10 microseconds to 10 seconds
+DEFAULT_BUCKETS = (1e-05, 2.5e-05, 5e-05, 0.0001, 0.00025, 0.0005, 0.001,
+                   0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', r'\\').replace('"', r'\"')
+               .replace('\n', r'\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"'
+                          for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    A named family of values, one for each combination of label values
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f'{self.name} takes labels {self.label_names}')
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self):
+        """
+        Get the samples of this metric
+        :return: (list) of (suffix, label values, extra labels, value)
+        """
+        with self._lock:
+            return [('', key, (), value)
+                    for key, value in sorted(self._values.items())]
+
+    def render(self):
+        """
+        Render this metric in the Prometheus text format
+        :return: (string)
+        """
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} {self.kind}']
+        for suffix, key, extra, value in self.samples():
+            labels = _format_labels(self.label_names, key, extra)
+            lines.append(f'{self.name}{suffix}{labels} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """
+    A value which only increases
+    """
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """
+    A value read from a function whenever the metric is rendered, such
+    as the size of a cache. A gauge of kind 'counter' exposes a count
+    kept by another object.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, function, kind='gauge',
+                 label_names=()):
+        super().__init__(name, documentation, label_names)
+        self.function = function
+        self.kind = kind
+
+    def samples(self):
+        if not self.label_names:
+            return [('', (), (), self.function())]
+        # A labelled gauge's function maps tuples of label values to values
+        return [('', tuple(str(v) for v in key), (), value)
+                for key, value in sorted(self.function().items())]
+
+
+class Histogram(Metric):
+    """
+    Counts of observed values, such as latencies, in cumulative buckets
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * len(self.buckets), 0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe the time spent in a with block
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        counts = self._values.get(self._key(labels))
+        return sum(counts[0]) if counts else 0
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append(('_bucket', key,
+                                    (('le', _format_value(bound)),),
+                                    cumulative))
+                samples.append(('_sum', key, (), total))
+                samples.append(('_count', key, (), cumulative))
+        return samples
+
+
+class Registry:
+    """
+    The metrics of a process, in registration order
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, label_names=()):
+        return self._register(Counter(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(),
+                  buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, label_names,
+                                        buckets))
+
+    def gauge(self, name, documentation, function, kind='gauge',
+              label_names=()):
+        """
+        Register a gauge, replacing any earlier gauge of the same name so
+        that a server can point it at its own objects
+        :param name: (string) the metric name
+        :param documentation: (string) the help text
+        :param function: (function) returning the current value
+        :param kind: (string) 'gauge', or 'counter' for a count kept
+        elsewhere
+        :param label_names: (tuple) of label names, in which case the
+        function returns a dict of label value tuples to values
+        :return: (Gauge)
+        """
+        gauge = Gauge(name, documentation, function, kind, label_names)
+        with self._lock:
+            self._metrics[name] = gauge
+        return gauge
+
+    def render(self):
+        """
+        Render every metric in the Prometheus text format
+        :return: (string)
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(m.render() for m in metrics) + '\n'
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+AI_SECONDS = REGISTRY.histogram(
+    'tttai_ai_seconds', 'Time spent choosing AI moves', ('function',))
+CACHE_LOOKUPS = REGISTRY.counter(
+    'tttai_cache_lookups_total', 'Cache lookups', ('cache', 'result'))
+REQUEST_SECONDS = REGISTRY.histogram(
+    'tttai_request_seconds', 'Time spent serving requests', ('endpoint',))
+REQUESTS = REGISTRY.counter(
+    'tttai_requests_total', 'Requests served', ('endpoint', 'status'))
+STAGE_SECONDS = REGISTRY.histogram(
+    'tttai_stage_seconds', 'Time spent in each stage of serving requests',
+    ('stage',))
+
+
+def register_sessions(sessions, registry=REGISTRY):
+    """
+    Expose the session counts of a SessionStore
+    :param sessions: (SessionStore) the store
+    :param registry: (Registry) the registry to add the gauges to
+    """
+    registry.gauge('tttai_sessions_active', 'Live sessions',
+                   lambda: sessions.metrics()['live'])
+    registry.gauge('tttai_sessions_created_total', 'Sessions created',
+                   lambda: sessions.metrics()['created'], 'counter')
+    registry.gauge('tttai_sessions_expired_total', 'Sessions expired',
+                   lambda: sessions.metrics()['expired'], 'counter')
+
+
+def _hit_ratios():
+    """
+    Get the fraction of the lookups of each cache which were hits
+    :return: (dict) of (cache,) label tuples to ratios
+    """
+    counts = {}
+    for _, (cache, result), _, value in CACHE_LOOKUPS.samples():
+        hits_misses = counts.setdefault((cache,), [0, 0])
+        hits_misses[result != 'hit'] += value
+    return {key: hits / (hits + misses)
+            for key, (hits, misses) in counts.items()}
+
+
+REGISTRY.gauge('tttai_cache_hit_ratio',
+               'Fraction of cache lookups which were hits', _hit_ratios,
+               label_names=('cache',))
+
+
+def timed(histogram, **labels):
+    """
+    Decorate a function to observe its running time in a histogram
+    :param histogram: (Histogram) the histogram
+    :return: (function) the decorator
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, **labels)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def timing(histogram, **labels):
+    """
+    Observe the running time of a with block in a histogram
+    :param histogram: (Histogram) the histogram
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start, **labels)
+
+
+class StartupTimer:
+    """
+    Times the phases of a server's start-up, so that cold starts can be
+    held under a budget
+    """
+    def __init__(self, start_time=None):
+        """
+        :param start_time: (float) the time.perf_counter() at which
+        start-up began, such as before the server's imports
+        """
+        self.start_time = time.perf_counter() if start_time is None \
+            else start_time
+        self.phases = []
+        self._last = self.start_time
+
+    def mark(self, phase):
+        """
+        End a phase, which began when the previous phase ended
+        :param phase: (string) the name of the phase
+        """
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    @contextmanager
+    def phase(self, phase):
+        """
+        Time a with block as a phase
+        :param phase: (string) the name of the phase
+        """
+        self._last = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.mark(phase)
+
+    @property
+    def total(self):
+        """
+        The seconds from the start time to the end of the last phase
+        :return: (float)
+        """
+        return self._last - self.start_time
+
+    def register(self, registry=REGISTRY):
+        """
+        Expose the time of each phase as a gauge
+        :param registry: (Registry) the registry to add the gauge to
+        """
+        registry.gauge('tttai_startup_seconds',
+                       'Time spent in each phase of start-up',
+                       lambda: {(p,): s for p, s in self.phases},
+                       label_names=('phase',))
+
+    def report(self, budget=None):
+        """
+        Format the time of each phase
+        :param budget: (float) the seconds allowed, or None
+        :return: (string)
+        """
+        lines = [f'{1000 * seconds:10.3f} ms  {phase}'
+                 for phase, seconds in self.phases]
+        lines.append(f'{1000 * self.total:10.3f} ms  total')
+        if budget is not None:
+            verdict = 'over' if self.total > budget else 'within'
+            lines.append(f'{verdict} the budget of {1000 * budget:.0f} ms')
+        return '\n'.join(lines) + '\n'
+
+
+# Profilers running at once share one lowered switch interval, which is
+# restored when the last of them stops
+_SWITCH_LOCK = threading.Lock()
+_switch_users = 0
+_switch_interval = None
+
+
+def _lower_switch_interval(interval):
+    global _switch_users, _switch_interval
+    with _SWITCH_LOCK:
+        if _switch_users == 0:
+            _switch_interval = sys.getswitchinterval()
+        _switch_users += 1
+        sys.setswitchinterval(min(sys.getswitchinterval(), interval))
+
+
+def _restore_switch_interval():
+    global _switch_users
+    with _SWITCH_LOCK:
+        _switch_users -= 1
+        if _switch_users == 0:
+            sys.setswitchinterval(_switch_interval)
+
+
+class SamplingProfiler:
+    """
+    Samples the call stack of one thread from a background thread, and
+    attributes each sample to the function running (self time) and to
+    every function on the stack (total time). Use it as a context manager
+    around the code to profile.
+    """
+    def __init__(self, interval=0.0001):
+        self.interval = interval
+        self.samples = 0
+        self.seconds = 0.0
+        self._self = _Tally()
+        self._total = _Tally()
+        self._thread_id = None
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def __enter__(self):
+        self._thread_id = threading.get_ident()
+        self._stop.clear()
+        # Let the sampler take the GIL often enough to see short requests
+        _lower_switch_interval(self.interval)
+        self._sampler = threading.Thread(target=self._run, daemon=True,
+                                         name='SamplingProfiler')
+        self._sampler.start()
+        self._start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._sampler.join()
+        _restore_switch_interval()
+        self.seconds = time.perf_counter() - self._start_time
+        return False
+
+    def _run(self):
+        own_codes = {SamplingProfiler.__enter__.__code__,
+                     SamplingProfiler.__exit__.__code__}
+        while not self._stop.is_set():
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            # Skip the profiler starting and stopping itself
+            if stack and not own_codes.intersection(stack):
+                self.samples += 1
+                self._self[self._describe(stack[0])] += 1
+                for function in set(map(self._describe, stack)):
+                    self._total[function] += 1
+            time.sleep(self.interval)
+
+    @classmethod
+    def _describe(cls, code):
+        return f'{code.co_filename}:{code.co_firstlineno}({code.co_name})'
+
+    def stats(self):
+        """
+        Get the estimated time of each sampled function
+        :return: (list) of (function, self seconds, total seconds), most
+        total time first
+        """
+        scale = self.seconds / self.samples if self.samples else 0.0
+        return sorted(((f, self._self[f] * scale, n * scale)
+                       for f, n in self._total.items()),
+                      key=lambda s: (-s[2], -s[1], s[0]))
+
+    def format(self, limit=40):
+        """
+        Format the per-function timings as a text table
+        :param limit: (int) the most functions to list
+        :return: (string)
+        """
+        lines = [f'{self.samples} samples in {1000 * self.seconds:.3f} ms',
+                 f'{"self ms":>10} {"total ms":>10}  function']
+        for function, self_seconds, total_seconds in self.stats()[:limit]:
+            lines.append(f'{1000 * self_seconds:10.3f} '
+                         f'{1000 * total_seconds:10.3f}  {function}')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,316 @@
+"""
+Tic-Tac-Toe move table module
+
+Precompiled AI replies for every cached state, so a move can be chosen
+with one table lookup instead of branching and scoring the children
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import numpy as np
+from tictactoe import Mark, State
+from . import bitboard, symmetry
+
+
+def _first_cells():
+    """
+    Find the lowest board cell of the canonical cells in every mask
+    :return: (ndarray) of shape (8, 512), -1 for the empty mask
+    """
+    masks = np.arange(1 << bitboard.CELLS)
+    bits = masks[:, np.newaxis] >> np.arange(bitboard.CELLS) & 1
+    perms = np.array(symmetry.PERMUTATIONS)
+    cells = np.where(bits[np.newaxis], perms[:, np.newaxis], bitboard.CELLS)
+    first = cells.min(axis=2)
+    return np.where(first == bitboard.CELLS, -1, first).astype(np.int8)
+
+
+# _FIRST_CELL[sym][mask] is the lowest board cell of the canonical cells
+# in mask, for a board which symmetry sym maps onto its canonical form
+_FIRST_CELL_ARRAY = _first_cells()
+_FIRST_CELL = _FIRST_CELL_ARRAY.tolist()
+_CANONICAL_ARRAY = np.array(symmetry.CANONICAL, dtype=np.int32)
+_SYMMETRY_ARRAY = np.array(symmetry.SYMMETRY, dtype=np.int8)
+
+
+class MoveTable:
+    """
+    Maps each (canonical state, Mark) to the set of cells which
+    calculate_next_state_for considers best, as a bit mask of cells of
+    the canonical board. Keeping every tied cell lets a lookup pick the
+    same first cell, in row-major order, as the search would for any
+    isomorph.
+    """
+
+    SNAPSHOT_MAGIC = b'TTTM'
+    SNAPSHOT_FORMAT = 1
+    # magic, format, key count, mark count, version, source file digest
+    SNAPSHOT_HEADER = struct.Struct('<4sHIH16s32s')
+
+    def __init__(self):
+        self._moves = {}
+        self._masks = None
+        self._version = None
+
+    @classmethod
+    def compile(cls, cache):
+        """
+        Build the move table for every non-terminal State in a cache
+        :param cache: (StateCache) the cache, with desirability
+        :return: (MoveTable)
+        """
+        table = cls()
+        for cached in cache:
+            key = symmetry.CANONICAL[cached.to_key()]
+            state = State.from_key(key)
+            if state.winner is not None:
+                continue
+            for mark in state.next_marks():
+                mask = table._best_cells(cache, state, mark)
+                if mask is not None:
+                    table._moves[key, mark] = mask
+        return table
+
+    @classmethod
+    def _best_cells(cls, cache, state, mark):
+        """
+        Score each move on a state as calculate_next_state_for does
+        :param cache: (StateCache) the cache, with desirability
+        :param state: (State) the state in its canonical orientation
+        :param mark: (Mark) the Mark to move
+        :return: (int) bit mask of the best cells, or None if a child is
+        missing from the cache
+        """
+        o, x = state.to_bits()
+        scores = {}
+        for cell in bitboard.moves(o, x):
+            child = State.from_key(
+                bitboard.to_key(*bitboard.place(o, x, cell, mark)))
+            cached = cache[child][0]
+            if cached is None or cached.desirability is None:
+                return None
+            gain = cached.desirability[mark]
+            loss = cached.desirability[Mark.get_next(mark)]
+            scores[cell] = max(gain, -loss)
+        best = max(scores.values())
+        return sum(1 << cell for cell, score in scores.items()
+                   if score == best)
+
+    def reply(self, key, mark):
+        """
+        Get the cell the AI plays on a board
+        :param key: (int) the board key
+        :param mark: (Mark) the Mark to move
+        :return: (int) the row-major cell index
+        """
+        canonical_key, sym = symmetry.canonical(key)
+        mask = self._mask_array().item(canonical_key, mark)
+        if not mask:
+            raise KeyError((canonical_key, mark))
+        return _FIRST_CELL[sym][mask]
+
+    def _move_dict(self):
+        """
+        Get every (canonical key, mark) mask, without the empty masks
+        :return: (dict)
+        """
+        if self._moves is None:
+            masks = self._masks
+            self._moves = {
+                (key, Mark(mark)): int(masks[key, mark])
+                for key, mark in zip(*(a.tolist()
+                                       for a in np.nonzero(masks)))}
+        return self._moves
+
+    @property
+    def version(self):
+        """
+        A digest of this table's moves, which changes whenever a reply does
+        :return: (string) 16 hex digits
+        """
+        if self._version is None:
+            digest = hashlib.sha256()
+            for (key, mark), mask in sorted(self._move_dict().items()):
+                digest.update(b'%d,%d,%d;' % (key, mark, mask))
+            self._version = digest.hexdigest()[:16]
+        return self._version
+
+    def _mask_array(self):
+        """
+        Get every (canonical key, mark) mask, 0 where there is no entry
+        :return: (ndarray) of shape (NUM_KEYS, len(Mark))
+        """
+        if self._masks is None:
+            masks = np.zeros((symmetry.NUM_KEYS, len(Mark)), dtype=np.int16)
+            for (key, mark), mask in self._moves.items():
+                masks[key, mark] = mask
+            self._masks = masks
+        return self._masks
+
+    def replies(self, keys, marks):
+        """
+        Get the cells the AI plays on many boards at once
+        :param keys: (ndarray) of board keys
+        :param marks: (ndarray) of the Marks to move, as ints
+        :return: (ndarray) of row-major cell indices, -1 where the table
+        has no reply
+        """
+        keys = np.asarray(keys, dtype=np.int32)
+        masks = self._mask_array()[_CANONICAL_ARRAY[keys], np.asarray(marks)]
+        return _FIRST_CELL_ARRAY[_SYMMETRY_ARRAY[keys], masks]
+
+    def write(self, file_path):
+        """
+        Write this table to a JSON file at the specified path
+        :param file_path: (string) file path
+        """
+        moves = {}
+        for (key, mark), mask in self._move_dict().items():
+            code = State.from_key(key).to_code1()
+            moves.setdefault(code, {})[repr(mark)] = mask
+        data = {
+            'Format': '001',
+            'Moves': dict(sorted(moves.items()))
+        }
+        with open(file_path, 'w', encoding='ascii') as fp:
+            json.dump(data, fp)
+
+    def load(self, file_path):
+        """
+        Read a JSON file at the specified path into this table
+        :param file_path: (string) file path
+        """
+        with open(file_path, 'r') as fp:
+            data = json.load(fp)
+        lookup = {repr(mark): mark for mark in Mark}
+        moves = self._move_dict()
+        for code, masks in data['Moves'].items():
+            key = State.from_code1(code).to_key()
+            for mark, mask in masks.items():
+                moves[key, lookup[mark]] = mask
+        self._masks = None
+        self._version = None
+
+    @classmethod
+    def _digest(cls, file_path):
+        with open(file_path, 'rb') as fp:
+            return hashlib.sha256(fp.read()).digest()
+
+    def write_snapshot(self, file_path, source_path=None):
+        """
+        Write this table to a snapshot file: a header and the flat array
+        of every (canonical key, mark) mask, which loads with one read.
+        The file is replaced whole, so that processes reading or mapping
+        it at the same time never see it half written.
+        :param file_path: (string) file path
+        :param source_path: (string) the file this table was loaded from,
+        whose digest marks the snapshot stale when the file changes
+        """
+        digest = bytes(32) if source_path is None \
+            else self._digest(source_path)
+        temp_path = f'{file_path}.{os.getpid()}.tmp'
+        try:
+            with open(temp_path, 'wb') as fp:
+                fp.write(self.SNAPSHOT_HEADER.pack(
+                    self.SNAPSHOT_MAGIC, self.SNAPSHOT_FORMAT,
+                    symmetry.NUM_KEYS, len(Mark),
+                    self.version.encode('ascii'), digest))
+                fp.write(self._mask_array().astype('<i2').tobytes())
+            os.replace(temp_path, file_path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+    def load_snapshot(self, file_path, source_path=None):
+        """
+        Read a snapshot file at the specified path into this table
+        :param file_path: (string) file path
+        :param source_path: (string) the file the snapshot was written
+        from, to check that it has not changed since
+        """
+        with open(file_path, 'rb') as fp:
+            data = fp.read()
+        self._use_snapshot(data, file_path, source_path)
+
+    def map_snapshot(self, file_path, source_path=None):
+        """
+        Map a snapshot file at the specified path read-only as this
+        table's masks, so that every process mapping the same file shares
+        one copy of its pages
+        :param file_path: (string) file path
+        :param source_path: (string) the file the snapshot was written
+        from, to check that it has not changed since
+        """
+        with open(file_path, 'rb') as fp:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._use_snapshot(data, file_path, source_path)
+
+    def _use_snapshot(self, data, file_path, source_path):
+        """
+        Check a snapshot and view its masks as this table's
+        :param data: (buffer) the snapshot file contents
+        :param file_path: (string) file path, for error messages
+        :param source_path: (string) the file the snapshot was written
+        from, to check that it has not changed since
+        """
+        header = self.SNAPSHOT_HEADER
+        if len(data) < header.size:
+            raise ValueError(f'{file_path} is truncated')
+        magic, _format, keys, marks, version, digest = \
+            header.unpack_from(data)
+        if magic != self.SNAPSHOT_MAGIC or _format != self.SNAPSHOT_FORMAT:
+            raise ValueError(f'{file_path} is not a move table snapshot')
+        if (keys, marks) != (symmetry.NUM_KEYS, len(Mark)):
+            raise ValueError(f'{file_path} has the wrong shape')
+        if len(data) != header.size + 2 * keys * marks:
+            raise ValueError(f'{file_path} is truncated')
+        if source_path is not None and digest != self._digest(source_path):
+            raise ValueError(f'{file_path} is older than {source_path}')
+        masks = np.frombuffer(data, dtype='<i2', offset=header.size)
+        # The move dict is built from the masks if it is ever needed
+        self._moves = None
+        self._masks = masks.reshape(keys, marks)
+        self._version = version.decode('ascii')
+
+    @classmethod
+    def from_files(cls, file_path, snapshot_path, mapped=False):
+        """
+        Load a table from its snapshot, or from its JSON file if the
+        snapshot is missing or stale, in which case the snapshot is
+        rewritten if possible
+        :param file_path: (string) the JSON file path
+        :param snapshot_path: (string) the snapshot file path
+        :param mapped: (bool) whether to map the snapshot read-only
+        rather than read it, as worker processes sharing it do
+        :return: (MoveTable)
+        """
+        table = cls()
+        read = table.map_snapshot if mapped else table.load_snapshot
+        try:
+            read(snapshot_path, file_path)
+            return table
+        except (OSError, ValueError):
+            pass
+        table.load(file_path)
+        try:
+            table.write_snapshot(snapshot_path, file_path)
+        except OSError:
+            return table
+        if mapped:
+            table.map_snapshot(snapshot_path)
+        return table
+
+    def __contains__(self, item):
+        key, mark = item
+        return bool(self._mask_array().item(symmetry.CANONICAL[key], mark))
+
+    def __len__(self):
+        if self._moves is None:
+            return int(np.count_nonzero(self._masks))
+        return len(self._moves)
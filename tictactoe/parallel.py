@@ -0,0 +1,140 @@
+"""
+Tic-Tac-Toe parallel solver module
+
+Solves the game DAG in several worker processes. The DAG is expanded one
+ply at a time and scored one ply at a time in reverse, as solve() does,
+and each ply is split between the workers by canonical key, so every
+state is expanded and scored exactly once. Between plies the workers'
+results are merged, and each worker is sent the child scores its share
+of the next ply needs.
+"""
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from tictactoe import Mark
+from . import symmetry
+from .solver import Solution, child_keys_of, score_key
+
+# The fewest states given to a worker. Smaller plies are split between
+# fewer workers, or handled in the calling process.
+MIN_SHARE = 64
+
+
+def _shares(keys, workers):
+    """
+    Split the states of a ply between workers by canonical key
+    :param keys: (list) of canonical keys
+    :param workers: (int) the number of workers
+    :return: (list) of the lists of keys of each share
+    """
+    count = max(1, min(workers, len(keys) // MIN_SHARE))
+    shares = [[] for _ in range(count)]
+    for key in keys:
+        shares[key % count].append(key)
+    return shares
+
+
+def _expand_share(keys, mark):
+    """
+    Expand a share of a ply, in a worker process
+    :param keys: (list) of canonical keys
+    :param mark: (Mark) the Mark to move
+    :return: (dict) of each key which is not won to its child keys
+    """
+    children = {}
+    for key in keys:
+        child_keys = child_keys_of(key, mark)
+        if child_keys is not None:
+            children[key] = child_keys
+    return children
+
+
+def _score_share(keys, to_move, children, scores):
+    """
+    Score a share of a ply, in a worker process
+    :param keys: (list) of canonical keys
+    :param to_move: (Mark) the Mark to move
+    :param children: (dict) of each key's child keys
+    :param scores: (dict) of each child key to its desirability and value
+    :return: (dict) of each key to its desirability and value
+    """
+    solution = Solution(None, to_move)
+    for key, (desirability, value) in scores.items():
+        solution.desirability[key] = desirability
+        solution.values[key] = value
+    for key in keys:
+        score_key(solution, key, to_move, children.get(key))
+    return {key: (solution.desirability[key], solution.values[key])
+            for key in keys}
+
+
+def solve_parallel(root_state, mark, workers=None, executor=None):
+    """
+    Solve every state reachable from a root state in parallel, giving the
+    same Solution as solve()
+    :param root_state: (State) the initial state to branch from
+    :param mark: (Mark) the Mark to move in the root state
+    :param workers: (int) the number of shares to split each ply into,
+    and of worker processes, or None for one per CPU
+    :param executor: (Executor) a pool to run the shares in, instead of
+    starting one
+    :return: (Solution)
+    """
+    start_time = time.perf_counter()
+    root_key = symmetry.CANONICAL[root_state.to_key()]
+    solution = Solution(root_key, mark)
+    workers = workers or os.cpu_count()
+    own_executor = executor is None
+
+    def run(function, shares, *args):
+        # A single share runs here, and the pool starts on first use
+        nonlocal executor
+        if len(shares) == 1:
+            return [function(shares[0], *(arg[0] for arg in args))]
+        if executor is None:
+            executor = ProcessPoolExecutor(workers)
+        return executor.map(function, shares, *args)
+
+    try:
+        levels = [[root_key]]
+        children = {}
+        seen = {root_key}
+        next_mark = mark
+        while levels[-1]:
+            shares = _shares(levels[-1], workers)
+            for share_children in run(_expand_share, shares,
+                                      [next_mark] * len(shares)):
+                children.update(share_children)
+            # The frontier keeps the order solve() finds it in
+            frontier = []
+            for key in levels[-1]:
+                for child in children.get(key, ()):
+                    if child not in seen:
+                        seen.add(child)
+                        frontier.append(child)
+            levels.append(frontier)
+            next_mark = Mark.get_next(next_mark)
+        levels.pop()
+
+        for depth in reversed(range(len(levels))):
+            to_move = mark if depth % 2 == 0 else Mark.get_next(mark)
+            shares = _shares(levels[depth], workers)
+            share_children = [{key: children[key] for key in share
+                               if key in children} for share in shares]
+            share_scores = [{child: (solution.desirability[child],
+                                     solution.values[child])
+                             for child_keys in part.values()
+                             for child in child_keys}
+                            for part in share_children]
+            for scores in run(_score_share, shares, [to_move] * len(shares),
+                              share_children, share_scores):
+                for key, (desirability, value) in scores.items():
+                    solution.desirability[key] = desirability
+                    solution.values[key] = value
+    finally:
+        if own_executor and executor is not None:
+            executor.shutdown()
+    solution.nodes = len(solution.desirability)
+    solution.seconds = time.perf_counter() - start_time
+    return solution
@@ -0,0 +1,181 @@
+"""
+Tic-Tac-Toe responses module
+
+Responses of the web game servers. The AI's reply is a pure function of
+the board and the AI's mark, so stateless replies are addressed by a
+compact board code and may be cached by any HTTP cache, and the session
+data of every reachable board is serialized ahead of time.
+"""
+
+import json
+from tictactoe import Mark, State
+from . import bitboard, symmetry
+from .metrics import CACHE_LOOKUPS
+from .board import Board
+
+# Replies never change for a given move table, whose version is part of
+# the ETag
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def parse_board(code):
+    """
+    Parse the board of a move request
+    :param code: (string) the board as a State.to_code1 string, such as
+    'X...O....', or as its decimal base-3 key
+    :return: (int) the board key
+    """
+    if code.isdigit():
+        key = int(code)
+        if key >= symmetry.NUM_KEYS:
+            raise ValueError(f'Board key out of range: {code}')
+        return key
+    if len(code) != bitboard.CELLS:
+        raise ValueError(f'Invalid board: {code}')
+    lookup = {repr(mark): mark for mark in Mark}
+    key = 0
+    for c in code.upper():
+        if c not in lookup:
+            raise ValueError(f'Invalid board: {code}')
+        key = key * 3 + lookup[c]
+    return key
+
+
+def parse_mark(code):
+    """
+    Parse the mark of a move request
+    :param code: (string) 'O' or 'X', or the int value of the Mark
+    :return: (Mark)
+    """
+    lookup = {'O': Mark.OMARK, 'X': Mark.XMARK,
+              str(int(Mark.OMARK)): Mark.OMARK,
+              str(int(Mark.XMARK)): Mark.XMARK}
+    try:
+        return lookup[code.upper()]
+    except KeyError:
+        raise ValueError(f'Invalid mark: {code}')
+
+
+def move_reply(move_table, key, mark):
+    """
+    Get the AI's reply to a board
+    :param move_table: (MoveTable) the table of AI replies
+    :param key: (int) the board key
+    :param mark: (Mark) the AI's mark
+    :return: (dict) of the board code after the reply, the row-major
+    cell played and the winner as an int Mark, as in session data; or
+    None if there is no reply to the board
+    """
+    if (key, mark) not in move_table:
+        return None
+    cell = move_table.reply(key, mark)
+    board = Board(key).play(cell, mark)
+    return {
+        'board': board.code,
+        'cell': cell,
+        'winner': board.winner,
+    }
+
+
+def etag(move_table, key, mark):
+    """
+    Get the strong ETag of a reply
+    :param move_table: (MoveTable) the table of AI replies
+    :param key: (int) the board key
+    :param mark: (Mark) the AI's mark
+    :return: (string) the quoted entity tag
+    """
+    return f'"{move_table.version}-{key}-{int(mark)}"'
+
+
+def etag_matches(if_none_match, tag):
+    """
+    Whether an If-None-Match header matches an ETag
+    :param if_none_match: (string) the header value, or None
+    :param tag: (string) the quoted entity tag
+    :return: (bool)
+    """
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(',')]
+    return '*' in tags or tag in tags or f'W/{tag}' in tags
+
+
+class ResponseCache:
+    """
+    The session data JSON of classic 3x3 boards, each serialized once, so
+    that answering a session request is usually a dictionary lookup.
+    Boards are serialized on first use, or all at once by compile().
+    Boards of other sizes are serialized on every request.
+    """
+    def __init__(self):
+        self._bodies = {}
+
+    @classmethod
+    def compile(cls):
+        """
+        Serialize the session data of every reachable 3x3 board
+        :return: (ResponseCache)
+        """
+        # Imported here, as servers which serialize boards on first use
+        # never traverse the game
+        from .traversal import is_terminal, traverse
+        responses = cls()
+        for mark in (Mark.OMARK, Mark.XMARK):
+            seen = set()
+
+            def dedup(position):
+                if position.key in seen:
+                    return False
+                seen.add(position.key)
+                return True
+
+            for position in traverse([State()], mark, order='bfs',
+                                     prune=is_terminal, dedup=dedup):
+                if position.key not in responses._bodies:
+                    responses._bodies[position.key] = _session_body(
+                        position.o, position.x)
+        return responses
+
+    def session_data(self, session):
+        """
+        Get the session data JSON of a game
+        :param session: (SessionData) the game
+        :return: (bytes)
+        """
+        if session.size == bitboard.SIZE:
+            body = self._bodies.get(session.key)
+            if body is None:
+                CACHE_LOOKUPS.inc(cache='responses', result='miss')
+                body = self._bodies[session.key] = _session_body(
+                    *bitboard.from_key(session.key))
+            else:
+                CACHE_LOOKUPS.inc(cache='responses', result='hit')
+            return body
+        return _serialize(session.to_dict())
+
+    def __contains__(self, key):
+        return key in self._bodies
+
+    def __len__(self):
+        return len(self._bodies)
+
+
+def _serialize(data):
+    return json.dumps(data).encode('utf-8')
+
+
+def _session_body(o, x):
+    """
+    Serialize the session data of a 3x3 bit board, as json.dumps would
+    serialize SessionData.to_dict
+    :param o: (int) the O bit set
+    :param x: (int) the X bit set
+    :return: (bytes)
+    """
+    cells = bitboard.to_cells(o, x)
+    rows = ', '.join('[%d, %d, %d]' % tuple(cells[i:i + bitboard.SIZE])
+                     for i in range(0, bitboard.CELLS, bitboard.SIZE))
+    winner = bitboard.winner(o, x)
+    return ('{"board": [%s], "winner": %s}' %
+            (rows, winner or 'null')).encode('utf-8')
@@ -0,0 +1,188 @@
+"""
+Tic-Tac-Toe scores module
+
+Scores of board states kept in NumPy columns indexed by canonical key,
+one column per metric, so that a whole cache is cleared, updated or
+serialized with array operations. The desirability of a cached State is
+a view of its row.
+"""
+
+from collections.abc import Mapping
+import numpy as np
+from tictactoe import Mark
+from . import symmetry
+
+# The column of each Mark's desirability
+_COLUMNS = {Mark.OMARK: 'O', Mark.XMARK: 'X'}
+# The (min, max) of each integer column type, filled as types are used
+_BOUNDS = {}
+
+
+def exact_integers(values, dtype):
+    """
+    Convert values to an integer type, refusing any value which would be
+    rounded or wrapped
+    :param values: (array_like) the values
+    :param dtype: (dtype) the integer type
+    :return: (ndarray) of the values as dtype
+    """
+    values = np.asarray(values)
+    message = f'Scores must be integers in the range of {np.dtype(dtype)}'
+    if values.dtype.kind in 'biu':
+        low, high = _bounds(dtype)
+        if values.size and (values.min() < low or values.max() > high):
+            raise ValueError(message)
+        return values.astype(dtype)
+    try:
+        with np.errstate(invalid='ignore'):
+            converted = values.astype(dtype)
+    except (OverflowError, TypeError, ValueError):
+        raise ValueError(message)
+    if not np.array_equal(converted, values):
+        raise ValueError(message)
+    return converted
+
+
+def _bounds(dtype):
+    bounds = _BOUNDS.get(dtype)
+    if bounds is None:
+        info = np.iinfo(dtype)
+        bounds = _BOUNDS[dtype] = (int(info.min), int(info.max))
+    return bounds
+
+
+class Desirability(Mapping):
+    """
+    Read-only view of the desirability of one row of a ScoreTable, which
+    behaves as the {Mark.OMARK: o, Mark.XMARK: x} dict it replaces. Once
+    the row is cleared the view is empty, and looking a Mark up raises
+    KeyError.
+    """
+    __slots__ = ('_table', '_index')
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+
+    def __getitem__(self, mark):
+        name = _COLUMNS[mark]
+        if not self._table.known[name][self._index]:
+            raise KeyError(mark)
+        return int(self._table.columns[name][self._index])
+
+    def __iter__(self):
+        return (mark for mark, name in _COLUMNS.items()
+                if self._table.known[name][self._index])
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class ScoreTable:
+    """
+    Columns of scores, one row per canonical key. Each column has a mask
+    of the rows which hold a value. The 'O' and 'X' columns hold the
+    desirability of each Mark, and 'value' the minimax value for the mark
+    to move; add_column() makes room for more. Values are integers, and
+    setting one which does not fit its column raises ValueError. A table
+    of read-only columns, such as views of a file mapped read-only,
+    raises TypeError on any change.
+    """
+    COLUMNS = (('O', np.int64), ('X', np.int64), ('value', np.int8))
+
+    def __init__(self, size=symmetry.NUM_KEYS, columns=None, known=None):
+        """
+        :param size: (int) the number of rows
+        :param columns: (dict) of column names to arrays to use instead of
+        new, empty columns, such as views of a mapped file
+        :param known: (dict) of column names to the boolean masks of the
+        rows holding a value, for the given columns
+        """
+        self.size = size
+        self.columns = dict(columns or {})
+        self.known = dict(known or {})
+        for name, dtype in self.COLUMNS:
+            if name not in self.columns:
+                self.add_column(name, dtype)
+
+    def add_column(self, name, dtype=np.int64):
+        """
+        Add an empty column
+        :param name: (string) the column name
+        :param dtype: (dtype) the type of its values
+        """
+        self.columns[name] = np.zeros(self.size, dtype=dtype)
+        self.known[name] = np.zeros(self.size, dtype=bool)
+
+    def desirability(self, index):
+        """
+        Get the desirability of a row
+        :param index: (int) the canonical key
+        :return: (Desirability) a view of the row, or None if the row has
+        no desirability
+        """
+        if not self.known['O'][index]:
+            return None
+        return Desirability(self, index)
+
+    def set_desirability(self, index, value):
+        """
+        Set the desirability of a row
+        :param index: (int) the canonical key
+        :param value: (dict) of {Mark: score}, or None to clear it
+        """
+        self._check_writeable('O', 'X')
+        if value is None:
+            self.known['O'][index] = self.known['X'][index] = False
+            return
+        scores = []
+        for mark, name in _COLUMNS.items():
+            score = value[mark]
+            dtype = self.columns[name].dtype
+            low, high = _bounds(dtype)
+            if type(score) is float and score.is_integer():
+                score = int(score)
+            if type(score) is not int or not low <= score <= high:
+                score = exact_integers(score, dtype)
+            scores.append(score)
+        for name, score in zip(_COLUMNS.values(), scores):
+            self.columns[name][index] = score
+            self.known[name][index] = True
+
+    def update(self, keys, **values):
+        """
+        Set the values of many rows at once
+        :param keys: (array_like) of canonical keys
+        :param values: (array_like) of the values of each named column,
+        in the order of the keys
+        """
+        self._check_writeable(*values)
+        keys = np.asarray(keys, dtype=np.int64)
+        values = {name: exact_integers(column, self.columns[name].dtype)
+                  for name, column in values.items()}
+        for name, column in values.items():
+            self.columns[name][keys] = column
+            self.known[name][keys] = True
+
+    def clear(self, *names):
+        """
+        Forget the values of columns
+        :param names: (string) the columns to clear, by default all of them
+        """
+        names = names or tuple(self.columns)
+        self._check_writeable(*names)
+        for name in names:
+            self.known[name][:] = False
+
+    def _check_writeable(self, *names):
+        """
+        Raise TypeError if any of the columns is read-only
+        :param names: (string) the column names
+        """
+        for name in names:
+            if not (self.columns[name].flags.writeable and
+                    self.known[name].flags.writeable):
+                raise TypeError(f'Score column {name} is read-only')
@@ -0,0 +1,213 @@
+"""
+Tic-Tac-Toe search module
+
+Game-tree search for boards too large to enumerate in a StateCache
+"""
+
+import time
+from tictactoe import Mark
+from .transposition import EXACT, LOWER, UPPER, TranspositionTable, \
+    ZobristHasher
+
+
+class SearchTimeout(Exception):
+    """
+    Raised inside a search when its time budget runs out
+    """
+    pass
+
+
+class AlphaBetaSearch:
+    """
+    Negamax search with alpha-beta pruning. The search deepens one ply at
+    a time until its time budget or max_depth is reached, and orders
+    moves by the best move stored in its transposition table, then by how
+    many winning lines pass through each cell. The table is kept between
+    searches of the same layout.
+    """
+    WIN_SCORE = 1000000
+    CHECK_INTERVAL = 1024
+
+    def __init__(self, time_budget=1.0, max_depth=None, table_size=1 << 16):
+        self.time_budget = time_budget
+        self.max_depth = max_depth
+        self.table = TranspositionTable(table_size)
+        self.nodes = 0
+        self.depth = 0
+        self._deadline = None
+        self._layout = None
+        self._hasher = None
+        self._order = ()
+        self._weights = ()
+
+    def search(self, state, mark):
+        """
+        Find the best move for a mark on a state
+        :param state: (State) the current state
+        :param mark: (Mark) the Mark to move
+        :return: (int) the row-major index of the cell to play, or None
+        if the board is full
+        """
+        self._prepare(state.layout)
+        o, x = state.to_bits()
+        mine, theirs = (o, x) if mark == Mark.OMARK else (x, o)
+        moves = self._layout.moves(o, x)
+        if not moves:
+            return None
+        self.nodes = 0
+        self.depth = 0
+        self.table.new_search()
+        self._deadline = time.perf_counter() + self.time_budget
+        max_depth = min(len(moves), self.max_depth or len(moves))
+        hashes = self._hasher.hash(o, x)
+
+        best = self._ordered(moves, None)[0]
+        for depth in range(1, max_depth + 1):
+            try:
+                # The first iteration always completes, so there is a move
+                cell, score = self._search_root(mine, theirs, hashes, mark,
+                                                moves, best, depth, depth > 1)
+            except SearchTimeout:
+                break
+            best = cell
+            self.depth = depth
+            if abs(score) >= self.WIN_SCORE - self._layout.cells:
+                break
+        return best
+
+    def _prepare(self, layout):
+        if layout is self._layout:
+            return
+        self._layout = layout
+        self._hasher = ZobristHasher(layout)
+        self.table.clear()
+        self._weights = (0,) + tuple(10 ** i for i in range(layout.win_length))
+        centrality = [len(masks) for masks in layout.cell_masks]
+        self._order = sorted(range(layout.cells), key=lambda c: -centrality[c])
+
+    def _ordered(self, moves, first):
+        """
+        Order moves for searching, most promising first
+        :param moves: (iterable) of cell indices
+        :param first: (int) a cell to search before all others, or None
+        :return: (list) of cell indices
+        """
+        moves = set(moves)
+        ordered = [c for c in self._order if c in moves and c != first]
+        return ordered if first not in moves else [first] + ordered
+
+    def _search_root(self, mine, theirs, hashes, mark, moves, first, depth,
+                     timed):
+        alpha, beta = -self.WIN_SCORE - 1, self.WIN_SCORE + 1
+        best = None
+        for cell in self._ordered(moves, first):
+            score = self._child_score(mine, theirs, hashes, mark, cell, depth,
+                                      alpha, beta, 0, timed)
+            if best is None or score > alpha:
+                best, alpha = cell, score
+        return best, alpha
+
+    def _child_score(self, mine, theirs, hashes, mark, cell, depth, alpha,
+                     beta, ply, timed):
+        """
+        Score a move from the point of view of the player making it
+        """
+        mine |= 1 << cell
+        if self._layout.wins_at(mine, cell):
+            return self.WIN_SCORE - ply
+        hashes = self._hasher.toggle(hashes, cell, mark)
+        return -self._negamax(theirs, mine, hashes, Mark.get_next(mark),
+                              depth - 1, -beta, -alpha, ply + 1, timed)
+
+    def _negamax(self, mine, theirs, hashes, mark, depth, alpha, beta, ply,
+                 timed):
+        self.nodes += 1
+        if timed and self.nodes % self.CHECK_INTERVAL == 0 and \
+                time.perf_counter() > self._deadline:
+            raise SearchTimeout()
+        empty = self._layout.full_mask & ~(mine | theirs)
+        if not empty:
+            return 0
+        if depth <= 0:
+            return self.evaluate(mine, theirs)
+
+        key, sym = self._hasher.canonical(hashes, mark)
+        entry = self.table.probe(key)
+        first = None
+        if entry is not None:
+            entry_depth, score, bound, move = entry
+            if entry_depth >= depth:
+                score = self._from_table(score, ply)
+                if bound == EXACT:
+                    return score
+                if bound == LOWER and score >= beta:
+                    return score
+                if bound == UPPER and score <= alpha:
+                    return score
+            if move is not None:
+                first = self._hasher.from_canonical_cell(move, sym)
+
+        original_alpha = alpha
+        best = None
+        for cell in self._node_order(empty, first):
+            score = self._child_score(mine, theirs, hashes, mark, cell, depth,
+                                      alpha, beta, ply, timed)
+            if best is None or score > alpha:
+                best = cell
+            if score > alpha:
+                alpha = score
+                if alpha >= beta:
+                    break
+
+        if alpha >= beta:
+            bound = LOWER
+        elif alpha > original_alpha:
+            bound = EXACT
+        else:
+            bound = UPPER
+        self.table.store(key, depth, self._to_table(alpha, ply), bound,
+                         self._hasher.to_canonical_cell(best, sym))
+        return alpha
+
+    def _node_order(self, empty, first):
+        if first is not None and empty >> first & 1:
+            yield first
+        for cell in self._order:
+            if empty >> cell & 1 and cell != first:
+                yield cell
+
+    def _to_table(self, score, ply):
+        """
+        Make a win or loss score relative to the board it is stored for,
+        rather than to the root of the search
+        """
+        if score > self.WIN_SCORE - self._layout.cells:
+            return score + ply
+        if score < self._layout.cells - self.WIN_SCORE:
+            return score - ply
+        return score
+
+    def _from_table(self, score, ply):
+        if score > self.WIN_SCORE - self._layout.cells:
+            return score - ply
+        if score < self._layout.cells - self.WIN_SCORE:
+            return score + ply
+        return score
+
+    def evaluate(self, mine, theirs):
+        """
+        Heuristic score of a position for the player to move: each line
+        still open to only one player counts for that player, weighted by
+        how many of its cells they hold
+        :param mine: (int) the bit set of the player to move
+        :param theirs: (int) the bit set of the opponent
+        :return: (int)
+        """
+        weights = self._weights
+        score = 0
+        for mask in self._layout.win_masks:
+            if not mask & theirs:
+                score += weights[bin(mask & mine).count('1')]
+            elif not mask & mine:
+                score -= weights[bin(mask & theirs).count('1')]
+        return score
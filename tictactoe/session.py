@@ -0,0 +1,579 @@
+"""
+Tic-Tac-Toe game session module
+
+The state of games played against the AI, and the stores which keep
+them for the web game servers
+"""
+
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from tictactoe import Mark, State
+from tictactoe.ai import calculate_next_board_from_table, \
+    calculate_next_keys_from_table, mcts_next_state_for, \
+    search_next_state_for
+from tictactoe.board import Board
+from tictactoe.metrics import STAGE_SECONDS, timed, timing
+
+# Session ids are written into pages as JavaScript numbers, which are
+# only exact up to 2 ** 53
+SESSION_ID_BITS = 52
+# The AI engines a game can be played against. The move table only
+# covers the classic 3x3 game.
+ENGINES = ('table', 'alphabeta', 'mcts')
+BOARD_SIZES = (3, 4, 5)
+SEARCH_TIME = float(os.environ.get('TTTAI_SEARCH_TIME', 0.5))
+# The most boards and moves one batch request may hold
+BATCH_LIMIT = 10000
+# The most moves one batch request may hold in games against a search
+# engine, which are answered one by one
+BATCH_SEARCH_LIMIT = 4
+# The Monte Carlo engine is shared by all sessions, so a game's search
+# tree is kept between moves. It is built on first use, as are the
+# alpha-beta engines, so that servers start without loading the engines.
+_MCTS_ENGINE = None
+_MCTS_LOCK = threading.Lock()
+# Alpha-beta engines keep their transposition tables between moves, but
+# search on one thread at a time, so each thread has one per layout
+_SEARCH_ENGINES = threading.local()
+
+
+def mcts_engine():
+    """
+    Get the Monte Carlo tree search engine shared by all sessions
+    :return: (MonteCarloTreeSearch)
+    """
+    global _MCTS_ENGINE
+    with _MCTS_LOCK:
+        if _MCTS_ENGINE is None:
+            from tictactoe.mcts import MonteCarloTreeSearch
+            _MCTS_ENGINE = MonteCarloTreeSearch(SEARCH_TIME)
+        return _MCTS_ENGINE
+
+
+def search_engine(layout):
+    """
+    Get the calling thread's alpha-beta engine for a board layout
+    :param layout: (Layout) the board layout
+    :return: (AlphaBetaSearch)
+    """
+    engines = getattr(_SEARCH_ENGINES, 'engines', None)
+    if engines is None:
+        engines = _SEARCH_ENGINES.engines = {}
+    engine = engines.get(layout)
+    if engine is None:
+        from tictactoe.search import AlphaBetaSearch
+        engine = engines[layout] = AlphaBetaSearch(SEARCH_TIME)
+    return engine
+
+
+class IllegalMoveError(Exception):
+    """
+    Raised when a player's move breaks the rules of the game
+    """
+    pass
+
+
+class SessionConflictError(Exception):
+    """
+    Raised when a session is saved after another request changed it
+    """
+    pass
+
+
+class SessionData:
+    """
+    A game between a player and the AI, stored as the board key, the
+    AI's mark, the rules of the board and the AI engine. The version
+    counts the saves of the game in a shared session store.
+    """
+    __slots__ = ('key', 'mark', 'size', 'win_length', 'engine', 'version')
+
+    def __init__(self, key=0, mark=None, size=3, win_length=None,
+                 engine='table', version=0):
+        self.key = key
+        self.mark = mark
+        self.size = size
+        self.win_length = win_length or size
+        self.engine = engine
+        self.version = version
+
+    @classmethod
+    def from_options(cls, size=None, win_length=None, engine=None):
+        """
+        Start a game with options chosen by a player
+        :param size: (int) the number of rows and columns, or None for 3
+        :param win_length: (int) the marks in a row needed to win, or None
+        for the board size
+        :param engine: (string) one of ENGINES, or None for the best engine
+        available for the board
+        :return: (SessionData)
+        """
+        size = int(size or 3)
+        win_length = int(win_length or size)
+        if size not in BOARD_SIZES:
+            raise ValueError(f'Unsupported board size {size}')
+        if not 3 <= win_length <= size:
+            raise ValueError(f'Unsupported win length {win_length}')
+        classic = size == win_length == 3
+        if engine is None:
+            engine = 'table' if classic else 'alphabeta'
+        if engine not in ENGINES or engine == 'table' and not classic:
+            raise ValueError(f'Unsupported engine {engine}')
+        return cls(size=size, win_length=win_length, engine=engine)
+
+    @property
+    @timed(STAGE_SECONDS, stage='state')
+    def state(self):
+        """
+        The current board of this game
+        :return: (State)
+        """
+        return State.from_key(self.key, self.size, self.win_length)
+
+    @state.setter
+    def state(self, value):
+        self.key = value.to_key()
+
+    def set_mark(self, move_table, player_mark, row, col):
+        """
+        Play a player's move and then the AI's reply
+        :param move_table: (MoveTable) the table of AI replies
+        :param player_mark: (Mark) the player's mark
+        :param row: (int)
+        :param col: (int)
+        """
+        state = self.play(player_mark, row, col)
+        if state.winner is None:
+            try:
+                state = self.reply(move_table, state)
+            except ValueError:
+                pass
+        self.state = state
+
+    def check_move(self, player_mark, row, col):
+        """
+        Check a player's move without playing it
+        :param player_mark: (Mark) the player's mark
+        :param row: (int)
+        :param col: (int)
+        :return: (State) the board before the move, an interned Board in
+        games against the move table
+        """
+        # Games against the move table are played on interned Boards, so
+        # their moves build no new boards
+        state = Board(self.key) if self.engine == 'table' else self.state
+        next_mark = Mark.get_next(player_mark)
+        if next_mark is None or \
+                not (0 <= row < self.size and 0 <= col < self.size):
+            raise IllegalMoveError('Illegal board move!')
+        wrong_mark = self.mark is not None and self.mark != next_mark
+        overwrite = state.get_mark(row, col) != Mark.EMPTY
+        if wrong_mark or overwrite:
+            raise IllegalMoveError('Illegal board move!')
+        return state
+
+    def play(self, player_mark, row, col):
+        """
+        Play a player's move, without the AI's reply. The session is left
+        unchanged if the move is illegal.
+        :param player_mark: (Mark) the player's mark
+        :param row: (int)
+        :param col: (int)
+        :return: (State) the board after the move, an interned Board in
+        games against the move table
+        """
+        state = self.check_move(player_mark, row, col)
+        if self.mark is None:
+            self.mark = Mark.get_next(player_mark)
+        if self.engine == 'table':
+            state = state.play(row * self.size + col, player_mark)
+        else:
+            state.set_mark(row, col, player_mark)
+        self.state = state
+        return state
+
+    def reply(self, move_table, state):
+        """
+        Get the AI's reply on a board of this game
+        :param move_table: (MoveTable) the table of AI replies
+        :param state: (State) the board, which is not finished
+        :return: (State) the board after the reply
+        """
+        if self.engine == 'table':
+            return calculate_next_board_from_table(
+                move_table, Board.from_state(state), self.mark)
+        if self.engine == 'mcts':
+            return mcts_next_state_for(state, self.mark, engine=mcts_engine())
+        return search_next_state_for(state, self.mark,
+                                     engine=search_engine(state.layout))
+
+    def submit(self, move_table, verb, args):
+        """
+        Handle a request made by the game front end
+        :param move_table: (MoveTable) the table of AI replies
+        :param verb: (string) the request verb
+        :param args: (dict) the request arguments
+        """
+        if verb.lower() == 'set-mark':
+            self.set_mark(move_table, Mark(args['mark']),
+                          int(args['row']), int(args['column']))
+
+    def to_dict(self):
+        """
+        Get the serializable board and winner of this game
+        :return: (dict)
+        """
+        state = self.state
+        return {
+            'board': state[:].tolist(),
+            'winner': state.winner
+        }
+
+
+def submit_form(move_table, session, form):
+    """
+    Handle a form posted by the game front end, whose 'verb' field names
+    the request and whose 'args' field holds its arguments as JSON. The
+    session is left unchanged if the request is bad.
+    :param move_table: (MoveTable) the table of AI replies
+    :param session: (SessionData) the game
+    :param form: (Mapping) of the form fields
+    :return: (string) why the request is bad, or None once it is handled
+    """
+    try:
+        with timing(STAGE_SECONDS, stage='parse'):
+            verb = form.get('verb') or ''
+            args = json.loads(form.get('args') or '{}')
+        session.submit(move_table, verb, args)
+    except IllegalMoveError as e:
+        return str(e)
+    except (KeyError, TypeError, ValueError):
+        return 'Invalid request'
+    return None
+
+
+def submit_batch(move_table, sessions, data):
+    """
+    Reply to many moves in one request. Classic 3x3 boards are answered
+    together through the move table; other sessions are answered one by
+    one by their engine, at most BATCH_SEARCH_LIMIT of them per batch.
+    :param move_table: (MoveTable) the table of AI replies
+    :param sessions: (SessionStore) the store of game sessions
+    :param data: (dict) with an optional 'games' list of {'board': code,
+    'mark': int} boards given by State.to_code1 code, and an optional
+    'moves' list of {'session': id, 'mark': int, 'row': int,
+    'column': int} moves to play in sessions
+    :return: (dict) with the 'games' and 'moves' replies in request order,
+    each holding the board after the reply and the winner, or an 'error'
+    """
+    requested_games = data.get('games', [])
+    requested_moves = data.get('moves', [])
+    if not isinstance(requested_games, list) or \
+            not isinstance(requested_moves, list) or \
+            not all(isinstance(entry, dict)
+                    for entry in requested_games + requested_moves):
+        raise ValueError('Expected lists of games and moves')
+    if len(requested_games) + len(requested_moves) > BATCH_LIMIT:
+        raise ValueError(f'Batches are limited to {BATCH_LIMIT} entries')
+    games = []
+    keys = []
+    marks = []
+    for game in requested_games:
+        try:
+            state = State.from_code1(game['board'])
+            mark = Mark(game['mark'])
+            if state.size != 3 or mark == Mark.EMPTY:
+                raise ValueError()
+        except (KeyError, TypeError, ValueError):
+            games.append({'error': 'Invalid board or mark'})
+            continue
+        games.append(None)
+        keys.append(state.to_key())
+        marks.append(mark)
+    next_keys = iter(calculate_next_keys_from_table(move_table, keys, marks))
+    for i, reply in enumerate(games):
+        if reply is not None:
+            continue
+        key = int(next(next_keys))
+        if key < 0:
+            games[i] = {'error': 'No reply for this board'}
+        else:
+            state = State.from_key(key)
+            games[i] = {'board': state.to_code1(), 'winner': state.winner}
+
+    # Every move is checked before any session is played, so that no
+    # session changes unless its move is answered
+    moves = []
+    played = {}
+    searches = 0
+    for move in requested_moves:
+        try:
+            sid = int(move.get('session'))
+        except (TypeError, ValueError):
+            sid = None
+        session = sessions.get(sid) if sid is not None else None
+        if session is None or sid in played:
+            # A session can only move once in each batch
+            error = 'Not found.' if session is None else 'Duplicate session'
+            moves.append({'session': move.get('session'), 'error': error})
+            continue
+        try:
+            player_mark = Mark(move['mark'])
+            row, col = int(move['row']), int(move['column'])
+            session.check_move(player_mark, row, col)
+        except IllegalMoveError as e:
+            moves.append({'session': sid, 'error': str(e)})
+            continue
+        except (KeyError, TypeError, ValueError):
+            moves.append({'session': sid, 'error': 'Invalid move'})
+            continue
+        if session.engine != 'table':
+            # Searches take SEARCH_TIME each, so few run in one batch
+            if searches == BATCH_SEARCH_LIMIT:
+                moves.append({'session': sid,
+                              'error': 'Too many searches in one batch'})
+                continue
+            searches += 1
+        moves.append(sid)
+        played[sid] = (session, (player_mark, row, col))
+
+    open_sessions = {}
+    for sid, (session, move) in played.items():
+        state = session.play(*move)
+        if state.winner is None and not state.is_full:
+            open_sessions[sid] = session
+    # Sessions played with the move table reply in one batch
+    table_sessions = [session for session in open_sessions.values()
+                      if session.engine == 'table']
+    next_keys = calculate_next_keys_from_table(
+        move_table, [session.key for session in table_sessions],
+        [session.mark for session in table_sessions])
+    for session, key in zip(table_sessions, next_keys.tolist()):
+        if key >= 0:
+            session.key = key
+    for i, sid in enumerate(moves):
+        if isinstance(sid, dict):
+            continue
+        session = played[sid][0]
+        if sid in open_sessions and session.engine != 'table':
+            session.state = session.reply(move_table, session.state)
+        try:
+            sessions.save(sid, session)
+        except SessionConflictError as e:
+            moves[i] = {'session': sid, 'error': str(e)}
+            continue
+        moves[i] = dict(session.to_dict(), session=sid)
+    return {'games': games, 'moves': moves}
+
+
+class SessionStore:
+    """
+    In-memory store of game sessions. Sessions unused for longer than
+    the TTL are evicted, as are the least recently used sessions once the
+    store holds max_size of them.
+    """
+    def __init__(self, max_size=10000, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._expired = 0
+        self._dropped = 0
+
+    @classmethod
+    def _new_id(cls):
+        return secrets.randbits(SESSION_ID_BITS)
+
+    def create(self, session=None):
+        """
+        Start a new session
+        :param session: (SessionData) the new game, or None for a 3x3 game
+        :return: (tuple) of the session id and the SessionData
+        """
+        session = session or SessionData()
+        with self._lock:
+            self._evict_expired()
+            while len(self._sessions) >= self.max_size:
+                self._sessions.popitem(last=False)
+                self._dropped += 1
+            sid = self._new_id()
+            while sid in self._sessions:
+                sid = self._new_id()
+            self._sessions[sid] = (session, time.monotonic())
+            self._created += 1
+        return sid, session
+
+    def get(self, sid):
+        """
+        Get a live session, marking it as recently used
+        :param sid: (int) the session id
+        :return: (SessionData) the session, or None if there is none
+        """
+        with self._lock:
+            self._evict_expired()
+            entry = self._sessions.get(sid)
+            if entry is None:
+                return None
+            self._sessions[sid] = (entry[0], time.monotonic())
+            self._sessions.move_to_end(sid)
+            return entry[0]
+
+    def save(self, sid, session):
+        """
+        Write back a session changed after it was retrieved
+        :param sid: (int) the session id
+        :param session: (SessionData) the session
+        """
+        # Sessions are held by reference, so there is nothing to write
+        pass
+
+    def _evict_expired(self):
+        deadline = time.monotonic() - self.ttl
+        while self._sessions:
+            sid, (session, accessed) = next(iter(self._sessions.items()))
+            if accessed > deadline:
+                break
+            del self._sessions[sid]
+            self._expired += 1
+
+    def metrics(self):
+        """
+        Get the session counts of this store
+        :return: (dict) of live, created and evicted session counts
+        """
+        return {
+            'live': len(self),
+            'created': self._created,
+            'expired': self._expired,
+            'dropped': self._dropped,
+        }
+
+    def __contains__(self, sid):
+        with self._lock:
+            self._evict_expired()
+            return sid in self._sessions
+
+    def __len__(self):
+        with self._lock:
+            self._evict_expired()
+            return len(self._sessions)
+
+
+class SqliteSessionStore(SessionStore):
+    """
+    Session store kept in a SQLite database file, so that several worker
+    processes can share sessions. Each save bumps the session's version,
+    and a save of a session which was changed by another request since it
+    was retrieved raises SessionConflictError rather than overwriting it.
+    """
+    def __init__(self, file_path, max_size=10000, ttl=3600):
+        super().__init__(max_size, ttl)
+        self._db = sqlite3.connect(file_path, timeout=30,
+                                   check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute('CREATE TABLE IF NOT EXISTS sessions ('
+                         'id INTEGER PRIMARY KEY, key INTEGER NOT NULL, '
+                         'mark INTEGER, size INTEGER NOT NULL, '
+                         'win_length INTEGER NOT NULL, engine TEXT NOT NULL, '
+                         'accessed REAL NOT NULL, '
+                         'version INTEGER NOT NULL DEFAULT 0)')
+        columns = [row[1] for row in
+                   self._db.execute('PRAGMA table_info(sessions)')]
+        if 'version' not in columns:
+            # Databases written before sessions were versioned
+            self._db.execute('ALTER TABLE sessions ADD COLUMN '
+                             'version INTEGER NOT NULL DEFAULT 0')
+        self._db.execute('CREATE INDEX IF NOT EXISTS sessions_accessed '
+                         'ON sessions (accessed)')
+
+    def create(self, session=None):
+        session = session or SessionData()
+        with self._lock:
+            now = time.time()
+            self._evict_expired()
+            count = self._count()
+            if count >= self.max_size:
+                cursor = self._db.execute(
+                    'DELETE FROM sessions WHERE id IN (SELECT id FROM '
+                    'sessions ORDER BY accessed LIMIT ?)',
+                    (count - self.max_size + 1,))
+                self._dropped += cursor.rowcount
+            while True:
+                sid = self._new_id()
+                try:
+                    self._db.execute(
+                        'INSERT INTO sessions (id, key, mark, size, '
+                        'win_length, engine, accessed, version) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        (sid, session.key, session.mark, session.size,
+                         session.win_length, session.engine, now,
+                         session.version))
+                    break
+                except sqlite3.IntegrityError:
+                    continue
+            self._created += 1
+        return sid, session
+
+    def get(self, sid):
+        with self._lock:
+            self._evict_expired()
+            row = self._db.execute('SELECT key, mark, size, win_length, '
+                                   'engine, version FROM sessions '
+                                   'WHERE id = ?', (sid,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute('UPDATE sessions SET accessed = ? WHERE id = ?',
+                             (time.time(), sid))
+        key, mark, size, win_length, engine, version = row
+        return SessionData(key, None if mark is None else Mark(mark),
+                           size, win_length, engine, version)
+
+    def save(self, sid, session):
+        with self._lock:
+            cursor = self._db.execute(
+                'UPDATE sessions SET key = ?, mark = ?, accessed = ?, '
+                'version = version + 1 WHERE id = ? AND version = ?',
+                (session.key, session.mark, time.time(), sid,
+                 session.version))
+        if cursor.rowcount != 1:
+            raise SessionConflictError('Session changed or expired')
+        session.version += 1
+
+    def __contains__(self, sid):
+        with self._lock:
+            self._evict_expired()
+            return self._db.execute('SELECT 1 FROM sessions WHERE id = ?',
+                                    (sid,)).fetchone() is not None
+
+    def _evict_expired(self):
+        cursor = self._db.execute('DELETE FROM sessions WHERE accessed <= ?',
+                                  (time.time() - self.ttl,))
+        self._expired += max(cursor.rowcount, 0)
+
+    def _count(self):
+        return self._db.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+    def __len__(self):
+        with self._lock:
+            self._evict_expired()
+            return self._count()
+
+
+def make_session_store(file_path=None, max_size=10000, ttl=3600):
+    """
+    Create a session store
+    :param file_path: (string) path of a SQLite database to share
+    sessions through, or None to keep them in memory
+    :param max_size: (int) the most sessions to keep
+    :param ttl: (float) seconds after which an unused session is evicted
+    :return: (SessionStore)
+    """
+    if file_path:
+        return SqliteSessionStore(file_path, max_size, ttl)
+    return SessionStore(max_size, ttl)
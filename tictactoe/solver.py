@@ -0,0 +1,334 @@
+"""
+Tic-Tac-Toe solver module
+
+Iterative, memoized solver for the desirability of every state reachable
+from a root state
+"""
+
+import time
+from tictactoe import Mark, State
+from . import bitboard, symmetry
+from .board import Board
+
+
+class Solution:
+    """
+    The solved values of every canonical state reachable from a root
+    state, keyed by canonical board key
+    """
+    def __init__(self, root_key, mark):
+        self.root_key = root_key
+        self.mark = mark
+        self.desirability = {}
+        self.values = {}
+        self.nodes = 0
+        self.seconds = 0.0
+
+    def get_desirability(self, key):
+        """
+        Get the desirability of a state as a State.desirability dict
+        :param key: (int) the canonical board key
+        :return: (dict) of {Mark: score}
+        """
+        o_des, x_des = self.desirability[key]
+        return {Mark.OMARK: o_des, Mark.XMARK: x_des}
+
+    def apply(self, cache, include_root=False):
+        """
+        Store the solved desirability and values in the score columns of
+        a cache, adding any States that are missing
+        :param cache: (StateCache) the cache
+        :param include_root: (bool) whether to also update the root
+        state, which cache_state_desirability leaves to the caller
+        """
+        keys = [key for key in self.desirability
+                if include_root or key != self.root_key]
+        for key in keys:
+            if not cache.contains_key(key):
+                cache.add(State.from_key(key))
+        o_des, x_des = zip(*(self.desirability[key] for key in keys)) \
+            if keys else ((), ())
+        cache.scores.update(keys, O=o_des, X=x_des,
+                            value=[self.values[key] for key in keys])
+
+    def __repr__(self):
+        return (f'Solution({self.nodes} nodes from {self.mark!r} in '
+                f'{round(1000 * self.seconds)} ms)')
+
+
+def _terminal(o, x, mark):
+    """
+    Score a state with no further moves
+    :param o: (int) the O bit set
+    :param x: (int) the X bit set
+    :param mark: (Mark) the mark to move
+    :return: (tuple) of the (O, X) desirability and the minimax value
+    for the mark to move, or None if the game continues
+    """
+    winner = bitboard.winner(o, x)
+    if winner:
+        o_des = 1 if winner == Mark.OMARK else -1
+        return (o_des, -o_des), 1 if winner == mark else -1
+    if bitboard.is_full(o, x):
+        return (0, 0), 0
+    return None
+
+
+def solve(root_state, mark):
+    """
+    Solve every state reachable from a root state. The game DAG is
+    walked once, level by level in order of move count, and each
+    canonical state is expanded exactly once. Desirability is the sum of
+    the desirability of the distinct canonical children, as computed by
+    cache_state_desirability; the value is the minimax outcome (1 win,
+    0 draw, -1 loss) for the mark to move.
+    :param root_state: (State) the initial state to branch from
+    :param mark: (Mark) the Mark to move in the root state
+    :return: (Solution)
+    """
+    start_time = time.perf_counter()
+    root_key = symmetry.CANONICAL[root_state.to_key()]
+    solution = Solution(root_key, mark)
+    levels, children = expand(root_key, mark)
+    solution.nodes = sum(len(level) for level in levels)
+    score(solution, levels, children)
+    solution.seconds = time.perf_counter() - start_time
+    return solution
+
+
+def expand(root_key, mark, max_depth=None):
+    """
+    Walk the game DAG one ply at a time from a canonical root state,
+    expanding each canonical state exactly once
+    :param root_key: (int) the canonical key of the root state
+    :param mark: (Mark) the Mark to move in the root state
+    :param max_depth: (int) the ply to stop at, or None to walk the
+    whole game
+    :return: (tuple) of the list of canonical keys at each ply, and a
+    dict of each expanded key to the list of its distinct child keys
+    """
+    children = {}
+    seen = {root_key}
+    levels = [[root_key]]
+    next_mark = mark
+    while levels[-1] and (max_depth is None or len(levels) <= max_depth):
+        frontier = []
+        for key in levels[-1]:
+            child_keys = child_keys_of(key, next_mark)
+            if child_keys is None:
+                continue
+            for child in child_keys:
+                if child not in seen:
+                    seen.add(child)
+                    frontier.append(child)
+            children[key] = child_keys
+        levels.append(frontier)
+        next_mark = Mark.get_next(next_mark)
+    if not levels[-1]:
+        levels.pop()
+    return levels, children
+
+
+def child_keys_of(key, mark):
+    """
+    Get the distinct canonical children of a canonical state
+    :param key: (int) the canonical key
+    :param mark: (Mark) the Mark to move
+    :return: (list) of canonical keys, or None if the state is won
+    """
+    o, x = bitboard.from_key(key)
+    if bitboard.winner(o, x):
+        return None
+    child_keys = []
+    for cell in bitboard.moves(o, x):
+        child = bitboard.to_key(*bitboard.place(o, x, cell, mark))
+        child = symmetry.CANONICAL[child]
+        if child not in child_keys:
+            child_keys.append(child)
+    return child_keys
+
+
+def score_key(solution, key, to_move, child_keys, evaluate=None):
+    """
+    Score one state of an expanded DAG whose children are scored
+    :param solution: (Solution) the solution holding the children's
+    scores, to add the state's score to
+    :param key: (int) the canonical key
+    :param to_move: (Mark) the Mark to move in the state
+    :param child_keys: (list) of the canonical keys of its children
+    :param evaluate: (function) scoring finished States, see score()
+    """
+    terminal = _terminal(*bitboard.from_key(key), to_move)
+    if terminal is not None:
+        desirability, value = terminal
+        if evaluate is not None:
+            desirability = _evaluate(evaluate, key)
+    else:
+        desirability = (
+            sum(solution.desirability[k][0] for k in child_keys),
+            sum(solution.desirability[k][1] for k in child_keys))
+        value = max(-solution.values[k] for k in child_keys)
+    solution.desirability[key] = desirability
+    solution.values[key] = value
+
+
+def score(solution, levels, children, evaluate=None):
+    """
+    Score the levels of an expanded DAG in reverse, children before their
+    parents. States the solution already holds are not scored again.
+    :param solution: (Solution) the solution to add the scores to
+    :param levels: (list) of the canonical keys at each ply
+    :param children: (dict) of each expanded key to its child keys
+    :param evaluate: (function) scoring the desirability of a finished
+    board as State.calculate_desirability does, or None for the default
+    of 1 for a win, -1 for a loss and 0 for a draw. It is given the
+    interned Board of each board, which is read like a State.
+    """
+    mark = solution.mark
+    for depth in reversed(range(len(levels))):
+        to_move = mark if depth % 2 == 0 else Mark.get_next(mark)
+        for key in levels[depth]:
+            if key not in solution.desirability:
+                score_key(solution, key, to_move, children.get(key),
+                          evaluate)
+
+
+def _evaluate(evaluate, key):
+    """
+    Score the desirability of a finished board with a scoring function
+    :param evaluate: (function) of a Board to a dict of {Mark: score}
+    :param key: (int) the board key
+    :return: (tuple) of the (O, X) desirability
+    """
+    desirability = evaluate(Board(key))
+    return desirability[Mark.OMARK], desirability[Mark.XMARK]
+
+
+class DependencyGraph:
+    """
+    A solved game DAG which keeps the parent links of every canonical
+    state, so that when the scores of some states change, only their
+    ancestors are scored again rather than the whole game
+    """
+    def __init__(self, solution, levels, children):
+        """
+        :param solution: (Solution) the scored DAG
+        :param levels: (list) of the canonical keys at each ply
+        :param children: (dict) of each expanded key to its child keys
+        """
+        self.solution = solution
+        self.levels = levels
+        self.children = children
+        self.depth = {key: depth for depth, level in enumerate(levels)
+                      for key in level}
+        self.parents = {}
+        for parent, child_keys in children.items():
+            for key in child_keys:
+                self.parents.setdefault(key, []).append(parent)
+        # The number of states given a new score or scored again by the
+        # last update
+        self.touched = 0
+
+    @classmethod
+    def solve(cls, root_state, mark, evaluate=None):
+        """
+        Solve every state reachable from a root state, as solve() does,
+        keeping the DAG
+        :param root_state: (State) the initial state to branch from
+        :param mark: (Mark) the Mark to move in the root state
+        :param evaluate: (function) scoring finished States, see score()
+        :return: (DependencyGraph)
+        """
+        start_time = time.perf_counter()
+        root_key = symmetry.CANONICAL[root_state.to_key()]
+        solution = Solution(root_key, mark)
+        levels, children = expand(root_key, mark)
+        solution.nodes = sum(len(level) for level in levels)
+        score(solution, levels, children, evaluate)
+        solution.seconds = time.perf_counter() - start_time
+        return cls(solution, levels, children)
+
+    @classmethod
+    def expand(cls, root_state, mark):
+        """
+        Expand every state reachable from a root state without scoring
+        them, for seed() to score from known scores. Its solution holds
+        no values.
+        :param root_state: (State) the initial state to branch from
+        :param mark: (Mark) the Mark to move in the root state
+        :return: (DependencyGraph)
+        """
+        root_key = symmetry.CANONICAL[root_state.to_key()]
+        solution = Solution(root_key, mark)
+        levels, children = expand(root_key, mark)
+        solution.nodes = sum(len(level) for level in levels)
+        return cls(solution, levels, children)
+
+    def seed(self, desirability):
+        """
+        Score the DAG from known scores, such as those a cache holds.
+        States without a known score are scored from their children.
+        :param desirability: (dict) of canonical keys to (O, X) tuples
+        """
+        scores = self.solution.desirability
+        for key in (key for level in reversed(self.levels) for key in level):
+            if key in desirability:
+                scores[key] = desirability[key]
+                continue
+            child_keys = self.children.get(key)
+            if not child_keys:
+                raise LookupError(f'No score for the finished state {key}')
+            scores[key] = (sum(scores[k][0] for k in child_keys),
+                           sum(scores[k][1] for k in child_keys))
+
+    def leaves(self):
+        """
+        Get the finished states of the DAG, which have no children
+        :return: (list) of canonical keys
+        """
+        return [key for key in self.depth if not self.children.get(key)]
+
+    def update(self, desirability):
+        """
+        Set the desirability of some states, and score again those of
+        their ancestors, deepest first, stopping wherever a score is left
+        unchanged
+        :param desirability: (dict) of canonical keys to (O, X) tuples
+        :return: (set) of the canonical keys whose desirability changed
+        """
+        scores = self.solution.desirability
+        changed = set()
+        dirty = {}
+
+        def changed_score(key, value):
+            scores[key] = value
+            changed.add(key)
+            for parent in self.parents.get(key, ()):
+                dirty.setdefault(self.depth[parent], set()).add(parent)
+
+        self.touched = 0
+        for key, value in desirability.items():
+            if scores[key] != value:
+                self.touched += 1
+                changed_score(key, value)
+        # Parents are one ply above their children, so a level is scored
+        # once every level below it is final
+        while dirty:
+            for key in dirty.pop(max(dirty)):
+                self.touched += 1
+                child_keys = self.children[key]
+                value = (sum(scores[k][0] for k in child_keys),
+                         sum(scores[k][1] for k in child_keys))
+                if scores[key] != value:
+                    changed_score(key, value)
+        return changed
+
+    def rescore(self, evaluate):
+        """
+        Score the finished states again with a new scoring function, and
+        update their ancestors
+        :param evaluate: (function) scoring finished States, see score()
+        :return: (set) of the canonical keys whose desirability changed
+        """
+        return self.update({key: _evaluate(evaluate, key)
+                            for key in self.leaves()})
@@ -0,0 +1,105 @@
+"""
+Symmetry Module
+
+Precomputed tables for mapping any board to its canonical isomorph. A
+board is identified by its base-3 key (see bitboard.to_key) and each of
+the eight geometrical symmetries by its index into ISO_XFORMS.
+"""
+
+import numpy as np
+from .util import apply_xforms, rot180, rot270
+
+SIZE = 3
+CELLS = SIZE * SIZE
+NUM_KEYS = 3 ** CELLS
+
+# Transformation and inverse transformation sequences for generating all
+# geometrical isomorphs of a game state
+ISO_XFORMS = (
+    ([], []),  # Identity
+    ([np.fliplr], [np.fliplr]),
+    ([np.flipud], [np.flipud]),
+    ([np.rot90], [rot270]),
+    ([rot180], [rot180]),
+    ([rot270], [np.rot90]),
+    ([np.rot90, np.fliplr], [np.fliplr, rot270]),
+    ([rot270, np.fliplr], [np.fliplr, np.rot90]),
+)
+
+
+def _permutation(xforms, size=SIZE):
+    """
+    Get the cell permutation performed by a transformation sequence
+    :param xforms: (iterable) of transformation functions
+    :param size: (int) the number of rows (and columns) of the board
+    :return: (tuple) p where the transformed board has cell p[i] of the
+    original board at cell i
+    """
+    cells = np.arange(size * size).reshape(size, size)
+    return tuple(int(i) for i in apply_xforms(xforms, cells).flatten())
+
+
+def permutations(size):
+    """
+    Get the cell permutations of the symmetries of a square board
+    :param size: (int) the number of rows (and columns) of the board
+    :return: (tuple) of permutations, in the order of ISO_XFORMS
+    """
+    return tuple(_permutation(xf, size) for xf, _ in ISO_XFORMS)
+
+
+PERMUTATIONS = permutations(SIZE)
+INVERSES = tuple(PERMUTATIONS.index(_permutation(ixf))
+                 for _, ixf in ISO_XFORMS)
+# COMPOSE[s][t] is the symmetry applying s and then t
+COMPOSE = tuple(tuple(PERMUTATIONS.index(tuple(ps[i] for i in pt))
+                      for pt in PERMUTATIONS)
+                for ps in PERMUTATIONS)
+
+_POWERS = 3 ** np.arange(CELLS - 1, -1, -1)
+
+
+def _build_tables():
+    """
+    Compute the key of every isomorph of every possible board
+    :return: (ndarray) of shape (NUM_KEYS, 8)
+    """
+    keys = np.arange(NUM_KEYS)
+    digits = keys[:, np.newaxis] // _POWERS % 3
+    return digits[:, PERMUTATIONS] @ _POWERS
+
+
+_ISO_KEYS = _build_tables()
+CANONICAL = _ISO_KEYS.min(axis=1).tolist()
+SYMMETRY = _ISO_KEYS.argmin(axis=1).tolist()
+
+
+def canonical(key):
+    """
+    Get the canonical form of a board
+    :param key: (int) the board key
+    :return: (tuple) of the canonical key and the index of the symmetry
+    which maps the board onto it
+    """
+    return CANONICAL[key], SYMMETRY[key]
+
+
+def transform(key, sym):
+    """
+    Get the key of a board after applying a symmetry
+    :param key: (int) the board key
+    :param sym: (int) the symmetry index
+    :return: (int) the transformed board key
+    """
+    return int(_ISO_KEYS[key, sym])
+
+
+def relate(key, other_key):
+    """
+    Get the symmetry which maps one board onto an isomorphic board
+    :param key: (int) the key of the board to transform
+    :param other_key: (int) the key of the target board
+    :return: (int) the symmetry index
+    """
+    assert(CANONICAL[key] == CANONICAL[other_key])
+    return COMPOSE[SYMMETRY[key]][INVERSES[SYMMETRY[other_key]]]
@@ -4,13 +4,46 @@ Tic-Tac-Toe unit tests
 Tests various classes and functions in the tictactoe modules
 """
 
-from unittest import TestCase
-from tictactoe import Mark, State
-from tictactoe.ai import branch, calculate_next_state_for
-from tictactoe.cache import StateCache
+from unittest import TestCase, mock
+from tictactoe import Mark, State, BitState
+from tictactoe.ai import branch, branch1, branch_unique, \
+    cache_dependency_graphs, calculate_next_state_for, \
+    calculate_next_state_from_table, mcts_next_state_for, rescore_cache, \
+    search_next_state_for
+from tictactoe.mcts import MonteCarloTreeSearch, line_cells, rollouts
+from tictactoe.board import Board
+from tictactoe.movetable import MoveTable
+from tictactoe.search import AlphaBetaSearch
+from tictactoe.responses import ResponseCache
+from tictactoe.traversal import Position, canonical_dedup, is_terminal, \
+    traverse
+from tictactoe.transposition import EXACT, LOWER, TranspositionTable, \
+    ZobristHasher
+from tictactoe.session import BATCH_SEARCH_LIMIT, SessionConflictError, \
+    SessionData, SessionStore, SqliteSessionStore, search_engine, \
+    submit_batch
+from tictactoe.cache import LazyStateCache, MappedCacheFile, \
+    SharedStateCache, StateCache, generate_cache_file
+from tictactoe.solver import DependencyGraph, solve
+from tictactoe.parallel import solve_parallel
+from tictactoe.batch import BoardBatch
+from tictactoe.metrics import Registry, SamplingProfiler, StartupTimer
+from tictactoe import batch
 from tictactoe.util import apply_xforms
+from tictactoe import symmetry
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
+import asyncio
+import copy
+import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import threading
+from urllib.parse import urlencode
 
 
 class TicTacToeTester(TestCase):
@@ -42,8 +75,168 @@ class TicTacToeTester(TestCase):
         cached, xf, ixf = cache[state1_iso]
         self.assertEqual(self.state1, cached)
 
+    def test_cache_lookup_permutation(self):
+        for state in StateCache._get_isomorphs(self.state1):
+            cached, sym = self.cache.lookup(state)
+            perm = symmetry.PERMUTATIONS[sym]
+            cells = cached[:].flatten()
+            self.assertEqual(list(state[:].flatten()),
+                             [cells[i] for i in perm])
+
+    def test_score_columns(self):
+        cached = self.cache[self.state1][0]
+        key = symmetry.CANONICAL[self.state1.to_key()]
+        desirability = dict(cached.desirability)
+        self.assertEqual(cached.desirability[Mark.OMARK],
+                         self.cache.scores.columns['O'][key])
+        # Writes go to the columns, and so to every State of the row
+        cached.desirability = {Mark.OMARK: 5, Mark.XMARK: -5}
+        self.assertEqual(self.cache[self.state1][0].desirability,
+                         {Mark.OMARK: 5, Mark.XMARK: -5})
+        cached.desirability = desirability
+        # A State changed after lookup keeps its desirability to itself
+        changed = State.from_key(self.state1.to_key())
+        changed.bind_scores(self.cache.scores, key)
+        changed.set_mark(2, 2, Mark.XMARK)
+        changed.desirability = None
+        self.assertEqual(cached.desirability, desirability)
+        # Solving fills the columns, and clearing empties them at once
+        cache = StateCache()
+        solution = solve(State(), Mark.OMARK)
+        solution.apply(cache)
+        self.assertEqual(len(cache), len(solution.desirability) - 1)
+        for state in list(cache)[::50]:
+            key = symmetry.CANONICAL[state.to_key()]
+            self.assertEqual(state.desirability,
+                             solution.get_desirability(key))
+            self.assertEqual(cache.scores.columns['value'][key],
+                             solution.values[key])
+        view = next(iter(cache)).desirability
+        cache.clear_desirability()
+        self.assertTrue(all(s.desirability is None for s in cache))
+        # Views taken before the clear hold no stale scores
+        self.assertEqual(dict(view), {})
+        with self.assertRaises(KeyError):
+            view[Mark.OMARK]
+        # Scores which would be rounded or wrapped are refused
+        for score in (0.5, float('nan'), 2 ** 63, -2 ** 70):
+            with self.assertRaises(ValueError):
+                cache.scores.set_desirability(
+                    key, {Mark.OMARK: score, Mark.XMARK: 0})
+        self.assertIsNone(cache.scores.desirability(key))
+        with self.assertRaises(ValueError):
+            cache.scores.update([key], value=[200])
+        state = State()
+        state.desirability = {Mark.OMARK: 2 ** 31, Mark.XMARK: 0}
+        with self.assertRaises(ValueError):
+            MappedCacheFile.to_record(state)
+        state.desirability = {Mark.OMARK: 3.0, Mark.XMARK: -3}
+        self.assertEqual(MappedCacheFile.to_record(state)[3:], (3, -3))
+
+    def test_lazy_cache(self):
+        # Solved on demand, with a cache too small to hold every State
+        lazy = LazyStateCache(max_size=100)
+        states = [s for s in self.cache if s.desirability is not None]
+        for state in states[::5]:
+            for iso in list(StateCache._get_isomorphs(state))[:2]:
+                cached, xforms, _ = lazy[iso]
+                self.assertEqual(cached.desirability, state.desirability)
+                self.assertEqual(apply_xforms(xforms, iso[:]).tolist(),
+                                 cached[:].tolist())
+        metrics = lazy.metrics()
+        self.assertEqual(metrics['size'], 100)
+        self.assertEqual(metrics['hits'] + metrics['misses'],
+                         2 * len(states[::5]))
+        self.assertGreater(metrics['evictions'], 0)
+        # Read from the binary file, after warming up in the background
+        lazy = LazyStateCache(file_path='state-cache.bin')
+        lazy.warm_up().join()
+        self.assertEqual(len(lazy), len(self.cache))
+        self.assertEqual(lazy[self.state1][0].desirability,
+                         self.cache[self.state1][0].desirability)
+        self.assertEqual(lazy.metrics()['solves'], 0)
+
+    def test_shared_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = os.path.join(directory, 'state-cache.shared')
+            primary = SharedStateCache.create(file_path, 'state-cache.bin')
+            # As a worker process would, map the file the primary wrote
+            shared = SharedStateCache(file_path)
+            self.assertEqual(len(shared), len(self.cache))
+            for state in list(self.cache)[::7]:
+                for iso in StateCache._get_isomorphs(state):
+                    cached, xforms, _ = shared[iso]
+                    expected, expected_xforms, _ = self.cache[iso]
+                    self.assertEqual(cached.desirability,
+                                     expected.desirability)
+                    self.assertEqual(apply_xforms(xforms, iso[:]).tolist(),
+                                     cached[:].tolist())
+                    self.assertIn(iso, shared)
+            self.assertEqual(shared[State.from_code1('OOOOO....')],
+                             (None, None, None))
+            with self.assertRaises(TypeError):
+                shared.add(State())
+            cached = shared[self.state1][0]
+            with self.assertRaises(TypeError):
+                cached.desirability = {Mark.OMARK: 1, Mark.XMARK: -1}
+            with self.assertRaises(TypeError):
+                shared.clear_desirability()
+            self.assertEqual(shared.metrics()['misses'], 1)
+            shared.close()
+            primary.close()
+
+    def test_canonical_tables(self):
+        for key in range(0, symmetry.NUM_KEYS, 7):
+            canonical, sym = symmetry.canonical(key)
+            self.assertEqual(symmetry.transform(key, sym), canonical)
+            inverse = symmetry.INVERSES[sym]
+            self.assertEqual(symmetry.transform(canonical, inverse), key)
+
     def test_to_code1(self):
         self.assertEqual(self.state1.to_code1(), '.OX.XOO..')
+        # Codes hold no win length, so it is given when parsing them
+        state = State.from_code1('OOO.' + '.' * 12, win_length=3)
+        self.assertEqual(state.winner, Mark.OMARK)
+        self.assertEqual(State.from_code2(state.to_code2(), 3).winner,
+                         Mark.OMARK)
+        self.assertIsNone(State.from_code1(state.to_code1()).winner)
+
+    def test_cached_winner(self):
+        state = State.from_code1('OO.XX....')
+        self.assertIsNone(state.winner)
+        # Indexing gives copies, and a State copies the array it is built
+        # from, so only set_mark changes the board and its winner
+        array = state[:]
+        array[0, 2] = Mark.OMARK
+        state[0][2] = Mark.OMARK
+        self.assertEqual(state.get_mark(0, 2), Mark.EMPTY)
+        self.assertIsNone(state.winner)
+        other = State(array)
+        array[0, 2] = Mark.EMPTY
+        self.assertEqual(other.winner, Mark.OMARK)
+        state.set_mark(0, 2, Mark.OMARK)
+        self.assertEqual(state.winner, Mark.OMARK)
+        state.reset_winner()
+        self.assertEqual(state.winner, Mark.OMARK)
+
+    def test_binary_cache_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = os.path.join(directory, 'state-cache.bin')
+            self.cache.write(file_path, file_format=3)
+            cache = StateCache()
+            cache.load(file_path)
+            self.assertEqual(len(cache), len(self.cache))
+            for state in self.cache:
+                cached, xf, ixf = cache[state]
+                self.assertEqual(cached.to_code1(), state.to_code1())
+                self.assertEqual(cached.desirability, state.desirability)
+            iso = State(np.rot90(self.state1[:]))
+            self.assertEqual(cache[iso][0], self.cache[iso][0])
+            cached = cache[self.state1][0]
+            cached.desirability = {Mark.OMARK: 5, Mark.XMARK: -5}
+            cache.update_state(cached)
+            self.assertEqual(cache[iso][0].desirability[Mark.OMARK], 5)
+            self.assertEqual(len(cache), len(self.cache))
 
     def test_branching(self):
         self.assertNotEqual(self.brancho, self.branchx)
@@ -64,6 +257,38 @@ class TicTacToeTester(TestCase):
 
         self.assertTrue(all(s in cache for s in branches))
 
+    def test_branch_unique(self):
+        states = list(branch_unique([State()], Mark.OMARK, 9))
+        self.assertEqual(len(states), 765)
+        self.assertTrue(all(s in self.cache for s in states))
+        plies = [9 - s.to_code1().count('.') for s in states]
+        self.assertEqual(plies, sorted(plies))
+        self.assertEqual(plies.count(4), 108)
+
+    def test_traverse(self):
+        dfs = [p.key for p in traverse([State()], Mark.OMARK, 3)]
+        bfs = [p.key for p in traverse([State()], Mark.OMARK, 3, 'bfs')]
+        self.assertEqual(len(dfs), 1 + 9 + 9 * 8 + 9 * 8 * 7)
+        self.assertEqual(sorted(dfs), sorted(bfs))
+        self.assertEqual(dfs[:3], [0, 3 ** 8, 3 ** 8 + 2 * 3 ** 7])
+        self.assertEqual(sorted(bfs[1:10]), bfs[1:10][::-1])
+        for mark in (Mark.OMARK, Mark.XMARK):
+            for order in ('dfs', 'bfs'):
+                unique = traverse([State()], mark, order=order,
+                                  prune=is_terminal, dedup=canonical_dedup())
+                self.assertEqual(sum(1 for _ in unique), 765)
+
+    def test_position_apply_undo(self):
+        position = Position.from_state(self.state1, Mark.XMARK)
+        key = position.key
+        position.apply(8)
+        self.assertEqual(position.to_state().to_code1(), '.OX.XOO.X')
+        self.assertEqual(position.mark, Mark.OMARK)
+        self.assertEqual(position.ply, 1)
+        position.undo()
+        self.assertEqual((position.key, position.mark, position.ply),
+                         (key, Mark.XMARK, 0))
+
     def test_full_state_branch(self):
         b9 = [s for s in self.cache if Mark.EMPTY not in s]
         sample9 = b9[0]
@@ -77,10 +302,457 @@ class TicTacToeTester(TestCase):
                      for m in s.next_marks()))
         self.assertTrue(all(s in self.cache for s in b1))
 
+    def test_solver_matches_cache(self):
+        cache = StateCache()
+        solution = solve(State(), Mark.XMARK)
+        solution.apply(cache)
+        self.assertEqual(solution.nodes, 765)
+        self.assertEqual(solution.values[solution.root_key], 0)
+        for state in cache:
+            if Mark.EMPTY in state and state.winner is None:
+                self.assertEqual(state.desirability,
+                                 self.cache[state][0].desirability)
+
+    def test_solver_minimax(self):
+        state = State(np.array([[2, 2, 0], [1, 1, 0], [0, 0, 0]]))
+        solution = solve(state, Mark.XMARK)
+        self.assertEqual(solution.values[solution.root_key], 1)
+        solution = solve(state, Mark.OMARK)
+        self.assertEqual(solution.values[solution.root_key], 1)
+        solution = solve(self.xwins1, Mark.OMARK)
+        self.assertEqual(solution.values[solution.root_key], -1)
+        self.assertEqual(solution.nodes, 1)
+
+    def test_incremental_rescore(self):
+        def diagonal_wins(state):
+            # Wins on the main diagonal count double
+            desirability = State.calculate_desirability(state)
+            diagonal = {state.get_mark(i, i) for i in range(3)}
+            if state.winner is not None and diagonal == {state.winner}:
+                return {mark: 2 * score for mark, score in desirability.items()}
+            return desirability
+
+        def solved_cache(evaluate=None):
+            cache = StateCache()
+            graphs = [DependencyGraph.solve(State(), mark, evaluate)
+                      for mark in (Mark.OMARK, Mark.XMARK)]
+            for graph in graphs:
+                graph.solution.apply(cache)
+            return cache
+
+        def rescore(file_path, evaluate):
+            # As tttai.py --rescore does, from the file alone
+            cache = StateCache()
+            cache.load(file_path)
+            graphs = cache_dependency_graphs(cache)
+            touched, keys = rescore_cache(cache, graphs, evaluate)
+            written = cache.write_changes(file_path, keys)
+            self.assertEqual(written, len(keys))
+            nodes = sum(graph.solution.nodes for graph in graphs)
+            self.assertLess(touched, nodes)
+            return touched, written
+
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = os.path.join(directory, 'cache.bin')
+            paths = {}
+            for name, evaluate in (('default', None),
+                                   ('diagonal', diagonal_wins)):
+                paths[name] = os.path.join(directory, f'{name}.bin')
+                solved_cache(evaluate).write(paths[name], file_format=3)
+            with open(paths['default'], 'rb') as fp:
+                default = fp.read()
+            with open(paths['diagonal'], 'rb') as fp:
+                diagonal = fp.read()
+            with open(file_path, 'wb') as fp:
+                fp.write(default)
+
+            touched, written = rescore(file_path, diagonal_wins)
+            self.assertTrue(0 < written <= touched)
+            with open(file_path, 'rb') as fp:
+                self.assertEqual(fp.read(), diagonal)
+            # Scoring with the same function again changes nothing
+            self.assertEqual(rescore(file_path, diagonal_wins), (0, 0))
+            # Reverting the tweak writes back every changed record
+            self.assertEqual(rescore(file_path, State.calculate_desirability),
+                             (touched, written))
+            with open(file_path, 'rb') as fp:
+                self.assertEqual(fp.read(), default)
+
+    def test_parallel_solver(self):
+        for mark in (Mark.OMARK, Mark.XMARK):
+            expected = solve(State(), mark)
+            actual = solve_parallel(State(), mark, workers=2)
+            self.assertEqual(actual.desirability, expected.desirability)
+            self.assertEqual(actual.values, expected.values)
+            self.assertEqual(actual.nodes, expected.nodes)
+        # A game too small to share is solved in the calling process
+        solution = solve_parallel(self.xwins1, Mark.OMARK, workers=2)
+        self.assertEqual(solution.nodes, 1)
+
+    def test_generate_cache_file(self):
+        # Every mode writes the same states, in the same orientation
+        with tempfile.TemporaryDirectory() as directory:
+            keys = []
+            for options in ({}, {'vectorized': True}, {'workers': 2}):
+                file_path = os.path.join(directory, 'state-cache.json')
+                generate_cache_file(file_path, **options)
+                cache = StateCache()
+                cache.load(file_path)
+                keys.append({state.to_key() for state in cache})
+        self.assertEqual(keys[0], keys[1])
+        self.assertEqual(keys[0], keys[2])
+        self.assertEqual(len(keys[0]), len(self.cache))
+
+    def test_batch_winners(self):
+        states = list(self.cache)
+        boards = BoardBatch.from_states(states)
+        winners = boards.winners()
+        for state, winner in zip(states, winners):
+            self.assertEqual(state.winner or Mark.EMPTY, winner)
+        keys, syms = boards.canonicalize()
+        for state, key, sym in zip(states, keys, syms):
+            self.assertEqual(symmetry.canonical(state.to_key()), (key, sym))
+
+    def test_batch_expand(self):
+        boards = BoardBatch.from_states([self.state1, self.xwins1])
+        children, parents, cells = boards.expand([Mark.XMARK, Mark.OMARK])
+        self.assertEqual(list(parents), [0, 0, 0, 0, 1, 1, 1])
+        expected = list(branch1(self.state1, Mark.XMARK))
+        expected += list(branch1(self.xwins1, Mark.OMARK))
+        self.assertEqual(list(children.keys()),
+                         [state.to_key() for state in expected])
+
+    def test_batch_solver(self):
+        for mark in (Mark.OMARK, Mark.XMARK):
+            vectorized = batch.solve(State(), mark)
+            solution = solve(State(), mark)
+            self.assertEqual(vectorized.desirability, solution.desirability)
+            self.assertEqual(vectorized.values, solution.values)
+
+    def test_move_table(self):
+        # Every unfinished board of the cache, in every orientation
+        table = MoveTable.compile(self.cache)
+        for key in range(symmetry.NUM_KEYS):
+            state = State.from_key(key)
+            if state.winner is not None or state.is_full or \
+                    state not in self.cache:
+                continue
+            for mark in state.next_marks():
+                expected = calculate_next_state_for(self.cache, state, mark)
+                actual = calculate_next_state_from_table(table, state, mark)
+                self.assertEqual(expected, actual, msg=state.to_code1())
+        # Larger boards are neither cached nor in the table
+        for state in (State(size=4), State(size=5, win_length=4)):
+            with self.assertRaises(ValueError):
+                calculate_next_state_for(self.cache, state, Mark.OMARK)
+            with self.assertRaises(ValueError):
+                calculate_next_state_from_table(table, state, Mark.OMARK)
+
+    def test_move_table_snapshot(self):
+        table = MoveTable()
+        table.load('move-table.json')
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, 'move-table.json')
+            snapshot = os.path.join(directory, 'move-table.bin')
+            table.write(source)
+            self.assertEqual(MoveTable.from_files(source, snapshot).version,
+                             table.version)
+            # Written through a temporary file, which is gone once replaced
+            self.assertEqual(sorted(os.listdir(directory)),
+                             ['move-table.bin', 'move-table.json'])
+            loaded = MoveTable()
+            loaded.load_snapshot(snapshot, source)
+            # As worker processes do, view the file's pages read-only
+            mapped = MoveTable.from_files(source, snapshot, mapped=True)
+            for other in (loaded, mapped):
+                self.assertEqual(other.version, table.version)
+                self.assertEqual(len(other), len(table))
+            for key in range(0, symmetry.NUM_KEYS, 11):
+                for mark in (Mark.OMARK, Mark.XMARK):
+                    for other in (loaded, mapped):
+                        self.assertEqual((key, mark) in other,
+                                         (key, mark) in table)
+                    if (key, mark) in table:
+                        self.assertEqual(mapped.reply(key, mark),
+                                         table.reply(key, mark))
+                        self.assertEqual(loaded.reply(key, mark),
+                                         table.reply(key, mark))
+            self.assertFalse(mapped._masks.flags.writeable)
+            # A snapshot is refused once its source file changes
+            with open(source, 'a') as fp:
+                fp.write(' ')
+            with self.assertRaises(ValueError):
+                MoveTable().load_snapshot(snapshot, source)
+            with open(snapshot, 'r+b') as fp:
+                fp.write(b'XXXX')
+            with self.assertRaises(ValueError):
+                MoveTable().load_snapshot(snapshot)
+
+    def test_board_interning(self):
+        key = self.state1.to_key()
+        board = Board.from_state(self.state1)
+        self.assertIs(board, Board(key))
+        self.assertIs(board, copy.deepcopy(board))
+        self.assertIs(board, pickle.loads(pickle.dumps(board)))
+        self.assertEqual(board.code, self.state1.to_code1())
+        self.assertEqual(board.winner, self.state1.winner)
+        self.assertEqual(board.next_marks(), self.state1.next_marks())
+        self.assertEqual(board.to_state(), self.state1)
+        with self.assertRaises(AttributeError):
+            board.key = 0
+        # Moves return the interned successors, the same ones every time
+        children = list(board.children(Mark.XMARK))
+        self.assertEqual([child.to_state() for _, child in children],
+                         list(branch1(self.state1, Mark.XMARK)))
+        for cell, child in children:
+            self.assertIs(board.play(cell, Mark.XMARK), child)
+            self.assertIs(child, Board(child.key))
+        with self.assertRaises(ValueError):
+            board.play(1, Mark.XMARK)
+        self.assertIs(Board().play(4, Mark.OMARK).play(0, Mark.XMARK),
+                      Board.from_state(State.from_code1('X...O....')))
+        self.assertLessEqual(Board.interned(), symmetry.NUM_KEYS)
+
     def test_winner(self):
         self.assertEqual(self.xwins1.winner, Mark.XMARK)
         self.assertEqual(self.owins1.winner, Mark.OMARK)
 
+    def test_winner_cache(self):
+        state = State(self.xwins1[:].copy())
+        self.assertEqual(state.winner, Mark.XMARK)
+        state.set_mark(2, 2, Mark.EMPTY)
+        self.assertIsNone(state.winner)
+        self.assertIsNone(state.winner)
+        state.set_mark(2, 2, Mark.XMARK)
+        self.assertEqual(state.winner, Mark.XMARK)
+
+    def test_winner_nxn(self):
+        state = State(size=5, win_length=4)
+        for col in range(1, 4):
+            state.set_mark(2, col, Mark.XMARK)
+        self.assertIsNone(state.winner)
+        state.set_mark(2, 4, Mark.XMARK)
+        self.assertEqual(state.winner, Mark.XMARK)
+        diagonal = State.from_code1('O...' '.O..' '..O.' '....')
+        self.assertEqual(diagonal.size, 4)
+        self.assertIsNone(diagonal.winner)
+        diagonal.set_mark(3, 3, Mark.OMARK)
+        self.assertEqual(diagonal.winner, Mark.OMARK)
+
+    def test_alpha_beta_search(self):
+        # The searched move must keep the minimax value of the position
+        def value(state, mark):
+            solution = solve(state, mark)
+            return solution.values[solution.root_key]
+
+        # One engine searches every state, so its table is reused
+        engine = AlphaBetaSearch(max_depth=9)
+        for state in self.brancho + self.branchx:
+            if state.winner is not None:
+                continue
+            for mark in state.next_marks():
+                child = search_next_state_for(state, mark, engine=engine)
+                self.assertEqual(-value(child, Mark.get_next(mark)),
+                                 value(state, mark))
+        self.assertGreater(len(engine.table), 0)
+
+    def test_search_engines(self):
+        # Each thread keeps one engine, and so one table, per layout
+        layout = State(size=4).layout
+        engine = search_engine(layout)
+        self.assertIs(search_engine(layout), engine)
+        self.assertIsNot(search_engine(State(size=5).layout), engine)
+        with ThreadPoolExecutor(1) as executor:
+            other = executor.submit(search_engine, layout).result()
+        self.assertIsNot(other, engine)
+
+    def test_alpha_beta_blocks(self):
+        state = State(size=5, win_length=4)
+        for col in range(3):
+            state.set_mark(1, col, Mark.OMARK)
+        state.set_mark(0, 0, Mark.XMARK)
+        state.set_mark(4, 4, Mark.XMARK)
+        search = AlphaBetaSearch(time_budget=5, max_depth=2)
+        self.assertEqual(search.search(state, Mark.XMARK), 1 * 5 + 3)
+
+    def test_rollouts(self):
+        lines = line_cells(self.state1.layout)
+        self.assertEqual(lines.shape, (8, 3))
+        # The last cell wins for O and draws for X
+        board = State.from_code1('OXOXXOOO.')[:].ravel()
+        winners = rollouts(lines, [board, board], [Mark.OMARK, Mark.XMARK],
+                           np.random.default_rng(0))
+        self.assertEqual(winners.tolist(), [Mark.OMARK, Mark.EMPTY])
+        # Random games from the empty board end as often as expected
+        winners = rollouts(lines, np.zeros((20000, 9)),
+                           np.full(20000, Mark.OMARK),
+                           np.random.default_rng(0))
+        counts = np.bincount(winners, minlength=3) / 20000
+        np.testing.assert_allclose(counts, [0.127, 0.585, 0.288], atol=0.02)
+
+    def test_mcts_against_cache(self):
+        # The cache plays perfectly, so the search must never lose to it
+        for seed, (mcts_mark, first) in enumerate(
+                [(m, f) for m in (Mark.OMARK, Mark.XMARK)
+                 for f in (Mark.OMARK, Mark.XMARK)] * 2):
+            engine = MonteCarloTreeSearch(time_budget=10, iterations=200,
+                                          seed=seed)
+            state, mark = State(), first
+            while state.winner is None and not state.is_full:
+                if mark == mcts_mark:
+                    state = mcts_next_state_for(state, mark, engine=engine)
+                else:
+                    state = calculate_next_state_for(self.cache, state, mark)
+                mark = Mark.get_next(mark)
+            self.assertNotEqual(state.winner, Mark.get_next(mcts_mark))
+
+    def test_mcts_tree_reuse(self):
+        engine = MonteCarloTreeSearch(time_budget=10, iterations=100, seed=0)
+        state = State()
+        result = engine.run(state, Mark.OMARK)
+        self.assertEqual(result.reused, 0)
+        self.assertEqual(result.iterations, 100)
+        state.set_mark(result.cell // 3, result.cell % 3, Mark.OMARK)
+        cell = next(c for c in range(9) if state[c // 3, c % 3] == 0)
+        state.set_mark(cell // 3, cell % 3, Mark.XMARK)
+        self.assertGreater(engine.run(state, Mark.OMARK).reused, 0)
+        # A time budget alone also ends the search
+        engine = MonteCarloTreeSearch(time_budget=0.05, seed=0)
+        state = State(size=5, win_length=4)
+        result = engine.run(state, Mark.XMARK)
+        self.assertIsNotNone(result.cell)
+        self.assertGreater(result.iterations, 0)
+        # Engines from one seed draw the same games
+        cells = [MonteCarloTreeSearch(iterations=50, seed=1).search(
+            State(), Mark.XMARK) for _ in range(2)]
+        self.assertEqual(cells[0], cells[1])
+        # A shared engine keeps the statistics of each search apart
+        engine = MonteCarloTreeSearch(iterations=40, seed=2)
+        with ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(
+                lambda code: engine.run(State.from_code1(code), Mark.XMARK),
+                ['O........', '.O.......', '....O....', 'OX.O.....']))
+        self.assertTrue(all(r.iterations == 40 for r in results))
+        self.assertEqual(len({id(r.root) for r in results}), 4)
+        with self.assertRaises(ValueError):
+            mcts_next_state_for(State.from_code1('OOOXX....'), Mark.XMARK)
+
+    def test_state_hash_ignores_desirability(self):
+        state = State(self.state1[:].copy())
+        before = hash(state)
+        state.desirability = {Mark.OMARK: 3, Mark.XMARK: -2}
+        self.assertEqual(hash(state), before)
+
+    def test_zobrist_hashing(self):
+        hasher = ZobristHasher(self.state1.layout)
+        o, x = self.state1.to_bits()
+        hashes = hasher.empty
+        for cell, mark in ((1, Mark.OMARK), (2, Mark.XMARK),
+                           (4, Mark.XMARK), (5, Mark.OMARK),
+                           (6, Mark.OMARK)):
+            hashes = hasher.toggle(hashes, cell, mark)
+        self.assertEqual(hashes, hasher.hash(o, x))
+        self.assertEqual(hasher.toggle(hasher.toggle(hashes, 8, Mark.XMARK),
+                                       8, Mark.XMARK), hashes)
+        key, state_sym = hasher.canonical(hashes, Mark.XMARK)
+        code = self.state1.to_code1()
+        for iso in StateCache._get_isomorphs(self.state1):
+            iso_key, sym = hasher.canonical(hasher.hash(*iso.to_bits()),
+                                            Mark.XMARK)
+            self.assertEqual(iso_key, key)
+            # Cells map through the canonical orientation onto isomorphs
+            iso_code = iso.to_code1()
+            for cell in range(9):
+                iso_cell = hasher.from_canonical_cell(
+                    hasher.to_canonical_cell(cell, state_sym), sym)
+                self.assertEqual(iso_code[iso_cell], code[cell])
+        self.assertNotEqual(hasher.canonical(hashes, Mark.OMARK)[0], key)
+
+    def test_transposition_table(self):
+        table = TranspositionTable(size=1)
+        table.store(1, 4, 10, EXACT, 0)
+        table.store(2, 2, 20, EXACT, 1)
+        self.assertIsNone(table.probe(2))
+        self.assertEqual(table.probe(1), (4, 10, EXACT, 0))
+        table.new_search()
+        table.store(2, 2, 20, LOWER, 1)
+        self.assertIsNone(table.probe(1))
+        self.assertEqual(table.probe(2), (2, 20, LOWER, 1))
+
+    def test_metrics(self):
+        registry = Registry()
+        lookups = registry.counter('lookups_total', 'Lookups', ('result',))
+        latency = registry.histogram('seconds', 'Latency', buckets=(0.1, 1))
+        lookups.inc(result='hit')
+        lookups.inc(2, result='hit')
+        for seconds in (0.05, 0.5, 5):
+            latency.observe(seconds)
+        registry.gauge('states', 'States', lambda: 42)
+        with self.assertRaises(ValueError):
+            lookups.inc(kind='hit')
+        text = registry.render()
+        self.assertIn('# TYPE lookups_total counter\n'
+                      'lookups_total{result="hit"} 3\n', text)
+        self.assertIn('seconds_bucket{le="0.1"} 1\n'
+                      'seconds_bucket{le="1"} 2\n'
+                      'seconds_bucket{le="+Inf"} 3\n'
+                      'seconds_sum 5.55\n'
+                      'seconds_count 3\n', text)
+        self.assertIn('states 42\n', text)
+        startup = StartupTimer()
+        startup.mark('imports')
+        with startup.phase('app'):
+            pass
+        startup.register(registry)
+        self.assertEqual([p for p, _ in startup.phases], ['imports', 'app'])
+        self.assertIn('tttai_startup_seconds{phase="app"}', registry.render())
+        self.assertIn('over the budget', startup.report(budget=-1))
+        # Registering a name again gives the existing metric
+        self.assertIs(registry.histogram('seconds', 'Latency'), latency)
+        self.assertEqual(latency.count(), 3)
+
+    def test_sampling_profiler(self):
+        def solve_root():
+            return solve(State(), Mark.OMARK)
+
+        with SamplingProfiler(interval=0.001) as profiler:
+            solve_root()
+        self.assertGreater(profiler.samples, 0)
+        stats = {function.rsplit('(', 1)[1]: total
+                 for function, _, total in profiler.stats()}
+        self.assertIn('solve_root)', stats)
+        self.assertLessEqual(stats['solve_root)'], profiler.seconds + 1e-9)
+        self.assertIn('solve_root', profiler.format())
+        # Overlapping profilers restore the switch interval once both stop
+        switch_interval = sys.getswitchinterval()
+        first = SamplingProfiler().__enter__()
+        second = SamplingProfiler().__enter__()
+        first.__exit__(None, None, None)
+        self.assertLess(sys.getswitchinterval(), switch_interval)
+        second.__exit__(None, None, None)
+        self.assertEqual(sys.getswitchinterval(), switch_interval)
+
+    def test_bitstate_matches_state(self):
+        for state in chain(self.brancho, self.branchx, self.cache):
+            bit_state = BitState.from_state(state)
+            self.assertEqual(bit_state, state)
+            self.assertEqual(bit_state.to_code2(), state.to_code2())
+            self.assertEqual(bit_state.winner, state.winner)
+            self.assertEqual(bit_state.is_full, state.is_full)
+            self.assertEqual(bit_state.next_marks(), state.next_marks())
+
+    def test_bitstate_set_mark(self):
+        state = BitState(self.xwins1[:])
+        self.assertEqual(state.winner, Mark.XMARK)
+        state.set_mark(2, 2, Mark.EMPTY)
+        self.assertIsNone(state.winner)
+        state.set_mark(0, 1, Mark.OMARK)
+        self.assertEqual(state.get_mark(0, 1), Mark.OMARK)
+        self.assertEqual(state.to_code1(), 'XO.OXOO..')
+        moves = list(state.moves(Mark.XMARK))
+        self.assertEqual(len(moves), 3)
+        self.assertIn(Mark.XMARK, [m.winner for m in moves])
+
     # def test_bug1(self):
     #     self.assertEqual(self.bug1_board.winner, Mark.OMARK)
     #     #calculate_next_state_for(self.cache, self.bug1_board, Mark.XMARK)
@@ -97,3 +769,442 @@ class TicTacToeTester(TestCase):
             iso = apply_xforms(xforms, ident)
             print()
             _print_array(iso)
+
+
+class SessionStoreTester(TestCase):
+    def setUp(self):
+        self.table = MoveTable()
+        self.table.load('move-table.json')
+
+    def test_capacity(self):
+        store = SessionStore(max_size=3)
+        sids = [store.create()[0] for _ in range(5)]
+        self.assertEqual(len(set(sids)), 5)
+        self.assertEqual(len(store), 3)
+        self.assertNotIn(sids[0], store)
+        self.assertIn(sids[4], store)
+        self.assertEqual(store.metrics()['dropped'], 2)
+
+    def test_ttl(self):
+        store = SessionStore(ttl=0)
+        sid, session = store.create()
+        self.assertIsNone(store.get(sid))
+        self.assertEqual(store.metrics(), {'live': 0, 'created': 1,
+                                           'expired': 1, 'dropped': 0})
+
+    def test_submit_batch(self):
+        cache = StateCache()
+        cache.load('state-cache.json')
+        # Every board of the table, in an orientation which needs mapping
+        games = [(list(StateCache._get_isomorphs(state))[3], mark)
+                 for state in cache if state.winner is None
+                 for mark in state.next_marks()]
+        store = SessionStore()
+        sid, _ = store.create()
+        replies = submit_batch(self.table, store, {
+            'games': [{'board': s.to_code1(), 'mark': m} for s, m in games] +
+                     [{'board': 'OOO......', 'mark': 2}],
+            'moves': [{'session': sid, 'mark': 1, 'row': 1, 'column': 1},
+                      {'session': sid, 'mark': 1, 'row': 0, 'column': 0},
+                      {'session': 1, 'mark': 1, 'row': 0, 'column': 0}]})
+        for (state, mark), reply in zip(games, replies['games']):
+            expected = calculate_next_state_from_table(self.table, state, mark)
+            self.assertEqual(reply['board'], expected.to_code1())
+        self.assertIn('error', replies['games'][-1])
+        self.assertEqual(replies['moves'][0]['session'], sid)
+        self.assertEqual(list(chain(*replies['moves'][0]['board'])).count(2), 1)
+        self.assertEqual(replies['moves'][1]['error'], 'Duplicate session')
+        self.assertEqual(replies['moves'][2]['error'], 'Not found.')
+        # Illegal moves leave their sessions as they were
+        fresh, session = store.create()
+        replies = submit_batch(self.table, store, {'moves': [
+            {'session': fresh, 'mark': 0, 'row': 0, 'column': 0},
+            {'session': sid, 'mark': 1, 'row': 1, 'column': 1}]})
+        self.assertIn('error', replies['moves'][0])
+        self.assertEqual(replies['moves'][1]['error'], 'Illegal board move!')
+        self.assertEqual((session.key, session.mark), (0, None))
+        # Few moves against search engines are answered in one batch
+        searched = [store.create(SessionData.from_options(
+            engine='alphabeta'))[0] for _ in range(BATCH_SEARCH_LIMIT + 1)]
+        replies = submit_batch(self.table, store, {'moves': [
+            {'session': s, 'mark': 1, 'row': 0, 'column': 0}
+            for s in searched]})
+        self.assertEqual(replies['moves'][-1]['error'],
+                         'Too many searches in one batch')
+        self.assertEqual(store.get(searched[-1]).key, 0)
+        self.assertTrue(all('board' in reply
+                            for reply in replies['moves'][:-1]))
+
+    def test_response_cache(self):
+        responses = ResponseCache.compile()
+        for key in range(0, symmetry.NUM_KEYS, 7):
+            session = SessionData(key)
+            if key in responses:
+                self.assertEqual(responses.session_data(session),
+                                 json.dumps(session.to_dict()).encode())
+        self.assertIn(State.from_code1('XOXOXO...').to_key(), responses)
+        # Bodies are serialized on first use without compile()
+        lazy = ResponseCache()
+        session = SessionData(State.from_code1('XOXOXO...').to_key())
+        self.assertEqual(lazy.session_data(session),
+                         responses.session_data(session))
+        self.assertEqual(len(lazy), 1)
+        session = SessionData.from_options(4)
+        self.assertEqual(responses.session_data(session),
+                         json.dumps(session.to_dict()).encode())
+
+    def test_shared_sqlite_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = os.path.join(directory, 'sessions.db')
+            store1 = SqliteSessionStore(file_path, max_size=2)
+            store2 = SqliteSessionStore(file_path, max_size=2)
+            sid, session = store1.create()
+            session.submit(self.table, 'set-mark',
+                           {'mark': Mark.OMARK, 'row': 1, 'column': 1})
+            store1.save(sid, session)
+            shared = store2.get(sid)
+            self.assertEqual(shared.mark, Mark.XMARK)
+            self.assertEqual(shared.to_dict(), session.to_dict())
+            # A save over another worker's save is refused
+            stale = store1.get(sid)
+            cell = shared.state[:].flatten().tolist().index(Mark.EMPTY)
+            move = {'mark': Mark.OMARK, 'row': cell // 3, 'column': cell % 3}
+            shared.submit(self.table, 'set-mark', move)
+            store2.save(sid, shared)
+            stale.submit(self.table, 'set-mark', move)
+            with self.assertRaises(SessionConflictError):
+                store1.save(sid, stale)
+            self.assertEqual(store1.get(sid).key, shared.key)
+            # Checking for a session does not keep it alive
+            accessed = store1._db.execute(
+                'SELECT accessed FROM sessions WHERE id = ?',
+                (sid,)).fetchone()
+            self.assertIn(sid, store1)
+            self.assertEqual(store1._db.execute(
+                'SELECT accessed FROM sessions WHERE id = ?',
+                (sid,)).fetchone(), accessed)
+            store2.create()
+            store2.create()
+            self.assertEqual(len(store1), 2)
+            self.assertIsNone(store1.get(sid))
+
+
+class AsyncGameTester(TestCase):
+    @classmethod
+    def request(cls, app, method, path, form=None, data=None, headers=()):
+        body = b''
+        headers = list(headers)
+        if form is not None:
+            body = urlencode(form).encode()
+            headers.append((b'content-type',
+                            b'application/x-www-form-urlencoded'))
+        if data is not None:
+            body = json.dumps(data).encode()
+            headers.append((b'content-type', b'application/json'))
+        messages = [{'type': 'http.request', 'body': body}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': method, 'path': path,
+                 'headers': headers}
+        return app(scope, receive, send), sent
+
+    def test_concurrent_moves(self):
+        import asyncgame
+        app = asyncgame.GameServer(asyncgame.MOVE_TABLE)
+
+        async def play():
+            call, sent = self.request(app, 'GET', '/start-new-game')
+            await call
+            location = dict(sent[0]['headers'])[b'location'].decode()
+            sid = location.rsplit('/', 1)[1]
+            calls = []
+            for cell in range(9):
+                args = json.dumps({'mark': 1, 'row': cell // 3,
+                                   'column': cell % 3})
+                calls.append(self.request(app, 'POST', f'/session-data/{sid}',
+                                          {'verb': 'set-mark', 'args': args}))
+            await asyncio.gather(*(call for call, _ in calls))
+            call, sent = self.request(app, 'GET', f'/session-data/{sid}')
+            await call
+            return json.loads(sent[1]['body']), [s[0]['status'] for _, s in calls]
+
+        data, statuses = asyncio.run(play())
+        board = list(chain(*data['board']))
+        self.assertTrue(set(statuses) <= {200, 400})
+        self.assertIn(board.count(1) - board.count(2), (0, 1))
+        self.assertEqual(board.count(1), statuses.count(200))
+
+    def test_bad_submissions(self):
+        import asyncgame
+        app = asyncgame.GameServer(asyncgame.MOVE_TABLE)
+        sid, _ = app.sessions.create()
+
+        async def post(form):
+            call, sent = self.request(app, 'POST', f'/session-data/{sid}',
+                                      form)
+            await call
+            return sent[0]['status']
+
+        async def play():
+            move = {'verb': 'set-mark',
+                    'args': json.dumps({'mark': 1, 'row': 0, 'column': 0})}
+            return [await post(move), await post(move),
+                    await post({'verb': 'set-mark', 'args': '{bad'}),
+                    await post({'verb': 'set-mark',
+                                'args': json.dumps({'mark': 7})}),
+                    await post({'args': '{}'})]
+
+        # An occupied cell or malformed arguments are bad requests, and a
+        # request without a verb does nothing
+        self.assertEqual(asyncio.run(play()), [200, 400, 400, 400, 200])
+        self.assertEqual(app.sessions.get(sid).state.to_code1().count('O'),
+                         1)
+
+    def test_store_off_event_loop(self):
+        import asyncgame
+
+        class ThreadRecordingStore(SessionStore):
+            def get(self, sid):
+                threads.add(threading.current_thread())
+                return super().get(sid)
+
+            def save(self, sid, session):
+                threads.add(threading.current_thread())
+
+        threads = set()
+        app = asyncgame.GameServer(asyncgame.MOVE_TABLE,
+                                   sessions=ThreadRecordingStore())
+        sid, _ = app.sessions.create()
+
+        async def play():
+            args = json.dumps({'mark': 1, 'row': 1, 'column': 1})
+            call, sent = self.request(app, 'POST', f'/session-data/{sid}',
+                                      {'verb': 'set-mark', 'args': args})
+            await call
+            call, _ = self.request(app, 'GET', f'/session/{sid}')
+            await call
+            return sent[0]['status']
+
+        # A store which blocks must not stall the event loop
+        self.assertEqual(asyncio.run(play()), 200)
+        self.assertTrue(threads)
+        self.assertNotIn(threading.main_thread(), threads)
+
+    def test_play_again_link(self):
+        import asyncgame
+        app = asyncgame.GameServer(asyncgame.MOVE_TABLE)
+        sid, _ = app.sessions.create(SessionData.from_options(4, 3, 'mcts'))
+
+        async def get():
+            call, sent = self.request(app, 'GET', f'/session/{sid}')
+            await call
+            return sent[1]['body'].decode()
+
+        # A new game has the rules and engine of the one just played
+        self.assertIn('/start-new-game?size=4&amp;win=3&amp;engine=mcts',
+                      asyncio.run(get()))
+
+    def test_batch_moves(self):
+        import asyncgame
+        app = asyncgame.GameServer(asyncgame.MOVE_TABLE)
+
+        async def play():
+            sids = []
+            for _ in range(3):
+                call, sent = self.request(app, 'GET', '/start-new-game')
+                await call
+                location = dict(sent[0]['headers'])[b'location'].decode()
+                sids.append(int(location.rsplit('/', 1)[1]))
+            moves = [{'session': sid, 'mark': 2, 'row': 2, 'column': i}
+                     for i, sid in enumerate(sids)]
+            call, sent = self.request(app, 'POST', '/moves', data={
+                'games': [{'board': '.........', 'mark': 1}],
+                'moves': moves})
+            await call
+            return sids, sent[0]['status'], json.loads(sent[1]['body'])
+
+        sids, status, replies = asyncio.run(play())
+        self.assertEqual(status, 200)
+        self.assertEqual(replies['games'], [{'board': 'O........',
+                                             'winner': None}])
+        self.assertEqual([m['session'] for m in replies['moves']], sids)
+        for move in replies['moves']:
+            board = list(chain(*move['board']))
+            self.assertEqual((board.count(1), board.count(2)), (1, 1))
+
+    def test_stateless_move(self):
+        import asyncgame
+        app = asyncgame.GameServer(asyncgame.MOVE_TABLE)
+        key = State.from_code1('X...O....').to_key()
+
+        async def get(path, headers=()):
+            call, sent = self.request(app, 'GET', path, headers=headers)
+            await call
+            return sent[0]['status'], dict(sent[0]['headers']), sent[1]['body']
+
+        async def play():
+            first = await get('/move/X...O..../O')
+            by_key = await get(f'/move/{key}/1')
+            tag = first[1][b'etag']
+            cached = await get('/move/X...O..../O', [(b'if-none-match', tag)])
+            finished = await get('/move/OOO....../X', [(b'if-none-match', b'*')])
+            return first, by_key, cached, finished, \
+                await get('/move/OO.XX.X../O')
+
+        first, by_key, cached, finished, won = asyncio.run(play())
+        self.assertEqual(first[0], 200)
+        self.assertEqual(json.loads(first[2]), {'board': 'X.O.O....',
+                                                'cell': 2, 'winner': None})
+        self.assertIn(b'immutable', first[1][b'cache-control'])
+        self.assertEqual(by_key[1][b'etag'], first[1][b'etag'])
+        self.assertEqual(by_key[2], first[2])
+        self.assertEqual((cached[0], cached[2]), (304, b''))
+        self.assertEqual(finished[0], 404)
+        # Winners are int Marks, as in session data and batch replies
+        self.assertEqual(json.loads(won[2])['winner'], Mark.OMARK)
+
+    def test_metrics_endpoint(self):
+        import asyncgame
+        app = asyncgame.GameServer(asyncgame.MOVE_TABLE)
+        sid, _ = app.sessions.create()
+
+        async def get(path):
+            call, sent = self.request(app, 'GET', path)
+            await call
+            return sent[0]['status'], sent[1]['body'].decode()
+
+        async def play():
+            await get('/move/X...O..../O')
+            await get(f'/session-data/{sid}')
+            return await get('/metrics')
+
+        status, text = asyncio.run(play())
+        self.assertEqual(status, 200)
+        self.assertIn('# TYPE tttai_request_seconds histogram', text)
+        self.assertRegex(text, r'tttai_requests_total\{endpoint="main.move",'
+                               r'status="200"\} [1-9]')
+        self.assertIn('tttai_sessions_active', text)
+        # Session data comes from the response cache
+        self.assertRegex(text, r'tttai_cache_hit_ratio\{cache="responses"\} '
+                               r'[0-9.]+\n')
+
+
+class WebGameTester(TestCase):
+    def setUp(self):
+        import webgame
+        self.webgame = webgame
+        self.app = webgame.create_app()
+        self.client = self.app.test_client()
+
+    def start_game(self, query=''):
+        response = self.client.get('/start-new-game' + query)
+        self.assertEqual(response.status_code, 302)
+        return int(response.headers['Location'].rsplit('/', 1)[1])
+
+    def test_lazy_engines(self):
+        # The servers start without loading the solvers or search engines
+        code = 'import sys, webgame; print(" ".join(sys.modules))'
+        modules = subprocess.run([sys.executable, '-c', code], check=True,
+                                 capture_output=True, text=True).stdout
+        for name in ('batch', 'mcts', 'search', 'solver', 'traversal'):
+            self.assertNotIn(f'tictactoe.{name}', modules.split())
+
+    def test_app_state(self):
+        served = self.app.extensions['tttai']
+        self.assertEqual(set(served),
+                         {'sessions', 'move_table', 'responses', 'startup'})
+        sid = self.start_game('?size=4&engine=mcts')
+        self.assertEqual(served['sessions'].get(sid).size, 4)
+        # Each app serves its own sessions
+        other = self.webgame.create_app().extensions['tttai']['sessions']
+        self.assertIsNone(other.get(sid))
+
+    def test_session_routes(self):
+        sid = self.start_game()
+        self.assertEqual(self.client.get(f'/session/{sid}').status_code, 200)
+        for path in ('/session/abc', '/session-data/abc', '/session/1'):
+            self.assertEqual(self.client.get(path).status_code, 404)
+        self.assertEqual(self.client.post('/session-data/abc').status_code,
+                         404)
+        self.assertEqual(self.client.get('/start-new-game?size=7')
+                         .status_code, 400)
+
+        def post(form):
+            return self.client.post(f'/session-data/{sid}', data=form)
+
+        move = {'verb': 'set-mark',
+                'args': json.dumps({'mark': 1, 'row': 0, 'column': 0})}
+        response = post(move)
+        self.assertEqual(response.status_code, 200)
+        board = list(chain(*json.loads(response.data)['board']))
+        self.assertEqual((board.count(1), board.count(2)), (1, 1))
+        # An occupied cell or malformed arguments are bad requests, and a
+        # request without a verb does nothing
+        self.assertEqual(post(move).status_code, 400)
+        self.assertEqual(post({'verb': 'set-mark', 'args': '{bad'})
+                         .status_code, 400)
+        response = post({'args': '{}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data,
+                         self.client.get(f'/session-data/{sid}').data)
+
+    def test_batch_moves(self):
+        sid = self.start_game()
+        response = self.client.post('/moves', json={
+            'games': [{'board': '.........', 'mark': 1}],
+            'moves': [{'session': sid, 'mark': 2, 'row': 1, 'column': 1}]})
+        self.assertEqual(response.status_code, 200)
+        replies = response.get_json()
+        self.assertEqual(replies['games'], [{'board': 'O........',
+                                             'winner': None}])
+        self.assertEqual(replies['moves'][0]['session'], sid)
+        self.assertEqual(self.client.post('/moves', data='[]').status_code,
+                         400)
+
+    def test_stateless_move(self):
+        first = self.client.get('/move/X...O..../O')
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.get_json(), {'board': 'X.O.O....', 'cell': 2,
+                                            'winner': None})
+        tag = first.headers['ETag']
+        cached = self.client.get('/move/X...O..../O',
+                                 headers={'If-None-Match': tag})
+        self.assertEqual((cached.status_code, cached.data), (304, b''))
+        # Boards without a reply are 404 even when the ETag matches
+        finished = self.client.get('/move/OOO....../X',
+                                   headers={'If-None-Match': '*'})
+        self.assertEqual(finished.status_code, 404)
+        self.assertEqual(self.client.get('/move/bad/O').status_code, 400)
+
+    def test_metrics_endpoint(self):
+        self.client.get('/move/X...O..../O')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        text = response.get_data(as_text=True)
+        self.assertRegex(text, r'tttai_requests_total\{endpoint="main.move",'
+                               r'status="200"\} [1-9]')
+        self.assertIn('tttai_startup_seconds{phase="app"}', text)
+
+    def test_profiling_gate(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.multiple(self.webgame, PROFILE_DIR=directory,
+                                    PROFILE_TOKEN='secret',
+                                    PROFILE_INTERVAL=3600,
+                                    _last_profile=float('-inf')):
+            path = '/move/X...O..../O?profile=1'
+            for headers in ({}, {'X-Profile-Token': 'wrong'}):
+                response = self.client.get(path, headers=headers)
+                self.assertNotIn('X-Profile', response.headers)
+            headers = {'X-Profile-Token': 'secret'}
+            response = self.client.get(path, headers=headers)
+            file_name = response.headers['X-Profile']
+            self.assertEqual(os.listdir(directory), [file_name])
+            # Profiles are rate limited
+            response = self.client.get(path, headers=headers)
+            self.assertNotIn('X-Profile', response.headers)
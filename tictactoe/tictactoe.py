@@ -8,6 +8,7 @@ from enum import Enum
 import numpy as np
 from copy import copy
 from .util import *
+from . import bitboard
 
 
 class Mark(int, Enum):
@@ -38,18 +39,53 @@ class Mark(int, Enum):
         return None
 
 
+# Marks a winner which has not been calculated yet, since None means
+# that there is no winner
+_UNKNOWN = object()
+
+
 class State:
     """
-    Class representing the Tic-Tac-Toe board game (state)
+    Class representing the Tic-Tac-Toe board game (state). The board is
+    size x size, and a player wins with win_length marks in a row,
+    column or diagonal (by default, a full line).
     """
-    def __init__(self, array=None):
+    def __init__(self, array=None, size=3, win_length=None):
         if array is not None:
-            assert(array.shape == (3, 3))
-            self._array = array
+            size = array.shape[0]
+            assert(array.shape == (size, size))
+            # Copied, so that the caller cannot change it behind set_mark
+            self._array = array.copy()
         else:
-            self._array = np.full((3, 3), Mark.EMPTY, dtype=Mark)
+            self._array = np.full((size, size), Mark.EMPTY, dtype=Mark)
+        self._layout = bitboard.get_layout(size, win_length)
         self._desirability = None
-        self._cached_winner = None
+        self._scores = None
+        self._cached_winner = _UNKNOWN
+
+    @property
+    def size(self):
+        """
+        The number of rows (and columns) of the board
+        :return: (int)
+        """
+        return self._layout.size
+
+    @property
+    def win_length(self):
+        """
+        The number of marks in a row needed to win
+        :return: (int)
+        """
+        return self._layout.win_length
+
+    @property
+    def layout(self):
+        """
+        The bit board operations for this State's size and win length
+        :return: (bitboard.Layout)
+        """
+        return self._layout
 
     def set_mark(self, row, col, mark):
         """
@@ -60,7 +96,15 @@ class State:
         :param mark: (Mark)
         """
         self._array[row][col] = mark
+        self.reset_winner()
+        self._unbind_scores()
 
+    def reset_winner(self):
+        """
+        Forget the cached winner, so that it is calculated again when next
+        asked for
+        """
+        self._cached_winner = _UNKNOWN
 
     def get_mark(self, row, col):
         """
@@ -72,6 +116,20 @@ class State:
         return Mark(self._array[row][col])
 
 
+    @classmethod
+    def from_key(cls, key, size=3, win_length=None):
+        """
+        Return a State given the base-3 integer key of its board
+        :param key: (int) the board key
+        :param size: (int) the number of rows (and columns) of the board
+        :param win_length: (int) the number of marks in a row needed to win
+        :return: (State)
+        """
+        layout = bitboard.get_layout(size, win_length)
+        marks = layout.to_cells(*layout.from_key(key))
+        array = np.array([Mark(m) for m in marks], dtype=Mark)
+        return cls(array.reshape(size, size), win_length=win_length)
+
     def to_code1(self):
         """
         Get the serializable string for this State
@@ -80,45 +138,65 @@ class State:
         return ''.join(str(Mark(int(x))) for x in self._array.flatten())
 
     @classmethod
-    def from_code1(cls, code):
+    def from_code1(cls, code, win_length=None):
         """
         Return a State given a serialized string (code)
         :param code: (string) the code to parse
+        :param win_length: (int) the number of marks in a row needed to win,
+        which the code does not hold, or None for the board size
         :return: (State)
         """
         lookup = {repr(mark): mark for mark in Mark}
-        array = np.array([lookup[c] for c in code]).reshape(3, 3)
-        return State(array)
+        size = round(len(code) ** 0.5)
+        array = np.array([lookup[c] for c in code]).reshape(size, size)
+        return cls(array, win_length=win_length)
 
     def to_code2(self):
         """
         Get the serializable string for this State
         :return: (string)
         """
-        array_code = ''.join(str(Mark(int(x))) for x in self._array.flatten())
+        array_code = self.to_code1()
         desirability = self.desirability or {}
         des_code = ','.join([str(x) for x in unroll_dict(desirability)])
         return '|'.join([array_code, des_code])
 
     @classmethod
-    def from_code2(cls, code):
+    def from_code2(cls, code, win_length=None):
         """
         Return a State given a serialized string (code)
         :param code: (string) the code to parse
+        :param win_length: (int) the number of marks in a row needed to win,
+        which the code does not hold, or None for the board size
         :return: (State)
         """
         lookup = {repr(mark): mark for mark in Mark}
         array_code, des_code = code.split('|')
-        array = np.array([lookup[c] for c in array_code]).reshape(3, 3)
-        state = State(array)
+        size = round(len(array_code) ** 0.5)
+        array = np.array([lookup[c] for c in array_code]).reshape(size, size)
+        state = cls(array, win_length=win_length)
         if des_code:
             des_list = des_code.split(',')
             state.desirability = {lookup[k]: float(v) for k, v in roll(des_list)}
         return state
 
+    def to_bits(self):
+        """
+        Get the bit board representation of this State
+        :return: (tuple) of the O bit set and the X bit set
+        """
+        return bitboard.from_cells(self._array.flat)
+
+    def to_key(self):
+        """
+        Get the base-3 integer key of this State's board
+        :return: (int)
+        """
+        return self._layout.to_key(*self.to_bits())
+
     @property
     def is_full(self):
-        return Mark.EMPTY not in list(np.unique(self._array.flatten()))
+        return self._layout.is_full(*self.to_bits())
 
     def next_marks(self):
         """
@@ -126,44 +204,49 @@ class State:
         this state
         :return: (set) of Mark objects
         """
-        unique, cnt = np.unique(self._array.flatten(), return_counts=True)
-        if Mark.EMPTY not in unique:
-            return set()
-        count = dict(zip(unique, cnt))
-        os = count.get(Mark.OMARK, 0)
-        xes = count.get(Mark.XMARK, 0)
-        if os == xes:
-            return {Mark.OMARK, Mark.XMARK}
-        else:
-            return {Mark.OMARK} if xes > os else {Mark.XMARK}
+        return {Mark(m) for m in self._layout.next_marks(*self.to_bits())}
 
     @property
     def desirability(self):
         """
-        The desirability values for each Mark for this state
+        The desirability values for each Mark for this state. For a State
+        bound to a ScoreTable, this is a view of its row.
         :return: (dict)
         """
+        if self._scores is not None:
+            table, index = self._scores
+            return table.desirability(index)
         return self._desirability
 
     @desirability.setter
     def desirability(self, value):
-        if value is None:
-            self._desirability = None
-            return
-        if not hasattr(value, '__getitem__'):
+        if value is not None and not hasattr(value, '__getitem__'):
             raise TypeError('desirability object must sliceable')
-        self._desirability = dict(value)
+        if self._scores is not None:
+            table, index = self._scores
+            table.set_desirability(index, value)
+            return
+        self._desirability = None if value is None else dict(value)
 
-    @classmethod
-    def _roll_rows(cls, array, step=1):
+    def bind_scores(self, table, index):
+        """
+        Keep this State's desirability in a row of a ScoreTable, which is
+        read and written through the desirability property from now on
+        :param table: (ScoreTable) the table
+        :param index: (int) the row, this State's canonical key
+        """
+        self._scores = (table, index)
+        self._desirability = None
+
+    def _unbind_scores(self):
         """
-        Rolls each row in a (2D) array by a step value
-        :param array: (ndarray) the array
-        :param step: (int) number of columns to shift by
-        :return: (ndarray)
+        Copy the desirability out of a ScoreTable, once this State no
+        longer matches the row it is bound to
         """
-        for idx, row in enumerate(array):
-            yield np.roll(row, step * idx)
+        if self._scores is not None:
+            desirability = self.desirability
+            self._scores = None
+            self.desirability = desirability
 
     @classmethod
     def calculate_desirability(cls, state):
@@ -195,20 +278,8 @@ class State:
         Calculates the winning mark, or None if no winner in this state
         :return: (Mark) the winning mark
         """
-        rows = self._array
-        columns = self._array.transpose()
-        diagonal1 = np.array(list(self._roll_rows(rows, -1)))[:, 0]
-        diagonal2 = np.array(list(self._roll_rows(rows, 1)))[:, -1]
-        diagonals = [diagonal1, diagonal2]
-        rows_cols_diags = chain(rows, columns, diagonals)
-        for line in rows_cols_diags:
-            unique, cnt = np.unique(line, return_counts=True)
-            win_cnt = len(line)
-            if win_cnt in cnt:
-                winner = unique[list(cnt).index(win_cnt)]
-                if winner != Mark.EMPTY:
-                    return Mark(winner)
-        return None
+        winner = self._layout.winner(*self.to_bits())
+        return Mark(winner) if winner else None
 
     @property
     def winner(self):
@@ -217,12 +288,15 @@ class State:
         :return: (Mark) the winning mark
         """
         # Lazy evaluation
-        if self._cached_winner is None:
+        if self._cached_winner is _UNKNOWN:
             self._cached_winner = self._calculate_winner()
         return copy(self._cached_winner)
 
     def __getitem__(self, item):
-        return self._array[item]
+        # A copy, as in BitState, since changes must go through set_mark
+        # to reset the cached winner
+        value = self._array[item]
+        return value.copy() if isinstance(value, np.ndarray) else value
 
     def __repr__(self):
         f = np.vectorize(Mark.__repr__)
@@ -238,10 +312,101 @@ class State:
         return np.array_equal(self._array, other._array)
 
     def __hash__(self):
-        board_hash = hash(tuple(self._array.flatten()))
-        desirability_hash = hash(tuple(self.desirability or []))
-        return board_hash ^ desirability_hash
+        # Only the board takes part, as in __eq__, so scoring a State does
+        # not change its hash
+        return hash(self.to_key())
 
     def __contains__(self, item):
         return item in self._array.flatten()
 
+
+class BitState(State):
+    """
+    Tic-Tac-Toe board game (state) stored as a pair of bit sets rather
+    than an array of Marks. Indexing materializes a fresh array, so
+    changes must go through set_mark.
+    """
+    def __init__(self, array=None):
+        if array is not None:
+            assert(array.shape == (3, 3))
+            self._o, self._x = bitboard.from_cells(array.flat)
+        else:
+            self._o = self._x = 0
+        self._layout = bitboard.get_layout()
+        self._desirability = None
+        self._scores = None
+
+    @classmethod
+    def from_bits(cls, o, x):
+        """
+        Return a BitState given the bit set of each player
+        :param o: (int) the O bit set
+        :param x: (int) the X bit set
+        :return: (BitState)
+        """
+        state = cls()
+        state._o, state._x = o, x
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Return a BitState with the board and desirability of a State
+        :param state: (State) the state
+        :return: (BitState)
+        """
+        result = cls.from_bits(*state.to_bits())
+        result.desirability = state.desirability
+        return result
+
+    @property
+    def _array(self):
+        array = np.array([Mark(m) for m in bitboard.to_cells(*self.to_bits())],
+                         dtype=Mark)
+        return array.reshape(3, 3)
+
+    def to_bits(self):
+        return self._o, self._x
+
+    def set_mark(self, row, col, mark):
+        self._o, self._x = bitboard.place(self._o, self._x, row * 3 + col, mark)
+        self._unbind_scores()
+
+    def get_mark(self, row, col):
+        cell = row * 3 + col
+        if self._o >> cell & 1:
+            return Mark.OMARK
+        if self._x >> cell & 1:
+            return Mark.XMARK
+        return Mark.EMPTY
+
+    def to_code1(self):
+        marks = bitboard.to_cells(self._o, self._x)
+        return ''.join(str(Mark(m)) for m in marks)
+
+    def moves(self, mark):
+        """
+        Yield results for making the next move with the given mark
+        :param mark: (Mark) the player's mark
+        :return: (generator) of BitState objects
+        """
+        for cell in bitboard.moves(self._o, self._x):
+            yield self.from_bits(*bitboard.place(self._o, self._x, cell, mark))
+
+    @property
+    def winner(self):
+        winner = bitboard.winner(self._o, self._x)
+        return Mark(winner) if winner else None
+
+    def __eq__(self, other):
+        if isinstance(other, BitState):
+            return self.to_bits() == other.to_bits()
+        return super().__eq__(other)
+
+    def __hash__(self):
+        return super().__hash__()
+
+    def __contains__(self, item):
+        if item == Mark.EMPTY:
+            return not bitboard.is_full(self._o, self._x)
+        return bool(self._o if item == Mark.OMARK else self._x)
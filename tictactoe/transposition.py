@@ -0,0 +1,162 @@
+"""
+Tic-Tac-Toe transposition module
+
+Zobrist hashing of boards and a bounded transposition table for the
+search engine. Every board is hashed in all eight orientations at once,
+so isomorphic boards share a single table entry.
+"""
+
+import random
+from tictactoe import Mark
+from . import symmetry
+
+# Bound types of a stored score
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+
+class ZobristHasher:
+    """
+    Zobrist hashing for a square board layout. A board's hashes are a
+    tuple with one 64-bit hash per symmetry, in the order of
+    symmetry.ISO_XFORMS. Placing or removing a mark XORs one code into
+    each of them, so moves and undos are both toggle().
+    """
+    def __init__(self, layout, seed=0):
+        rng = random.Random(seed)
+        self.layout = layout
+        self.permutations = symmetry.permutations(layout.size)
+        # _positions[sym][cell] is where symmetry sym moves a cell
+        self._positions = tuple(
+            tuple(perm.index(cell) for cell in range(layout.cells))
+            for perm in self.permutations)
+        codes = {mark: [rng.getrandbits(64) for _ in range(layout.cells)]
+                 for mark in (Mark.OMARK, Mark.XMARK)}
+        # _codes[mark][cell][sym] is the code of a mark on a cell of the
+        # board after symmetry sym moves the cell
+        self._codes = {mark: tuple(
+            tuple(codes[mark][positions[cell]]
+                  for positions in self._positions)
+            for cell in range(layout.cells)) for mark in codes}
+        self.side = rng.getrandbits(64)
+        self.empty = (0,) * len(self.permutations)
+
+    def hash(self, o, x):
+        """
+        Hash a bit board from scratch
+        :param o: (int) the O bit set
+        :param x: (int) the X bit set
+        :return: (tuple) of hashes, one per symmetry
+        """
+        hashes = self.empty
+        for cell in range(self.layout.cells):
+            if o >> cell & 1:
+                hashes = self.toggle(hashes, cell, Mark.OMARK)
+            elif x >> cell & 1:
+                hashes = self.toggle(hashes, cell, Mark.XMARK)
+        return hashes
+
+    def toggle(self, hashes, cell, mark):
+        """
+        Update hashes for a mark placed on, or removed from, a cell
+        :param hashes: (tuple) of hashes, one per symmetry
+        :param cell: (int) the row-major cell index
+        :param mark: (Mark) the mark
+        :return: (tuple) of the updated hashes
+        """
+        return tuple(h ^ c for h, c in zip(hashes, self._codes[mark][cell]))
+
+    def canonical(self, hashes, mark):
+        """
+        Get the table key of a board, the same for all its isomorphs
+        :param hashes: (tuple) of hashes, one per symmetry
+        :param mark: (Mark) the Mark to move
+        :return: (tuple) of the key and the symmetry which gives it
+        """
+        h = min(hashes)
+        sym = hashes.index(h)
+        return h ^ self.side if mark == Mark.XMARK else h, sym
+
+    def to_canonical_cell(self, cell, sym):
+        """
+        Move a cell of a board onto its canonical orientation
+        :param cell: (int) the row-major cell index
+        :param sym: (int) the symmetry from canonical()
+        :return: (int) the cell index in the canonical orientation
+        """
+        return self._positions[sym][cell]
+
+    def from_canonical_cell(self, cell, sym):
+        """
+        Move a cell of the canonical orientation back onto a board
+        :param cell: (int) the cell index in the canonical orientation
+        :param sym: (int) the symmetry from canonical()
+        :return: (int) the row-major cell index
+        """
+        return self.permutations[sym][cell]
+
+
+class TranspositionTable:
+    """
+    Bounded table of search results, indexed by Zobrist key. Each slot
+    holds one entry; a new entry replaces the old one if it was searched
+    at least as deep, or if the old one is left over from an earlier
+    search.
+    """
+    def __init__(self, size=1 << 16):
+        self.size = size
+        self._entries = [None] * size
+        self.generation = 0
+        self.probes = 0
+        self.hits = 0
+        self.stores = 0
+        self.replacements = 0
+
+    def new_search(self):
+        """
+        Age the entries of earlier searches, so they are replaced first
+        """
+        self.generation += 1
+
+    def probe(self, key):
+        """
+        Look up an entry
+        :param key: (int) the Zobrist key
+        :return: (tuple) of depth, score, bound and canonical best move,
+        or None if the table has no entry for the key
+        """
+        self.probes += 1
+        entry = self._entries[key % self.size]
+        if entry is None or entry[0] != key:
+            return None
+        self.hits += 1
+        return entry[1:5]
+
+    def store(self, key, depth, score, bound, move):
+        """
+        Store a search result, unless it would replace a more useful one
+        :param key: (int) the Zobrist key
+        :param depth: (int) the depth searched below the board
+        :param score: (int) the score found
+        :param bound: (int) EXACT, LOWER or UPPER
+        :param move: (int) the best cell in the canonical orientation, or
+        None
+        """
+        index = key % self.size
+        entry = self._entries[index]
+        if entry is not None:
+            if entry[0] != key and entry[5] == self.generation and \
+                    entry[1] > depth:
+                return
+            if entry[0] != key:
+                self.replacements += 1
+        self._entries[index] = (key, depth, score, bound, move,
+                                self.generation)
+        self.stores += 1
+
+    def clear(self):
+        self._entries = [None] * self.size
+
+    def __len__(self):
+        return sum(entry is not None for entry in self._entries)
@@ -0,0 +1,251 @@
+"""
+Tic-Tac-Toe traversal module
+
+Streaming traversal of the game tree. Moves are applied to and undone
+from a single Position buffer, and positions are yielded lazily in depth
+first or breadth first order, so no State is built unless the caller
+asks for one.
+"""
+
+import numpy as np
+from tictactoe import Mark, State
+from . import symmetry
+
+_MARKS = tuple(Mark)
+
+
+class Position:
+    """
+    A mutable bit board on which moves are applied and undone in place.
+    The mark to move alternates with each move.
+    """
+    __slots__ = ('layout', 'o', 'x', 'mark', '_base', '_moves')
+
+    def __init__(self, layout, o=0, x=0, mark=Mark.OMARK):
+        self.layout = layout
+        self.o = o
+        self.x = x
+        self.mark = mark
+        self._base = 0
+        self._moves = []
+
+    @classmethod
+    def from_state(cls, state, mark):
+        """
+        Make a Position from a State
+        :param state: (State) the board
+        :param mark: (Mark) the Mark to move
+        :return: (Position)
+        """
+        return cls(state.layout, *state.to_bits(), mark)
+
+    def apply(self, cell):
+        """
+        Place the mark to move on a cell
+        :param cell: (int) the row-major index of an empty cell
+        """
+        if self.mark == Mark.OMARK:
+            self.o |= 1 << cell
+        else:
+            self.x |= 1 << cell
+        self._moves.append(cell)
+        self.mark = Mark.get_next(self.mark)
+
+    def undo(self):
+        """
+        Take back the last move applied
+        """
+        cell = self._moves.pop()
+        self.mark = Mark.get_next(self.mark)
+        if self.mark == Mark.OMARK:
+            self.o &= ~(1 << cell)
+        else:
+            self.x &= ~(1 << cell)
+
+    def load(self, o, x, mark, ply=0):
+        """
+        Set this Position to another board, forgetting its moves
+        :param o: (int) the O bit set
+        :param x: (int) the X bit set
+        :param mark: (Mark) the Mark to move
+        :param ply: (int) the number of moves from the traversal root
+        """
+        self.o, self.x, self.mark = o, x, mark
+        self._base = ply
+        self._moves.clear()
+
+    @property
+    def ply(self):
+        """
+        The number of moves applied since the traversal root
+        :return: (int)
+        """
+        return self._base + len(self._moves)
+
+    @property
+    def key(self):
+        """
+        The base-3 key of the board
+        :return: (int)
+        """
+        return self.layout.to_key(self.o, self.x)
+
+    @property
+    def canonical_key(self):
+        """
+        The key of the board's canonical isomorph
+        :return: (int)
+        """
+        if self.layout.cells == symmetry.CELLS:
+            return symmetry.CANONICAL[self.key]
+        cells = self.layout.to_cells(self.o, self.x)
+        keys = []
+        for perm in symmetry.permutations(self.layout.size):
+            key = 0
+            for i in perm:
+                key = key * 3 + cells[i]
+            keys.append(key)
+        return min(keys)
+
+    @property
+    def winner(self):
+        """
+        The winning Mark, or None if there is no winner
+        :return: (Mark)
+        """
+        winner = self.layout.winner(self.o, self.x)
+        return Mark(winner) if winner else None
+
+    def moves(self):
+        """
+        Get the empty cells of the board
+        :return: (tuple) of row-major cell indices
+        """
+        return self.layout.moves(self.o, self.x)
+
+    def to_state(self):
+        """
+        Build a State of the board, to keep after the traversal moves on
+        :return: (State)
+        """
+        marks = [_MARKS[m] for m in self.layout.to_cells(self.o, self.x)]
+        array = np.array(marks, dtype=Mark)
+        size = self.layout.size
+        return State(array.reshape(size, size),
+                     win_length=self.layout.win_length)
+
+    def __repr__(self):
+        return f'Position({self.to_state().to_code1()}, {self.mark!r})'
+
+
+def is_terminal(position):
+    """
+    Pruning callback which stops at won games
+    :param position: (Position)
+    :return: (bool) whether the position should not be expanded
+    """
+    return position.winner is not None
+
+
+def canonical_dedup():
+    """
+    Make a deduplication callback which keeps only the first isomorph of
+    each board
+    :return: (function) taking a Position and returning whether it has
+    not been seen before
+    """
+    seen = set()
+
+    def dedup(position):
+        key = position.canonical_key
+        if key in seen:
+            return False
+        seen.add(key)
+        return True
+    return dedup
+
+
+def traverse(states, mark, depth=None, order='dfs', prune=None, dedup=None):
+    """
+    Yield the positions reachable from some states. The same Position
+    object is yielded every time, changed in place between yields, so
+    call to_state() or read its key to keep a position.
+    :param states: (iterable) of States to traverse from, all with the
+    same layout
+    :param mark: (Mark) the Mark to move in the given states
+    :param depth: (int) the ply to stop at, or None to play out the game
+    :param order: (string) 'dfs' for depth first or 'bfs' for breadth
+    first (ply by ply) order
+    :param prune: (function) taking a Position and returning whether to
+    skip its children, such as is_terminal
+    :param dedup: (function) taking a Position and returning whether to
+    keep it, such as a canonical_dedup()
+    :return: (generator) of Position
+    """
+    if order == 'dfs':
+        for state in states:
+            position = Position.from_state(state, mark)
+            if dedup is None or dedup(position):
+                yield from _dfs(position, depth, prune, dedup)
+    elif order == 'bfs':
+        yield from _bfs(states, mark, depth, prune, dedup)
+    else:
+        raise ValueError(f'Unknown traversal order {order!r}')
+
+
+def _dfs(position, depth, prune, dedup):
+    """
+    Depth first traversal, holding one iterator of moves per ply
+    """
+    yield position
+    if depth == 0 or prune is not None and prune(position):
+        return
+    stack = [iter(position.moves())]
+    while stack:
+        cell = next(stack[-1], None)
+        if cell is None:
+            stack.pop()
+            if stack:
+                position.undo()
+            continue
+        position.apply(cell)
+        if dedup is not None and not dedup(position):
+            position.undo()
+            continue
+        yield position
+        if (depth is None or position.ply < depth) and \
+                not (prune is not None and prune(position)):
+            stack.append(iter(position.moves()))
+        else:
+            position.undo()
+
+
+def _bfs(states, mark, depth, prune, dedup):
+    """
+    Breadth first traversal, holding the bit boards of one ply
+    """
+    position = None
+    frontier = []
+    for state in states:
+        if position is None:
+            position = Position(state.layout)
+        position.load(*state.to_bits(), mark)
+        if dedup is None or dedup(position):
+            yield position
+            frontier.append((position.o, position.x))
+    ply = 0
+    while frontier and (depth is None or ply < depth):
+        next_frontier = []
+        for o, x in frontier:
+            position.load(o, x, mark, ply)
+            if prune is not None and prune(position):
+                continue
+            for cell in position.moves():
+                position.apply(cell)
+                if dedup is None or dedup(position):
+                    yield position
+                    next_frontier.append((position.o, position.x))
+                position.undo()
+        frontier = next_frontier
+        mark = Mark.get_next(mark)
+        ply += 1
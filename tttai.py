@@ -5,8 +5,11 @@ Tic-Tac-Toe AI runner
 """
 
 from tictactoe import State, Mark
-from tictactoe.cache import StateCache
-from tictactoe.ai import cache_state_desirability, calculate_next_state_for
+from tictactoe.cache import StateCache, generate_cache_file
+from tictactoe.ai import cache_dependency_graphs, \
+    cache_state_desirability, calculate_next_state_for, rescore_cache
+from tictactoe.movetable import MoveTable
+import argparse
 import time
 
 
@@ -25,17 +28,79 @@ def play_self_game(cache):
         print(state)
 
 
-def recalculate_desirability(cache):
+def recalculate_desirability(cache, vectorized=False, workers=1):
     cache.clear_desirability()
-    cache_state_desirability(cache, State(), Mark.OMARK)
-    cache_state_desirability(cache, State(), Mark.XMARK)
+    return [cache_state_desirability(cache, State(), mark, vectorized,
+                                     workers)
+            for mark in (Mark.OMARK, Mark.XMARK)]
+
+
+def rescore_desirability(cache, evaluate=State.calculate_desirability):
+    """
+    Score the finished states again with a changed scoring function, and
+    update only the cached States whose desirability changes from what
+    the cache holds. The cache must hold the desirability of every state
+    recalculate_desirability solves, as it did with some scoring function.
+    :param cache: (StateCache) the cache
+    :param evaluate: (function) scoring finished States
+    :return: (tuple) of the number of states touched, and the set of the
+    canonical keys of the cached States which changed
+    """
+    return rescore_cache(cache, cache_dependency_graphs(cache), evaluate)
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Tic-Tac-Toe AI runner')
+    parser.add_argument('--generate', action='store_true',
+                        help='regenerate the cached states before solving')
+    parser.add_argument('--ply-counts', action='store_true',
+                        help='print the number of states of each ply '
+                             'when generating')
+    parser.add_argument('--vectorized', action='store_true',
+                        help='generate and solve with batch operations')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='the number of processes to generate and '
+                             'solve with')
+    parser.add_argument('--compile-moves', action='store_true',
+                        help='compile the AI reply for every state into '
+                             'move-table.json and its move-table.bin '
+                             'snapshot')
+    parser.add_argument('--rescore', action='store_true',
+                        help='score finished states again with '
+                             'State.calculate_desirability, and write only '
+                             'the changed states to state-cache.bin in '
+                             'place')
+    args = parser.parse_args()
+
+    if args.generate:
+        counts = generate_cache_file('state-cache.json', args.vectorized,
+                                     ply_counts=True, workers=args.workers)
+        if args.ply_counts:
+            for mark, ply_counts in counts.items():
+                print('Plies from', mark, ply_counts, sum(ply_counts))
     cache = StateCache()
-    cache.load('state-cache.json')
-    recalculate_desirability(cache)
-    cache.write('state-cache.json')
+    if args.rescore:
+        cache.load('state-cache.bin')
+        touched, keys = rescore_desirability(cache)
+        written = cache.write_changes('state-cache.bin', keys)
+        print('Touched', touched, 'states and wrote', written, 'changed '
+              'records')
+        if keys:
+            # A JSON file cannot be written in place
+            cache.write('state-cache.json')
+    else:
+        cache.load('state-cache.json')
+        for solution in recalculate_desirability(cache, args.vectorized,
+                                                 args.workers):
+            print('Solved', solution.nodes, 'states from', solution.mark,
+                  'in', round(1000 * solution.seconds), 'ms')
+        cache.write('state-cache.json')
+        cache.write('state-cache.bin', file_format=3)
+    if args.compile_moves:
+        table = MoveTable.compile(cache)
+        table.write('move-table.json')
+        table.write_snapshot('move-table.bin', 'move-table.json')
+        print('Compiled', len(table), 'moves')
 
 
 if __name__ == '__main__':
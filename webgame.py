@@ -1,22 +1,32 @@
-from flask import Flask, Blueprint, render_template, redirect, request, url_for
-from tictactoe import State, Mark
-from tictactoe.cache import StateCache
-from tictactoe.ai import calculate_next_state_for
+import time
+_START_TIME = time.perf_counter()
+
+from flask import Flask, Blueprint, Response, current_app, g, \
+    render_template, redirect, request, url_for
+from tictactoe import State
+from tictactoe.movetable import MoveTable
+from tictactoe.session import SessionConflictError, SessionData, \
+    make_session_store, submit_batch, submit_form
+from tictactoe import metrics, responses
+import itertools
 import json
-from random import randint
 import os
+import secrets
+import sys
+import threading
 
 FLASK_APPLICATION_ROOT = os.environ.get('FLASK_APPLICATION_ROOT', '')
 EMPTY_BOARD = list(State()[:].flatten())  # No touchy
-ACTIVE_SESSIONS = {}
-STATE_CACHE = StateCache()
-STATE_CACHE.load('state-cache.json')
-
-
-class SessionData:
-    def __init__(self):
-        self.state = State()
-        self.mark = None
+# With profiling on, a request with ?profile=1 and the profile token in
+# an X-Profile-Token header has its per-function timings written to a
+# file in this directory, at most once every PROFILE_INTERVAL seconds
+PROFILE_DIR = os.environ.get('TTTAI_PROFILE_DIR')
+PROFILE_TOKEN = os.environ.get('TTTAI_PROFILE_TOKEN')
+PROFILE_INTERVAL = float(os.environ.get('TTTAI_PROFILE_INTERVAL', 1.0))
+_PROFILE_LOCK = threading.Lock()
+_last_profile = float('-inf')
+# Counts the apps built, as only the first start-up includes the imports
+_APPS = itertools.count()
 
 
 # Used in order to prepend the FLASK_APPLICATION_ROOT prefix
@@ -26,6 +36,15 @@ bp = Blueprint('main',
                static_folder='static')
 
 
+def _served():
+    """
+    Get what the current app serves from
+    :return: (dict) of the 'sessions', 'move_table', 'responses' and
+    'startup' set up by create_app
+    """
+    return current_app.extensions['tttai']
+
+
 @bp.context_processor
 def globals_processor():
     def flask_application_root():
@@ -33,6 +52,66 @@ def globals_processor():
     return {'FLASK_APPLICATION_ROOT': flask_application_root}
 
 
+def _may_profile():
+    """
+    Check whether to profile the current request, counting it against
+    the profiling rate limit if so
+    :return: (bool)
+    """
+    global _last_profile
+    if not (PROFILE_DIR and PROFILE_TOKEN and request.args.get('profile')):
+        return False
+    token = request.headers.get('X-Profile-Token', '')
+    if not secrets.compare_digest(token.encode(), PROFILE_TOKEN.encode()):
+        return False
+    with _PROFILE_LOCK:
+        now = time.monotonic()
+        if now - _last_profile < PROFILE_INTERVAL:
+            return False
+        _last_profile = now
+    return True
+
+
+@bp.before_app_request
+def start_request():
+    g.start_time = time.perf_counter()
+    if _may_profile():
+        g.profiler = metrics.SamplingProfiler().__enter__()
+
+
+@bp.after_app_request
+def finish_request(response):
+    endpoint = request.endpoint or 'none'
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - g.start_time,
+                                    endpoint=endpoint)
+    metrics.REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.__exit__(None, None, None)
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        file_name = f'{endpoint}-{time.time_ns()}.txt'
+        with open(os.path.join(PROFILE_DIR, file_name), 'w') as file:
+            file.write(f'{request.method} {request.full_path}\n')
+            file.write(profiler.format())
+        # Named without the directory, which clients need not know
+        response.headers['X-Profile'] = file_name
+    return response
+
+
+@bp.teardown_app_request
+def stop_profiler(exception):
+    # Stop the sampler of a request which failed before after_request
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.__exit__(None, None, None)
+
+
+@bp.route('/metrics')
+def metrics_text():
+    return Response(metrics.REGISTRY.render(),
+                    content_type=metrics.CONTENT_TYPE)
+
+
 @bp.route('/')
 def home():
     return render_template('home.html')
@@ -40,84 +119,133 @@ def home():
 
 @bp.route('/start-new-game')
 def start_new_game():
-    sid = randint(10000, 99999)
-    ACTIVE_SESSIONS[sid] = ACTIVE_SESSIONS.get(sid, SessionData())
+    try:
+        game = SessionData.from_options(request.args.get('size'),
+                                        request.args.get('win'),
+                                        request.args.get('engine'))
+    except ValueError as e:
+        return str(e), 400
+    sid, _ = _served()['sessions'].create(game)
     return redirect(url_for('main.session', session_id=sid))
 
 
-@bp.route('/session/<session_id>')
+@bp.route('/session/<int:session_id>')
 def session(session_id):
-    if int(session_id) not in ACTIVE_SESSIONS:
+    game = _served()['sessions'].get(session_id)
+    if game is None:
         return 'Not found.', 404  # TODO
     return render_template(
         'game.html',
-        board_marks=EMPTY_BOARD,
+        board_marks=EMPTY_BOARD if game.size == 3 else
+        [0] * game.size ** 2,
+        board_size=game.size,
+        win_length=game.win_length,
+        engine=game.engine,
         session_id=session_id)
 
 
-@bp.route('/session-data/<session_id>', methods=['GET'])
+@bp.route('/session-data/<int:session_id>', methods=['GET'])
 def session_data(session_id):
-    try:
-        session = ACTIVE_SESSIONS[int(session_id)]
-    except KeyError as e:
+    served = _served()
+    session = served['sessions'].get(session_id)
+    if session is None:
         return 'Not found.', 404  # TODO
-    board = session.state[:].tolist()
-    winner = session.state.winner
-    state = {
-        'board': board,
-        'winner': winner
-    }
-    return json.dumps(state)
+    return served['responses'].session_data(session)
 
 
-@bp.route('/session-data/<session_id>', methods=['POST'])
+@bp.route('/session-data/<int:session_id>', methods=['POST'])
 def session_data_submit(session_id):
+    served = _served()
+    session = served['sessions'].get(session_id)
+    if session is None:
+        return 'Not found.', 404
+    error = submit_form(served['move_table'], session, request.form)
+    if error is not None:
+        return error, 400
     try:
-        session = ACTIVE_SESSIONS[int(session_id)]
-    except KeyError as e:
-        return str(e), 404
+        served['sessions'].save(session_id, session)
+    except SessionConflictError as e:
+        return str(e), 409
+    return served['responses'].session_data(session)
+
+
+@bp.route('/moves', methods=['POST'])
+def moves():
+    with metrics.timing(metrics.STAGE_SECONDS, stage='parse'):
+        data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return 'Expected a JSON object.', 400
     try:
-        verb = request.form.get('verb')
-        if verb.lower() == 'set-mark':
-            args = json.loads(request.form.get('args'))
-            player_mark = Mark(args['mark'])
-            row = args['row']
-            col = args['column']
-
-            next_mark = Mark.get_next(player_mark)
-            if session.mark is None:
-                session.mark = next_mark
-            else:
-                wrong_mark = session.mark != next_mark
-                overwrite = session.state.get_mark(row, col) != Mark.EMPTY
-                if wrong_mark or overwrite:
-                    raise Exception('Illegal board move!')
-            session.state.set_mark(row, col, player_mark)
-            if session.state.winner is None:
-                try:
-                    next_board_state = calculate_next_state_for(
-                        STATE_CACHE, session.state, session.mark)
-                    session.state = next_board_state
-                except ValueError:
-                    pass
-
-    except Exception as e:
-        raise e
-    board = session.state[:].tolist()
-    winner = session.state.winner
-    state = {
-        'board': board,
-        'winner': winner
-    }
-    return json.dumps(state)
+        served = _served()
+        replies = submit_batch(served['move_table'], served['sessions'],
+                               data)
+    except ValueError as e:
+        return str(e), 400
+    return json.dumps(replies), 200, {'Content-Type': 'application/json'}
 
 
-app = Flask(__name__)
-app.register_blueprint(bp, url_prefix=FLASK_APPLICATION_ROOT)
+@bp.route('/move/<board>/<mark>')
+def move(board, mark):
+    try:
+        key, mark = responses.parse_board(board), responses.parse_mark(mark)
+    except ValueError as e:
+        return str(e), 400
+    move_table = _served()['move_table']
+    # Boards without a reply are never cached, whatever they match
+    if (key, mark) not in move_table:
+        return 'No reply for this board.', 404
+    tag = responses.etag(move_table, key, mark)
+    headers = {'ETag': tag, 'Cache-Control': responses.CACHE_CONTROL}
+    if responses.etag_matches(request.headers.get('If-None-Match'), tag):
+        return Response(status=304, headers=headers)
+    reply = responses.move_reply(move_table, key, mark)
+    return Response(json.dumps(reply), headers=headers,
+                    mimetype='application/json')
+
+
+def create_app():
+    """
+    Build the web game app and the sessions, responses and move table it
+    serves from, reporting the time each start-up phase took if
+    TTTAI_STARTUP_REPORT is set or TTTAI_STARTUP_BUDGET seconds are
+    exceeded
+    :return: (Flask)
+    """
+    first = next(_APPS) == 0
+    startup = metrics.StartupTimer(_START_TIME if first else None)
+    if first:
+        startup.mark('imports')
+    sessions = make_session_store(
+        os.environ.get('TTTAI_SESSION_STORE'),
+        max_size=int(os.environ.get('TTTAI_SESSION_MAX_SIZE', 10000)),
+        ttl=float(os.environ.get('TTTAI_SESSION_TTL', 3600)))
+    startup.mark('sessions')
+    # Mapped read-only, so worker processes share one copy of the masks
+    move_table = MoveTable.from_files('move-table.json', 'move-table.bin',
+                                      mapped=True)
+    startup.mark('move table')
+    metrics.register_sessions(sessions)
+    app = Flask(__name__)
+    app.extensions['tttai'] = {
+        'sessions': sessions,
+        'move_table': move_table,
+        # Session data is serialized as boards are first played
+        'responses': responses.ResponseCache(),
+        'startup': startup,
+    }
+    app.register_blueprint(bp, url_prefix=FLASK_APPLICATION_ROOT)
+    startup.mark('app')
+    startup.register()
+    budget = os.environ.get('TTTAI_STARTUP_BUDGET')
+    budget = float(budget) if budget else None
+    if os.environ.get('TTTAI_STARTUP_REPORT') or \
+            budget is not None and startup.total > budget:
+        print(startup.report(budget), end='', file=sys.stderr)
+    return app
 
 
 def main():
-    app.run(debug=True)
+    create_app().run(debug=True)
 
 
 if __name__ == '__main__':